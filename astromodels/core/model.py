@@ -12,7 +12,9 @@ from astromodels.core.parameter import Parameter, IndependentVariable
 from astromodels.core.tree import Node, DuplicatedNode
 from astromodels.functions.function import get_function
 from astromodels.sources.source import Source, POINT_SOURCE, EXTENDED_SOURCE, PARTICLE_SOURCE
+from astromodels.utils.bounding_box_index import BoundingBoxIndex
 from astromodels.utils.disk_usage import disk_usage
+from astromodels.utils.healpix import get_healpix_geometry, get_pixel_index, nest_to_ring
 from astromodels.utils.long_path_formatter import long_path_formatter
 
 
@@ -78,6 +80,11 @@ class Model(Node):
         # This controls the verbosity of the display
         self._complete_display = False
 
+        # Spatial index of the boundaries of the extended sources (see _get_extended_sources_index)
+
+        self._extended_sources_index = None
+        self._extended_sources_index_key = None
+
     def __reduce__(self):
 
         from astromodels.core.model_parser import model_unpickler
@@ -922,25 +929,57 @@ class Model(Node):
 
         return ra_min, ra_max, dec_min, dec_max
 
+    def _get_extended_sources_index(self):
+
+        # The boundaries depend only on the parameters of the spatial shapes, so the index is built again only if
+        # the extended sources or those parameters have changed
+
+        key = tuple(map(lambda source: (source.name,
+                                        tuple(map(lambda par: (par.value, par.min_value, par.max_value),
+                                                  source.spatial_shape.parameters.values()))),
+                        self._extended_sources.values()))
+
+        if key != self._extended_sources_index_key:
+
+            boundaries = map(lambda source: source.get_boundaries(), self._extended_sources.values())
+
+            self._extended_sources_index = BoundingBoxIndex(boundaries)
+            self._extended_sources_index_key = key
+
+        return self._extended_sources_index
+
     def is_inside_any_extended_source(self, j2000_ra, j2000_dec):
+        """
+        Returns whether the provided position(s) are inside the boundaries of any extended source (longitudes
+        wrapping around 360 are handled correctly)
 
-        for ext_source in self.extended_sources.values():
+        :param j2000_ra: R.A. (number or array)
+        :param j2000_dec: Dec. (number or array)
+        :return: True or False for a single position, or a boolean array
+        """
 
-            (ra_min, ra_max), (dec_min, dec_max) = ext_source.get_boundaries()
+        mask = self._get_extended_sources_index().is_inside_any(j2000_ra, j2000_dec)
 
-            # Transform from the 0...360 convention to the -180..180 convention, so that
-            # the comparison is easier
-            if ra_min > 180:
+        if np.ndim(j2000_ra) == 0:
 
-                ra_min = -(360-ra_min)
+            return bool(mask[0])
 
-            if ra_min <= j2000_ra <= ra_max and dec_min <= j2000_dec <= dec_max:
+        else:
 
-                return True
+            return mask
 
-        # If we are here, it means that no extended source contains the provided coordinates
+    def find_extended_sources_containing(self, j2000_ra, j2000_dec):
+        """
+        Finds the extended sources whose boundaries contain the provided positions
+
+        :param j2000_ra: R.A. (number or array)
+        :param j2000_dec: Dec. (number or array)
+        :return: a tuple (position_indices, source_ids) of arrays, where each pair of elements means that the position
+        position_indices[i] is inside the extended source with id source_ids[i] (the same ids used by the other
+        get_extended_source_* methods)
+        """
 
-        return False
+        return self._get_extended_sources_index().find(j2000_ra, j2000_dec)
 
     def get_number_of_particle_sources(self):
         """
@@ -979,4 +1018,62 @@ class Model(Node):
 
             fluxes.append(self._point_sources[src](energies))
 
-        return np.sum(fluxes, axis=0)
\ No newline at end of file
+        return np.sum(fluxes, axis=0)
+
+    def to_healpix_cube(self, nside, energies, nest=False):
+        """
+        Returns the differential flux of all the point and extended sources in each pixel of a HEALPix map in
+        equatorial (J2000) coordinates. Each extended source is only evaluated on the pixels within its boundaries
+        (see ExtendedSource.get_sparse_flux), at the center of the pixels, and its brightness (per sr) is multiplied by
+        the solid angle of the pixels. The flux of each point source is added to the pixel containing it. The geometry
+        of the map is computed once for each nside (see astromodels.utils.healpix).
+
+        :param nside: the nside of the map
+        :param energies: energies (without units, in the current units)
+        :param nest: whether to use the NESTED scheme for the pixels (default: False, i.e., RING)
+        :return: an array with shape (n_energies, n_pixels) containing the differential flux (in the current units)
+        """
+
+        energies = np.array(energies, dtype=float, ndmin=1)
+
+        geometry = get_healpix_geometry(nside)
+
+        cube = np.zeros((energies.shape[0], geometry.n_pixels))
+
+        # Solid angle of the pixels. The spatial shapes are normalized to 1 / sr (see for example Gaussian_on_sphere)
+
+        pixel_area = geometry.pixel_area
+
+        for source in self._extended_sources.values():
+
+            # In the RING scheme the pixels within a range of latitudes are contiguous, so we can exclude all the
+            # others right away
+
+            (_, _), (min_lat, max_lat) = source.get_boundaries()
+
+            start, stop = geometry.get_latitude_range(min_lat, max_lat)
+
+            if start == stop:
+
+                continue
+
+            # A sub-grid (instead of a slice of the coordinates) keeps the cached unit vectors of the pixels
+
+            pixels = geometry.sky_grid.get_subgrid(start, stop)
+
+            indices, fluxes = source.get_sparse_flux(pixels.lon, pixels.lat, energies)
+
+            cube[:, start + indices] += fluxes.T * pixel_area
+
+        for source in self._point_sources.values():
+
+            pixel = get_pixel_index(nside, source.position.get_ra(), source.position.get_dec())[0]
+
+            cube[:, pixel] += source(energies)
+
+        if nest:
+
+            cube = cube[:, nest_to_ring(nside, np.arange(geometry.n_pixels))]
+
+        return cube
+
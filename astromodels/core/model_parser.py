@@ -507,7 +507,29 @@ class ShapeParser(object):
         if 'expression' in parameters_definition:
 
             # This is a composite function
-            function_instance = function.get_function(function_name, parameters_definition['expression'])
+            function_instance = function.get_function(function_name, parameters_definition['expression'],
+                                                      parameters_definition.get('template_options'))
+
+        elif 'template_options' in parameters_definition:
+
+            # This is a template model loaded with some options (see TemplateModel.to_dict)
+
+            # NOTE: import here to avoid circular import
+
+            from astromodels.functions.template_model import TemplateModel, MissingDataFile
+
+            template_options = dict(parameters_definition['template_options'])
+
+            model_name = template_options.pop('model_name')
+
+            try:
+
+                function_instance = TemplateModel(model_name, other_name=function_name, **template_options)
+
+            except MissingDataFile: # pragma: no cover
+
+                raise ModelSyntaxError("Template %s, specified as shape for %s of source %s, does not "
+                                       "exist" % (model_name, component_name, self._source_name))
 
         else:
 
@@ -520,6 +542,23 @@ class ShapeParser(object):
                 raise ModelSyntaxError("Function %s, specified as shape for %s of source %s, is not a "
                                        "known function" % (function_name, component_name, self._source_name))
 
+        # Restore the precision of the functions which support it (see for example DMFitFunction). For a composite
+        # function this is the list of the components (like 'DMSpectra{2}') in single precision
+
+        if 'single_precision' in parameters_definition:
+
+            if 'expression' in parameters_definition:
+
+                for component in parameters_definition['single_precision']:
+
+                    index = int(re.match(r'.+\{([0-9]+)\}$', component).groups()[0])
+
+                    function_instance.functions[index - 1].set_single_precision(True)
+
+            else:
+
+                function_instance.set_single_precision(parameters_definition['single_precision'])
+
         # Loop over the parameters of the function instance, instead of the specification,
         # so we can understand if there are parameters missing from the specification
 
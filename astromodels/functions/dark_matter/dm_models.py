@@ -1,12 +1,417 @@
+import hashlib
+import os
+import uuid
+
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
 import astropy.units as astropy_units
 
 from astromodels.functions.function import Function1D, FunctionMeta
+from astromodels.utils.configuration import get_user_data_path
 from astromodels.utils.data_files import _get_data_file_path
 
 
-class DMFitFunction(Function1D):
+"""
+    Mapping between the channel codes and the rows in the gammamc file
+    dmSpecTab.npy created to match this mapping too
+
+    1 : 8, # ee
+    2 : 6, # mumu
+    3 : 3, # tautau
+    4 : 1, # bb
+    5 : 2, # tt
+    6 : 7, # gg
+    7 : 4, # ww
+    8 : 5, # zz
+    9 : 0, # cc
+    10 : 10, # uu
+    11 : 11, # dd
+    12 : 9, # ss
+"""
+
+_channel_index_mapping = {
+    1: 8,  # ee
+    2: 6,  # mumu
+    3: 3,  # tautau
+    4: 1,  # bb
+    5: 2,  # tt
+    6: 7,  # gg
+    7: 4,  # ww
+    8: 5,  # zz
+    9: 0,  # cc
+    10: 10,  # uu
+    11: 11,  # dd
+    12: 9,  # ss
+}
+
+# Number of decades in x = log10(E/M)
+_ndec = 10.0
+_xedge = np.linspace(0, 1.0, 251)
+_x = 0.5 * (_xedge[1:] + _xedge[:-1]) * _ndec - _ndec
+
+# These are the mass points in GeV of the Fermi tables (gammamc_dif.dat)
+_mass_f = np.array([2.0, 4.0, 6.0, 8.0, 10.0,
+                    25.0, 50.0, 80.3, 91.2, 100.0,
+                    150.0, 176.0, 200.0, 250.0, 350.0, 500.0, 750.0,
+                    1000.0, 1500.0, 2000.0, 3000.0, 5000.0, 7000.0, 1E4])
+
+# These are the mass points in GeV of the HAWC tables (dmSpecTab.npy)
+_mass_h = np.array([50., 61.2, 74.91, 91.69, 112.22, 137.36, 168.12, 205.78, 251.87, 308.29,
+                    377.34, 461.86, 565.31, 691.93, 846.91, 1036.6, 1268.78, 1552.97, 1900.82,
+                    2326.57, 2847.69, 3485.53, 4266.23, 5221.81, 6391.41, 7823.0, 9575.23,
+                    11719.94, 14345.03, 17558.1, 21490.85, 26304.48, 32196.3, 39407.79, 48234.54,
+                    59038.36, 72262.07, 88447.7, 108258.66, 132506.99, 162186.57, 198513.95,
+                    242978.11, 297401.58, 364015.09, 445549.04, 545345.37, 667494.6, 817003.43, 1000000.])
+
+# Mass points and data files for the two tables: 'fermi' (used by DMFitFunction) and 'combined' (used by
+# DMSpectra, Fermi tables up to 10 TeV and HAWC tables above)
+
+_dm_tables_masses = {'fermi': _mass_f,
+                     'combined': np.append(_mass_f, _mass_h[27:])}
+
+_dm_tables_files = {'fermi': ["dark_matter/gammamc_dif.dat"],
+                    'combined': ["dark_matter/gammamc_dif.dat", "dark_matter/dmSpecTab.npy"]}
+
+# These will contain the tables (channel x mass x energy) and their interpolators already loaded in this session,
+# shared by all the instances of DMFitFunction and DMSpectra
+
+_dm_tables = {}
+_dm_interpolators = {}
+
+
+def _read_dm_table(table_name):
+    """
+    Read the original data files and build the table (channel x mass x energy)
+
+    :param table_name: either 'fermi' or 'combined'
+    :return: the table
+    """
+
+    data_f = np.loadtxt(_get_data_file_path("dark_matter/gammamc_dif.dat"))
+
+    dn_f = data_f.reshape((12, 24, 250))
+
+    if table_name == 'fermi':
+
+        return dn_f
+
+    data_h = np.load(_get_data_file_path("dark_matter/dmSpecTab.npy"))
+
+    dn = np.zeros((12, len(_dm_tables_masses[table_name]), 250))
+    dn[:, 0:24, :] = dn_f
+    dn[:, 24:, :] = data_h[:, 27:, :]
+
+    return dn
+
+
+def _get_dm_table_cache_path(table_name, dtype):
+
+    # The name of the cache depends on the size and modification time of the original files, so that the cache is
+    # rebuilt if they change
+
+    checksum = hashlib.md5()
+
+    for data_file in _dm_tables_files[table_name]:
+
+        file_stat = os.stat(_get_data_file_path(data_file))
+
+        checksum.update("%s %s %s" % (data_file, file_stat.st_size, file_stat.st_mtime))
+
+    return os.path.join(get_user_data_path(), 'dark_matter_cache',
+                        '%s_%s_%s.npy' % (table_name, np.dtype(dtype).name, checksum.hexdigest()))
+
+
+def _get_dm_table(table_name, dtype):
+    """
+    Returns the table (channel x mass x energy) with the provided name. The first time it is built from the original
+    data files and saved as a binary file in the user data directory, which is then memory-mapped.
+
+    :param table_name: either 'fermi' or 'combined'
+    :param dtype: either np.float32 or np.float64
+    :return: the table (a read-only array)
+    """
+
+    key = (table_name, np.dtype(dtype).name)
+
+    if key not in _dm_tables:
+
+        cache_path = _get_dm_table_cache_path(table_name, dtype)
+
+        if not os.path.exists(cache_path):
+
+            cache_dir = os.path.dirname(cache_path)
+
+            if not os.path.exists(cache_dir):
+
+                os.makedirs(cache_dir)
+
+            # Write to a temporary file and then rename it, so that another process never reads a partial file
+
+            temp_file = "%s.%s.npy" % (cache_path, uuid.uuid4().hex)
+
+            np.save(temp_file, _read_dm_table(table_name).astype(dtype))
+
+            os.rename(temp_file, cache_path)
+
+        _dm_tables[key] = np.load(cache_path, mmap_mode='r')
+
+    return _dm_tables[key]
+
+
+class _DMTableInterpolator(object):
+    """
+    Linear interpolation of a table (channel x mass x energy) in mass and x = log10(E/mass), with linear
+    extrapolation outside of the grid. This gives the same results as a RegularGridInterpolator with
+    bounds_error=False and fill_value=None, but it is much faster: since the x grid is uniform the cell containing
+    each x is computed arithmetically, and the interpolation in mass (which does not depend on the energies) is
+    computed only once for each channel and mass, and then cached.
+
+    :param table_name: either 'fermi' or 'combined'
+    :param dtype: either np.float32 or np.float64
+    """
+
+    def __init__(self, table_name, dtype):
+
+        self.table = _get_dm_table(table_name, dtype)
+
+        self.masses = _dm_tables_masses[table_name]
+
+        self._n_x = _x.shape[0]
+
+        self._x_min = _x[0]
+
+        self._inverse_x_step = (self._n_x - 1) / (_x[-1] - _x[0])
+
+        # This will contain the spectra interpolated in mass (and their differences between consecutive points of the
+        # x grid), for each (channel, mass)
+
+        self._spectra_cache = {}
+
+    def _get_mass_weights(self, mass):
+
+        # Same convention as RegularGridInterpolator (masses outside of the grid use the first or the last cell)
+
+        idx = min(max(np.searchsorted(self.masses, mass) - 1, 0), self.masses.shape[0] - 2)
+
+        t = (mass - self.masses[idx]) / (self.masses[idx + 1] - self.masses[idx])
+
+        return idx, t
+
+    def get_spectrum(self, channel, mass):
+        """
+        Returns the spectrum for the provided channel and mass on the x grid of the table
+
+        :param channel: the channel code (see print_channel_mapping)
+        :param mass: the mass (GeV)
+        :return: a tuple (spectrum, differences between consecutive elements of the spectrum)
+        """
+
+        key = (int(channel), float(mass))
+
+        spectrum = self._spectra_cache.get(key)
+
+        if spectrum is None:
+
+            ichan = _channel_index_mapping[int(channel)]
+
+            idx, t = self._get_mass_weights(float(mass))
+
+            this_spectrum = (1 - t) * self.table[ichan, idx, :] + t * self.table[ichan, idx + 1, :]
+
+            spectrum = (this_spectrum, np.diff(this_spectrum))
+
+            if len(self._spectra_cache) >= 1000:
+
+                self._spectra_cache.clear()
+
+            self._spectra_cache[key] = spectrum
+
+        return spectrum
+
+    def interpolate_x(self, spectra, differences, log_x):
+        """
+        Interpolate the provided spectra (tabulated on the x grid of the table, on the last axis) at the provided
+        values of x = log10(E/mass)
+
+        :param spectra: an array with the x grid on the last axis
+        :param differences: the differences between consecutive elements of spectra along the last axis
+        :param log_x: the values of x
+        :return: an array with the same shape as spectra, except for the last axis which has the shape of log_x
+        """
+
+        u = (log_x - self._x_min) * self._inverse_x_step
+
+        # NOTE: after clipping u is positive, so truncating is the same as taking the floor
+
+        idx = np.clip(u, 0, self._n_x - 2).astype(np.intp)
+
+        t = u - idx
+
+        return np.asarray(np.take(spectra, idx, axis=-1) + t * np.take(differences, idx, axis=-1))
+
+    def __call__(self, channel, mass, log_x):
+
+        spectrum, differences = self.get_spectrum(channel, mass)
+
+        return self.interpolate_x(spectrum, differences, log_x)
+
+    def evaluate_grid(self, channels, masses, log_x):
+        """
+        Interpolate the table for several channels and masses at once
+
+        :param channels: the channel codes (see print_channel_mapping)
+        :param masses: the masses (GeV)
+        :param log_x: a (n_masses, n_energies) array with the values of x = log10(E/mass) for each mass
+        :return: a (n_channels, n_masses, n_energies) array
+        """
+
+        ichans = np.array(map(lambda channel: _channel_index_mapping[int(channel)], channels), dtype=int)
+
+        mass_idx, mass_t = np.array(map(self._get_mass_weights, masses)).T
+
+        mass_idx = mass_idx.astype(int)
+
+        # Interpolate in mass for all channels (n_channels x n_masses x n_x)
+
+        table = self.table[ichans]
+
+        spectra = ((1 - mass_t)[None, :, None] * table[:, mass_idx, :] +
+                   mass_t[None, :, None] * table[:, mass_idx + 1, :])
+
+        differences = np.diff(spectra, axis=-1)
+
+        # Now interpolate in x (which is different for each mass)
+
+        u = (log_x - self._x_min) * self._inverse_x_step
+
+        idx = np.clip(u, 0, self._n_x - 2).astype(np.intp)
+
+        t = u - idx
+
+        mass_rows = np.arange(len(masses))[:, None]
+
+        return spectra[:, mass_rows, idx] + t * differences[:, mass_rows, idx]
+
+
+def _get_dm_spectra(interpolator, energies, channels, masses, sigmav, J):
+    """
+    Compute the differential fluxes for several channels and masses at once (see get_spectra in DMFitFunction and
+    DMSpectra)
+
+    :param interpolator: the interpolator for the table to use
+    :param energies: energies (keV if not a Quantity)
+    :param channels: the channel codes (None for all channels)
+    :param masses: the masses (GeV if not a Quantity)
+    :param sigmav: cross section (cm^3/s)
+    :param J: J-factor (GeV^2 cm^-5)
+    :return: a (n_channels, n_masses, n_energies) array of differential fluxes (keV^-1 cm^-2 s^-1)
+    """
+
+    if channels is None:
+
+        channels = sorted(_channel_index_mapping.keys())
+
+    if isinstance(energies, astropy_units.Quantity):
+
+        energies = energies.to(astropy_units.keV).value
+
+    if isinstance(masses, astropy_units.Quantity):
+
+        masses = masses.to(astropy_units.GeV).value
+
+    energies = np.array(energies, dtype=float, ndmin=1)
+
+    masses = np.array(masses, dtype=float, ndmin=1)
+
+    keVtoGeV = 1e-6
+
+    xm = np.log10(energies[None, :] * keVtoGeV / masses[:, None])
+
+    phip = 1. / (8. * np.pi) * np.power(masses, -2) * (sigmav * J)
+
+    dn = interpolator.evaluate_grid(channels, masses, xm)
+    dn[:, xm > 0] = 0
+
+    return phip[None, :, None] * dn / energies[None, None, :]
+
+
+def _get_dm_interpolator(table_name, dtype):
+    """
+    Returns the interpolator for the provided table, which is built the first time it is needed and then shared
+    by all the instances
+
+    :param table_name: either 'fermi' or 'combined'
+    :param dtype: either np.float32 or np.float64
+    :return: a _DMTableInterpolator instance
+    """
+
+    key = (table_name, np.dtype(dtype).name)
+
+    if key not in _dm_interpolators:
+
+        _dm_interpolators[key] = _DMTableInterpolator(table_name, dtype)
+
+    return _dm_interpolators[key]
+
+
+class _DMTableFunction(object):
+    """
+    Methods shared by the functions using the tabulated dark matter spectra. The class using it must define
+    _table_name in _setup
+    """
+
+    def set_single_precision(self, single_precision=True):
+        """
+        Store (and interpolate) the tabulated spectra in single precision (float32) instead of double precision. The
+        interpolation is linear, so the relative error with respect to double precision is of the order of the
+        float32 rounding error (6e-8), and always below 1e-6.
+
+        :param single_precision: True (default) for single precision, False for double precision
+        :return: none
+        """
+
+        self._single_precision = bool(single_precision)
+
+        self._setup()
+
+    def _get_dtype(self):
+
+        return np.float32 if getattr(self, '_single_precision', False) else np.float64
+
+    def _get_interpolator(self):
+
+        return _get_dm_interpolator(self._table_name, self._get_dtype())
+
+    def get_spectra(self, energies, channels=None, masses=None):
+        """
+        Evaluate the spectrum for several channels and masses in one call, using the current values of sigmav
+        and J.
+
+        :param energies: the energies (keV if not a Quantity)
+        :param channels: (optional) list of channel codes (see print_channel_mapping). Default: all channels
+        :param masses: (optional) list of masses (GeV if not a Quantity). Default: the current mass
+        :return: a (n_channels, n_masses, n_energies) array of differential fluxes (keV^-1 cm^-2 s^-1)
+        """
+
+        if masses is None:
+
+            masses = [self.mass.value]
+
+        return _get_dm_spectra(self._get_interpolator(), energies, channels, masses, self.sigmav.value, self.J.value)
+
+    def to_dict(self, minimal=False):
+
+        data = super(_DMTableFunction, self).to_dict(minimal)
+
+        # Save the precision, so that the ModelParser can restore it
+
+        if not minimal and self._get_dtype() == np.float32:
+
+            data['single_precision'] = True
+
+        return data
+
+
+class DMFitFunction(_DMTableFunction, Function1D):
     r"""
         description :
 
@@ -47,60 +452,12 @@ class DMFitFunction(Function1D):
 
     def _setup(self):
 
-        tablepath = _get_data_file_path("dark_matter/gammamc_dif.dat")
-
-        self._data = np.loadtxt(tablepath)
-
-        """
-            Mapping between the channel codes and the rows in the gammamc file
-
-            1 : 8, # ee
-            2 : 6, # mumu
-            3 : 3, # tautau
-            4 : 1, # bb
-            5 : 2, # tt
-            6 : 7, # gg
-            7 : 4, # ww
-            8 : 5, # zz
-            9 : 0, # cc
-            10 : 10, # uu
-            11 : 11, # dd
-            12 : 9, # ss
-        """
+        # The tables and the interpolators are shared between all instances (see _get_dm_interpolator), so here we
+        # only make sure that they are ready and that the channel is valid
 
-        channel_index_mapping = {
-            1: 8,  # ee
-            2: 6,  # mumu
-            3: 3,  # tautau
-            4: 1,  # bb
-            5: 2,  # tt
-            6: 7,  # gg
-            7: 4,  # ww
-            8: 5,  # zz
-            9: 0,  # cc
-            10: 10,  # uu
-            11: 11,  # dd
-            12: 9,  # ss
-        }
+        self._table_name = 'fermi'
 
-        # Number of decades in x = log10(E/M)
-        ndec = 10.0
-        xedge = np.linspace(0, 1.0, 251)
-        self._x = 0.5 * (xedge[1:] + xedge[:-1]) * ndec - ndec
-
-        ichan = channel_index_mapping[int(self.channel.value)]
-
-        # These are the mass points
-        self._mass = np.array([2.0, 4.0, 6.0, 8.0, 10.0,
-                               25.0, 50.0, 80.3, 91.2, 100.0,
-                               150.0, 176.0, 200.0, 250.0, 350.0, 500.0, 750.0,
-                               1000.0, 1500.0, 2000.0, 3000.0, 5000.0, 7000.0, 1E4])
-        self._dn = self._data.reshape((12, 24, 250))
-
-        self._dn_interp = RegularGridInterpolator([self._mass, self._x],
-                                                  self._dn[ichan, :, :],
-                                                  bounds_error=False,
-                                                  fill_value=None)
+        self._get_interpolator().get_spectrum(self.channel.value, self.mass.value)
 
         if self.mass.value > 10000:
 
@@ -159,13 +516,13 @@ class DMFitFunction(Function1D):
 
         xm = np.log10(np.divide(xx, mass))
         phip = 1. / (8. * np.pi) * np.power(mass, -2) * (sigmav * J)  # units of this should be 1 / cm**2 / s
-        dn = self._dn_interp((mass, xm))
+        dn = self._get_interpolator()(channel, np.asarray(mass), np.asarray(xm))
         dn[xm > 0] = 0
 
         return np.multiply(phip, np.divide(dn, x))
 
 
-class DMSpectra(Function1D):
+class DMSpectra(_DMTableFunction, Function1D):
     r"""
         description :
 
@@ -208,83 +565,12 @@ class DMSpectra(Function1D):
 
     def _setup(self):
 
-        # Get and open the two data files
-
-        tablepath_h = _get_data_file_path("dark_matter/dmSpecTab.npy")
-        self._data_h = np.load(tablepath_h)
-
-        tablepath_f = _get_data_file_path("dark_matter/gammamc_dif.dat")
-        self._data_f = np.loadtxt(tablepath_f)
-
-        """
-            Mapping between the channel codes and the rows in the gammamc file
-            dmSpecTab.npy created to match this mapping too
-
-            1 : 8, # ee
-            2 : 6, # mumu
-            3 : 3, # tautau
-            4 : 1, # bb
-            5 : 2, # tt
-            6 : 7, # gg
-            7 : 4, # ww
-            8 : 5, # zz
-            9 : 0, # cc
-            10 : 10, # uu
-            11 : 11, # dd
-            12 : 9, # ss
-            """
-
-        channel_index_mapping = {
-            1: 8,  # ee
-            2: 6,  # mumu
-            3: 3,  # tautau
-            4: 1,  # bb
-            5: 2,  # tt
-            6: 7,  # gg
-            7: 4,  # ww
-            8: 5,  # zz
-            9: 0,  # cc
-            10: 10,  # uu
-            11: 11,  # dd
-            12: 9,  # ss
-        }
-
-        # Number of decades in x = log10(E/M)
-        ndec = 10.0
-        xedge = np.linspace(0, 1.0, 251)
-        self._x = 0.5 * (xedge[1:] + xedge[:-1]) * ndec - ndec
-
-        ichan = channel_index_mapping[int(self.channel.value)]
-
-        # These are the mass points in GeV
-        self._mass_h = np.array([50., 61.2, 74.91, 91.69, 112.22, 137.36, 168.12, 205.78, 251.87, 308.29,
-                                 377.34, 461.86, 565.31, 691.93, 846.91, 1036.6, 1268.78, 1552.97, 1900.82,
-                                 2326.57, 2847.69, 3485.53, 4266.23, 5221.81, 6391.41, 7823.0, 9575.23,
-                                 11719.94, 14345.03, 17558.1, 21490.85, 26304.48, 32196.3, 39407.79, 48234.54,
-                                 59038.36, 72262.07, 88447.7, 108258.66, 132506.99, 162186.57, 198513.95,
-                                 242978.11, 297401.58, 364015.09, 445549.04, 545345.37, 667494.6, 817003.43, 1000000.])
-
-        # These are the mass points in GeV
-        self._mass_f = np.array([2.0, 4.0, 6.0, 8.0, 10.0,
-                                 25.0, 50.0, 80.3, 91.2, 100.0,
-                                 150.0, 176.0, 200.0, 250.0, 350.0, 500.0, 750.0,
-                                 1000.0, 1500.0, 2000.0, 3000.0, 5000.0, 7000.0, 1E4])
-
-        self._mass = np.append(self._mass_f, self._mass_h[27:])
-
-        self._dn_f = self._data_f.reshape((12, 24, 250))
-
-        # Is this really used?
-        self._dn_h = self._data_h
+        # The tables and the interpolators are shared between all instances (see _get_dm_interpolator), so here we
+        # only make sure that they are ready and that the channel is valid
 
-        self._dn = np.zeros((12, len(self._mass), 250))
-        self._dn[:, 0:24, :] = self._dn_f
-        self._dn[:, 24:, :] = self._dn_h[:, 27:, :]
+        self._table_name = 'combined'
 
-        self._dn_interp = RegularGridInterpolator([self._mass, self._x],
-                                                  self._dn[ichan, :, :],
-                                                  bounds_error=False,
-                                                  fill_value=None)
+        self._get_interpolator().get_spectrum(self.channel.value, self.mass.value)
 
         if self.channel.value in [1, 6, 7] and self.mass.value > 10000.:
             print "ERROR: currently spectra for selected channel and mass not implemented."
@@ -336,7 +622,7 @@ class DMSpectra(Function1D):
         xm = np.log10(np.divide(xx, mass))
 
         phip = 1. / (8. * np.pi) * np.power(mass, -2) * (sigmav * J)  # units of this should be 1 / cm**2
-        dn = self._dn_interp((mass, xm))  # note this is unitless (dx = d(xm))
+        dn = self._get_interpolator()(channel, np.asarray(mass), np.asarray(xm))  # note this is unitless (dx = d(xm))
         dn[xm > 0] = 0
 
         return np.multiply(phip, np.divide(dn, x))
@@ -15,6 +15,7 @@ from astromodels.core.my_yaml import my_yaml
 from astromodels.core.parameter import Parameter
 from astromodels.core.tree import Node
 from astromodels.utils.pretty_list import dict_to_list
+from astromodels.utils.sky_grid import _get_input_type, get_sky_grid
 from astromodels.utils.table import dict_to_table
 from astromodels.core.memoization import memoize
 
@@ -84,6 +85,46 @@ NO_LATEX_FORMULA = '(no latex formula available)'
 
 _known_functions = {}
 
+# This dictionary contains functions which are known, but whose class has not been created yet because it is
+# expensive to create and it might never be used (for example, the XSPEC models). It maps the name of the function
+# to a callable which creates the class when called (the class is then added to _known_functions by the
+# FunctionMeta meta-class)
+
+_lazy_functions = {}
+
+
+def register_lazy_function(function_name, class_factory):
+    """
+    Register a function whose class will be created only when first needed (for example by get_function_class or
+    by get_function)
+
+    :param function_name: name of the function (i.e., the name of the class which will be created)
+    :param class_factory: a callable with no arguments which creates the class
+    :return: (none)
+    """
+
+    _lazy_functions[function_name] = class_factory
+
+
+def _create_lazy_function(function_name):
+    """
+    If the function has been registered for lazy creation and its class has not been created yet, create it now.
+
+    :param function_name: name of the function
+    :return: (none)
+    """
+
+    if function_name in _lazy_functions and function_name not in _known_functions:
+
+        _lazy_functions[function_name]()
+
+        # Now the class has been created and registered by the metaclass
+
+        assert function_name in _known_functions, "The class factory for %s did not create a function " \
+                                                  "with that name" % function_name
+
+        _lazy_functions.pop(function_name)
+
 
 # The following is a metaclass for all the functions
 class FunctionMeta(type):
@@ -742,6 +783,17 @@ class Function(Node):
 
         raise NotImplementedError("You have to implement this")
 
+    def get_bounding_cone(self):
+        """
+        Returns a cone containing all the points where this function is not negligible, computed from the current
+        values of the parameters (so it is usually tighter than the boundaries). By default there is no cone, but
+        subclasses can override this.
+
+        :return: a tuple (lon0, lat0, radius) in the current units, or None
+        """
+
+        return None
+
     def __call__(self, *args):  # pragma: no cover
 
         raise NotImplementedError("You have to implement this")
@@ -1001,7 +1053,7 @@ class Function2D(Function):
         # which is not an array into an array introduce a significant overload (10 microseconds or so), so we perform
         # this transformation only when strictly required
 
-        assert type(x) == type(y), "You have to use the same type for x and y"
+        assert _get_input_type(x) == _get_input_type(y), "You have to use the same type for x and y"
 
         if isinstance(x, np.ndarray):
 
@@ -1071,6 +1123,15 @@ class Function2D(Function):
 
 class Function3D(Function):
 
+    # Default memory budget (in bytes) for the evaluation of the function (see the memory_budget property)
+
+    _default_memory_budget = 256 * 1024 ** 2
+
+    # Approximate number of arrays with the same size as the output created by evaluate. Functions can override this
+    # to make the chunks of the evaluation larger or smaller
+
+    _n_temporary_arrays = 8
+
     def __init__(self, name=None, function_definition=None, parameters=None):
 
         Function.__init__(self, name, function_definition, parameters)
@@ -1080,6 +1141,26 @@ class Function3D(Function):
         self._z_unit = None
         self._w_unit = None
 
+        self._memory_budget = self._default_memory_budget
+
+    @property
+    def memory_budget(self):
+        """
+        Memory budget (in bytes) for the temporary arrays created when evaluating the function without units. If the
+        evaluation on all the points at once would exceed it, the points (x, y) are split in chunks which are
+        evaluated one at a time (on all the z values) and written into the output array. Use None to always evaluate
+        all the points at once.
+        """
+
+        return self._memory_budget
+
+    @memory_budget.setter
+    def memory_budget(self, value):
+
+        assert value is None or value > 0, "The memory budget must be positive (or None)"
+
+        self._memory_budget = value
+
     def evaluate(self, x, y, z, *args, **kwargs):  # pragma: no cover
 
         raise NotImplementedError("You have to re-implement this")
@@ -1149,7 +1230,8 @@ class Function3D(Function):
         # which is not an array into an array introduce a significant overload (10 microseconds or so), so we perform
         # this transformation only when strictly required
 
-        assert type(x) == type(y) and type(y) == type(z), "You have to use the same type for x, y and z"
+        assert _get_input_type(x) == _get_input_type(y) and _get_input_type(y) == _get_input_type(z), \
+            "You have to use the same type for x, y and z"
 
         if isinstance(x, np.ndarray):
 
@@ -1215,7 +1297,51 @@ class Function3D(Function):
 
         values = map(attrgetter("value"), self._get_children())
 
-        return self.evaluate(x, y, z, *values)
+        if self._memory_budget is None or x.ndim == 0:
+
+            return self.evaluate(x, y, z, *values)
+
+        # Number of points which can be evaluated at once within the memory budget
+
+        chunk_size = max(1, int(self._memory_budget // (8 * self._n_temporary_arrays * max(z.size, 1))))
+
+        n_points = x.shape[0]
+
+        if n_points <= chunk_size:
+
+            return self.evaluate(x, y, z, *values)
+
+        # Evaluate the chunks writing the results in the output array, which is allocated when the shape of the
+        # results is known (i.e., after the first chunk)
+
+        # If the points come from a SkyGrid, the chunks are sub-grids of it (a plain slice would lose the link to the
+        # grid, and with it the quantities cached in the grid)
+
+        sky_grid = get_sky_grid(x, y)
+
+        results = None
+
+        for start in range(0, n_points, chunk_size):
+
+            stop = min(start + chunk_size, n_points)
+
+            if sky_grid is not None:
+
+                chunk = sky_grid.get_subgrid(start, stop)
+
+                this_results = self.evaluate(chunk.lon, chunk.lat, z, *values)
+
+            else:
+
+                this_results = self.evaluate(x[start:stop], y[start:stop], z, *values)
+
+            if results is None:
+
+                results = np.empty((n_points,) + this_results.shape[1:], dtype=this_results.dtype)
+
+            results[start:stop] = this_results
+
+        return results
 
 
 ##########################
@@ -1504,18 +1630,50 @@ class CompositeFunction(Function):
 
             data['expression'] = self._expression
 
+            # The expression contains only the names of the functions. The functions which need more information to
+            # be created (like a TemplateModel loaded with some options, see TemplateModel.to_dict) are saved with
+            # their options, keyed by their name in the expression (like 'my_template{1}')
+
+            template_options = {}
+
+            for i, function in enumerate(self._functions):
+
+                if getattr(function, '_template_options', None) is not None:
+
+                    template_options["%s{%s}" % (function.name, i + 1)] = function._template_options
+
+            if len(template_options) > 0:
+
+                data['template_options'] = template_options
+
+            # Same for the functions in single precision (like DMSpectra, see ShapeParser)
+
+            single_precision = []
+
+            for i, function in enumerate(self._functions):
+
+                if getattr(function, '_single_precision', False):
+
+                    single_precision.append("%s{%s}" % (function.name, i + 1))
+
+            if len(single_precision) > 0:
+
+                data['single_precision'] = single_precision
+
         return data
 
 
 
 
-def get_function(function_name, composite_function_expression=None):
+def get_function(function_name, composite_function_expression=None, template_options=None):
     """
     Returns the function "name", which must be among the known functions or a composite function.
 
     :param function_name: the name of the function (use 'composite' if the function is a composite function)
     :param composite_function_expression: composite function specification such as
     ((((powerlaw{1} + (sin{2} * 3)) + (sin{2} * 25)) - (powerlaw{1} * 16)) + (sin{2} ** 3.0))
+    :param template_options: (optional) the options of the template models in the composite function expression,
+    as a dictionary like {'my_template{1}': options} (see CompositeFunction.to_dict)
     :return: the an instance of the requested class
 
     """
@@ -1525,10 +1683,12 @@ def get_function(function_name, composite_function_expression=None):
 
         # Composite function
 
-        return _parse_function_expression(composite_function_expression)
+        return _parse_function_expression(composite_function_expression, template_options)
 
     else:
 
+        _create_lazy_function(function_name)
+
         if function_name in _known_functions:
 
             return _known_functions[function_name]()
@@ -1563,6 +1723,8 @@ def get_function_class(function_name):
     :return: the type for that function (i.e., this is a class, not an instance)
     """
 
+    _create_lazy_function(function_name)
+
     if function_name in _known_functions:
 
         return _known_functions[function_name]
@@ -1591,7 +1753,7 @@ def list_functions():
     return table
 
 
-def _parse_function_expression(function_specification):
+def _parse_function_expression(function_specification, template_options=None):
     """
     Parse a complex function expression like:
 
@@ -1600,9 +1762,15 @@ def _parse_function_expression(function_specification):
     and return a composite function instance
 
     :param function_specification:
+    :param template_options: (optional) a dictionary like {'my_template{1}': options} with the options to be used to
+    load the template models in the expression (see TemplateModel.to_dict)
     :return: a composite function instance
     """
 
+    if template_options is None:
+
+        template_options = {}
+
     # NOTE FOR SECURITY
     # This function has some security concerns. Security issues could arise if the user tries to read a model
     # file which has been maliciously formatted to contain harmful code. In this function we close all the doors
@@ -1638,7 +1806,24 @@ def _parse_function_expression(function_specification):
         # As first safety measure, check that the unique function is in the dictionary of _known_functions.
         # This could still be easily hacked, so it won't be the only check
 
-        if unique_function in _known_functions:
+        _create_lazy_function(unique_function)
+
+        if complete_function_specification in template_options:
+
+            # This is a template loaded with some options
+
+            # This import is here to avoid circular dependency between this module and TemplateModel.py
+            import astromodels.functions.template_model
+
+            these_options = dict(template_options[complete_function_specification])
+
+            model_name = these_options.pop('model_name')
+
+            instances[complete_function_specification] = \
+                astromodels.functions.template_model.TemplateModel(model_name, other_name=unique_function,
+                                                                   **these_options)
+
+        elif unique_function in _known_functions:
 
             # Get the function class and check that it is indeed a proper Function class
 
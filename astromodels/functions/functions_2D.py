@@ -1,3 +1,6 @@
+import collections
+import hashlib
+
 import numpy as np
 from scipy.integrate import quad
 from astropy.coordinates import SkyCoord, ICRS, BaseCoordinateFrame
@@ -6,6 +9,15 @@ import astropy.units as u
 
 from astromodels.functions.function import Function2D, FunctionMeta
 from astromodels.utils.angular_distance import angular_distance
+from astromodels.utils.sky_grid import angular_distance_on_grid, cos_angular_distance_on_grid, get_sky_grid
+
+
+def _get_angular_distance_from_cosine(cos_angsep):
+
+    # Only one inverse trigonometric function per point. The precision (about 1e-6 deg close to 0) is more than
+    # enough for containment tests
+
+    return np.rad2deg(np.arccos(np.clip(cos_angsep, -1.0, 1.0)))
 
 
 class Latitude_galactic_diffuse(Function2D):
@@ -39,6 +51,11 @@ class Latitude_galactic_diffuse(Function2D):
 
         self._frame = ICRS()
 
+        # Cache of the galactic latitudes of the last input coordinates, so that the (slow) transformation is not
+        # repeated when the function is evaluated many times on the same points (for example during a fit)
+
+        self._galactic_latitude_cache = collections.OrderedDict()
+
     def set_frame(self, new_frame):
         """
         Set a new frame for the coordinates (the default is ICRS J2000)
@@ -55,12 +72,44 @@ class Latitude_galactic_diffuse(Function2D):
         self.K.unit = z_unit
         self.sigma_b.unit = x_unit
 
-    def evaluate(self, x, y, K, sigma_b):
+    def _get_galactic_latitude(self, x, y):
+
+        if isinstance(x, u.Quantity):
+
+            # Slow path with units, no caching
+
+            return SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg").transform_to('galactic').b.value
+
+        x = np.ascontiguousarray(x, dtype=float)
+        y = np.ascontiguousarray(y, dtype=float)
+
+        # The key is made of the frame and of a fingerprint of the input coordinates (which is much faster to compute
+        # than the transformation)
+
+        key = (repr(self._frame), x.shape, hashlib.md5(x).hexdigest(), hashlib.md5(y).hexdigest())
+
+        b = self._galactic_latitude_cache.get(key)
+
+        if b is None:
+
+            # We assume x and y are R.A. and Dec
+            _coord = SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg")
+
+            b = _coord.transform_to('galactic').b.value
+
+            self._galactic_latitude_cache[key] = b
+
+            if len(self._galactic_latitude_cache) > 10:
+
+                # Remove the oldest element
+
+                self._galactic_latitude_cache.popitem(False)
+
+        return b
 
-        # We assume x and y are R.A. and Dec
-        _coord = SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg")
+    def evaluate(self, x, y, K, sigma_b):
 
-        b = _coord.transform_to('galactic').b.value
+        b = self._get_galactic_latitude(x, y)
 
         return K * np.exp(-b ** 2 / (2 * sigma_b ** 2))
 
@@ -114,11 +163,17 @@ class Gaussian_on_sphere(Function2D):
 
         lon, lat = x,y
 
-        angsep = angular_distance(lon0, lat0, lon, lat)
+        angsep = angular_distance_on_grid(lon0, lat0, lon, lat)
 
         return np.power(180 / np.pi, 2) * 1. / (2 * np.pi * sigma ** 2) * np.exp(
             -0.5 * np.power(angsep, 2) / sigma ** 2)
 
+    def get_bounding_cone(self):
+
+        # Beyond 5 sigma the brightness is less than 4e-6 times the peak
+
+        return self.lon0.value, self.lat0.value, 5 * self.sigma.value
+
     def get_boundaries(self):
 
         # Truncate the gaussian at 2 times the max of sigma allowed
@@ -200,9 +255,16 @@ class Disk_on_sphere(Function2D):
 
         lon, lat = x,y
 
-        angsep = angular_distance(lon0, lat0, lon, lat)
+        # This is just a containment test, so there is no need to compute the angular distance:
+        # angsep <= radius is equivalent to cos(angsep) >= cos(radius)
+
+        cos_angsep = cos_angular_distance_on_grid(lon0, lat0, lon, lat)
+
+        return np.power(180 / np.pi, 2) * 1. / (np.pi * radius ** 2) * (cos_angsep >= np.cos(np.deg2rad(radius)))
 
-        return np.power(180 / np.pi, 2) * 1. / (np.pi * radius ** 2) * (angsep <= radius)
+    def get_bounding_cone(self):
+
+        return self.lon0.value, self.lat0.value, self.radius.value
 
     def get_boundaries(self):
 
@@ -308,18 +370,41 @@ class Ellipse_on_sphere(Function2D):
         # focus 1 coordinate and distance from focus 1 to point
         lon1 = lon0 - f*np.cos(theta)
         lat1 = lat0 - f*np.sin(theta)
-        angsep1 = angular_distance(lon1, lat1, lon, lat)
+        angsep1 = _get_angular_distance_from_cosine(cos_angular_distance_on_grid(lon1, lat1, lon, lat))
 
         # focus 2 coordinate and distance from focus 2 to point
         lon2 = lon0 + f*np.cos(theta)
         lat2 = lat0 + f*np.sin(theta)
-        angsep2 = angular_distance(lon2, lat2, lon, lat)
+        angsep2 = _get_angular_distance_from_cosine(cos_angular_distance_on_grid(lon2, lat2, lon, lat))
 
         # sum of distances to focii (should be <= 2a to be in ellipse)
         angsep = angsep1 + angsep2
         
         return np.power(180 / np.pi, 2) * 1. / (np.pi * a * b) * (angsep <= 2*a)
 
+    def get_bounding_cone(self):
+
+        lon0, lat0, a, b, theta = map(lambda parameter: parameter.value,
+                                      [self.lon0, self.lat0, self.a, self.b, self.theta])
+
+        # The same foci used in evaluate
+
+        f = np.sqrt(a**2 - b**2)
+
+        lon1 = lon0 - f * np.cos(theta)
+        lat1 = lat0 - f * np.sin(theta)
+
+        lon2 = lon0 + f * np.cos(theta)
+        lat2 = lat0 + f * np.sin(theta)
+
+        # For a point inside the ellipse the sum of the distances from the foci is at most 2a, so (triangle
+        # inequality) its distance from the center is at most a plus the average distance between the foci
+        # and the center
+
+        radius = a + (angular_distance(lon0, lat0, lon1, lat1) + angular_distance(lon0, lat0, lon2, lat2)) / 2.0
+
+        return lon0, lat0, radius
+
     def get_boundaries(self):
 
         # Truncate the ellipse at 2 times the max of semimajor axis allowed
@@ -383,9 +468,18 @@ class SpatialTemplate_2D(Function2D):
         
         self._frame = ICRS()
     
-    def load_file(self,fitsfile,ihdu=0):
-        
-        with fits.open(fitsfile) as f:
+    def load_file(self, fitsfile, ihdu=0, memmap=False):
+        """
+        Load the template from a FITS file
+
+        :param fitsfile: name of the FITS file
+        :param ihdu: index of the HDU containing the template (default: 0)
+        :param memmap: (optional) if True, the template is memory-mapped instead of being read in memory, so that
+        only the parts actually used are read from disk. Useful for very large (all-sky) templates. Default: False
+        :return: (none)
+        """
+
+        with fits.open(fitsfile, memmap=memmap) as f:
             self._refXpix = f[ihdu].header['CRPIX1']
             self._refYpix = f[ihdu].header['CRPIX2']
             self._delXpix = f[ihdu].header['CDELT1']
@@ -395,7 +489,21 @@ class SpatialTemplate_2D(Function2D):
             self._map = f[ihdu].data
             self._nX = f[ihdu].header['NAXIS1']
             self._nY = f[ihdu].header['NAXIS2']
-    
+
+        # Cache of the pixels corresponding to the last SkyGrid instances used as input (see _get_pixels)
+
+        self._pixels_cache = collections.OrderedDict()
+
+    def __reduce__(self):
+
+        unpickler, arguments, state = super(SpatialTemplate_2D, self).__reduce__()
+
+        # Do not copy the cache
+
+        state['__dict__'] = dict(state['__dict__'], _pixels_cache=collections.OrderedDict())
+
+        return unpickler, arguments, state
+
     def set_frame(self, new_frame):
         """
             Set a new frame for the coordinates (the default is ICRS J2000)
@@ -407,24 +515,72 @@ class SpatialTemplate_2D(Function2D):
         
         self._frame = new_frame
     
-    def evaluate(self, x, y, K):
-        
-        # We assume x and y are R.A. and Dec
-        _coord = SkyCoord(ra=x, dec=y, frame=self._frame, unit="deg")
-        
+    def _compute_pixels(self, x, y):
+
+        # Returns the flat indices (in the template) of the input points which are within the template, and the
+        # positions of those points in the input
+
         Xpix = np.add(np.divide(np.subtract(x,self._refX),self._delXpix),self._refXpix)
         Ypix = np.add(np.divide(np.subtract(y,self._refY),self._delYpix),self._refYpix)
-        
+
         Xpix = Xpix.astype(int)
         Ypix = Ypix.astype(int)
-        
+
         # find pixels that are in the template ROI, otherwise return zero
         iz = np.where((Xpix<self._nX) & (Xpix>=0) & (Ypix<self._nY) & (Ypix>=0))[0]
+
+        flat_indices = np.ravel_multi_index((Xpix[iz], Ypix[iz]), self._map.shape)
+
+        return flat_indices, iz
+
+    def _get_pixels(self, x, y):
+
+        sky_grid = get_sky_grid(x, y)
+
+        if sky_grid is None:
+
+            # Finding the pixels costs about as much as hashing the input to look them up in a cache, so they are
+            # computed every time
+
+            return self._compute_pixels(np.asarray(x), np.asarray(y))
+
+        # The pixels are cached for the whole grid (the points might be a sub-grid, see SkyGrid.get_subgrid), so
+        # that evaluating the function many times on the same grid (for example during a fit) only requires one
+        # gather from the template. This is a least recently used cache: a hit moves the element to the end, and the
+        # first element is removed when the cache is full
+
+        root = sky_grid.root
+
+        pixels = self._pixels_cache.pop(root.key, None)
+
+        if pixels is None:
+
+            pixels = self._compute_pixels(np.array(root.lon), np.array(root.lat))
+
+            if len(self._pixels_cache) >= 10:
+
+                self._pixels_cache.popitem(False)
+
+        self._pixels_cache[root.key] = pixels
+
+        flat_indices, iz = pixels
+
+        if root is not sky_grid:
+
+            selected = (iz >= sky_grid.offset) & (iz < sky_grid.offset + sky_grid.n_points)
+
+            flat_indices = flat_indices[selected]
+            iz = iz[selected] - sky_grid.offset
+
+        return flat_indices, iz
+
+    def evaluate(self, x, y, K):
+
+        flat_indices, iz = self._get_pixels(x, y)
+
         out = np.zeros((len(x)))
-        out[iz] = self._map[Xpix[iz].astype(int),Ypix[iz]]
-        
-        #pdb.set_trace()
-        
+        out[iz] = self._map.ravel()[flat_indices]
+
         return np.multiply(K,out)
 
     def get_boundaries(self):
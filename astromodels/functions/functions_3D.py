@@ -1,10 +1,14 @@
+import collections
+import hashlib
+
 import astropy.units as u
+from astropy.io import fits
 
 from astromodels.functions.function import Function3D, FunctionMeta
 
 import numpy as np
 
-from astromodels.utils.angular_distance import angular_distance
+from astromodels.utils.sky_grid import angular_distance_on_grid, get_sky_grid
 
 
 class Continuous_injection_diffusion(Function3D):
@@ -71,6 +75,10 @@ class Continuous_injection_diffusion(Function3D):
 
     __metaclass__ = FunctionMeta
 
+    # See Function3D
+
+    _n_temporary_arrays = 3
+
     def _set_units(self, x_unit, y_unit, z_unit, w_unit):
 
         # lon0 and lat0 and rdiff have most probably all units of degrees. However,
@@ -120,14 +128,35 @@ class Continuous_injection_diffusion(Function3D):
                                   (delta - 1.) / 2. * np.sqrt(1. + uratio * np.power(1. + 0.0107 * e_piv_piv2, -1.5)) /
                                   np.sqrt(1. + uratio * np.power(1. + 0.0107 * e_energy_piv2, -1.5)))) * rdiff0.unit
 
-        angsep = angular_distance(lon, lat, lon0, lat0)
+        angsep = angular_distance_on_grid(lon0, lat0, lon, lat)
 
         pi = np.pi
 
-        rdiffs, angseps = np.meshgrid(rdiff, angsep)
+        # Factors depending only on the energy, computed once instead of on the whole (points x energies) grid
+
+        normalization = np.power(180.0 / pi, 2) * 1.2154 / (pi * np.sqrt(pi) * rdiff)
+        offset = 0.06 * rdiff
+        inverse_rdiff2 = 1.0 / rdiff ** 2
+
+        if isinstance(rdiff, u.Quantity) or isinstance(angsep, u.Quantity):
+
+            # Slow version with units (angsep can also be a scalar here)
+
+            angsep = angsep.reshape(-1, 1)
+
+            return normalization / (angsep + offset) * np.exp(-np.power(angsep, 2) * inverse_rdiff2)
+
+        # Fast version, which only uses two arrays with the size of the output
+
+        result = np.add.outer(angsep, offset)
+        np.divide(normalization, result, out=result)
 
-        return np.power(180.0 / pi, 2) * 1.2154 / (pi * np.sqrt(pi) * rdiffs * (angseps + 0.06 * rdiffs)) * \
-               np.exp(-np.power(angseps, 2) / rdiffs ** 2)
+        exponential = np.multiply.outer(-np.power(angsep, 2), inverse_rdiff2)
+        np.exp(exponential, out=exponential)
+
+        result *= exponential
+
+        return result
 
 
     def get_boundaries(self):
@@ -160,3 +189,325 @@ class Continuous_injection_diffusion(Function3D):
                 max_longitude -= 360.
 
         return (min_longitude, max_longitude), (min_latitude, max_latitude)
+
+
+class SpatialTemplate_3D(Function3D):
+    r"""
+        description :
+
+            User input map cube (longitude x latitude x energy), like the templates for the Galactic diffuse emission.
+            Use load_file to load it. The cube is memory-mapped and only the energy planes bracketing the requested
+            energies are read. Between two planes the brightness is interpolated linearly in log(energy) and
+            log(brightness). The brightness is zero outside of the cube (in space or in energy).
+
+        latex : $ K~{\rm cube}(x, y, E) $
+
+        parameters :
+
+            K :
+
+                desc : normalization (the values in the cube are used as they are)
+                initial value : 1
+                fix : yes
+
+        """
+
+    __metaclass__ = FunctionMeta
+
+    def _setup(self):
+
+        self._fitsfile = None
+        self._data = None
+
+    def _set_units(self, x_unit, y_unit, z_unit, w_unit):
+
+        self.K.unit = w_unit
+
+    def load_file(self, fitsfile, ihdu=0, energy_hdu='ENERGIES', energy_unit='MeV', max_cached_planes=50):
+        """
+        Load the map cube from a FITS file. The cube must have 3 axes (longitude, latitude and energy, i.e., the data
+        has shape (n_energies, n_lat, n_lon)) with a linear (CAR) projection described by the CRPIX, CDELT and CRVAL
+        keywords. The energies of the planes are read from the first column of the energy_hdu extension if present
+        (like in the Fermi/LAT diffuse models), otherwise from the keywords of the third axis (if CTYPE3 starts with
+        'log' the axis contains log10(energy)).
+
+        :param fitsfile: name of the FITS file
+        :param ihdu: index of the HDU containing the cube (default: 0)
+        :param energy_hdu: name of the extension containing the energies of the planes (default: ENERGIES)
+        :param energy_unit: unit of the energies, used if the file does not specify it (default: MeV)
+        :param max_cached_planes: maximum number of (parts of) energy planes kept in memory (default: 50). The cache
+        is also limited to memory_budget bytes (see Function3D.memory_budget)
+        :return: (none)
+        """
+
+        with fits.open(fitsfile, memmap=True) as f:
+
+            header = f[ihdu].header
+
+            assert header['NAXIS'] == 3, "The map cube must have 3 axes (longitude, latitude and energy)"
+
+            self._refXpix = header['CRPIX1']
+            self._refYpix = header['CRPIX2']
+            self._delXpix = header['CDELT1']
+            self._delYpix = header['CDELT2']
+            self._refX = header['CRVAL1']
+            self._refY = header['CRVAL2']
+            self._nX = header['NAXIS1']
+            self._nY = header['NAXIS2']
+
+            n_energies = header['NAXIS3']
+
+            if energy_hdu in f:
+
+                column = f[energy_hdu].columns[0]
+
+                energies = np.array(f[energy_hdu].data.field(0), dtype=float)
+
+                if column.unit:
+
+                    energy_unit = column.unit
+
+            else:
+
+                energies = header['CRVAL3'] + (np.arange(n_energies) + 1 - header['CRPIX3']) * header['CDELT3']
+
+                if header.get('CTYPE3', '').lower().startswith('log'):
+
+                    energies = 10 ** energies
+
+                energy_unit = header.get('CUNIT3', energy_unit)
+
+        assert energies.shape[0] == n_energies, "The number of energies does not match the number of planes"
+
+        assert n_energies >= 2 and np.all(np.diff(energies) > 0), "Energies must be at least 2 and increasing"
+
+        self._log_energies = np.log(energies)
+        self._energy_unit = u.Unit(energy_unit)
+
+        # The cube is opened (memory-mapped) the first time it is needed
+
+        self._fitsfile = fitsfile
+        self._ihdu = ihdu
+        self._data = None
+
+        # Caches of the pixels corresponding to the last input coordinates, and of the values of the energy planes
+        # on those pixels
+
+        self._max_cached_planes = max_cached_planes
+        self._pixels_cache = collections.OrderedDict()
+        self._planes_cache = collections.OrderedDict()
+
+    def __reduce__(self):
+
+        unpickler, arguments, state = super(SpatialTemplate_3D, self).__reduce__()
+
+        # Do not copy the cube and the caches. The file will be opened again when needed
+
+        state['__dict__'] = dict(state['__dict__'], _data=None,
+                                 _pixels_cache=collections.OrderedDict(), _planes_cache=collections.OrderedDict())
+
+        return unpickler, arguments, state
+
+    def _get_data(self):
+
+        assert self._fitsfile is not None, "You have to load a map cube with load_file first"
+
+        if self._data is None:
+
+            with fits.open(self._fitsfile, memmap=True) as f:
+
+                self._data = f[self._ihdu].data
+
+        return self._data
+
+    @staticmethod
+    def _get_from_cache(cache, key, max_size, function):
+
+        # Least recently used cache: a hit moves the element to the end, and the first element is removed
+        # when the cache is full
+
+        value = cache.pop(key, None)
+
+        if value is None:
+
+            value = function()
+
+            if len(cache) >= max_size:
+
+                cache.popitem(False)
+
+        cache[key] = value
+
+        return value
+
+    def _compute_pixels(self, x, y):
+
+        # Measure the longitudes from the center of the map, so that maps crossing lon = 0 (or covering the whole
+        # sky) are handled correctly
+
+        lon_center = self._refX + ((self._nX + 1) / 2.0 - self._refXpix) * self._delXpix
+
+        delta_lon = np.mod(x - lon_center + 180.0, 360.0) - 180.0
+
+        # Pixel coordinates (FITS pixel n covers [n - 0.5, n + 0.5), starting from 1)
+
+        x_pix = np.floor((lon_center + delta_lon - self._refX) / self._delXpix + self._refXpix + 0.5).astype(int) - 1
+        y_pix = np.floor((y - self._refY) / self._delYpix + self._refYpix + 0.5).astype(int) - 1
+
+        iz = np.where((x_pix < self._nX) & (x_pix >= 0) & (y_pix < self._nY) & (y_pix >= 0))[0]
+
+        flat_indices = y_pix[iz] * self._nX + x_pix[iz]
+
+        return flat_indices, iz
+
+    def _read_plane(self, flat_indices, plane_index):
+
+        # Only the pixels actually needed are read from the (memory-mapped) cube
+
+        return np.array(self._get_data()[plane_index].ravel()[flat_indices], dtype=float)
+
+    def _get_plane(self, pixels_key, flat_indices, plane_index):
+
+        plane = self._get_from_cache(self._planes_cache, (pixels_key, plane_index), self._max_cached_planes,
+                                     lambda: self._read_plane(flat_indices, plane_index))
+
+        # Keep the cache within the memory budget (the plane just used is the last one, so it is never removed)
+
+        if self._memory_budget is not None:
+
+            while len(self._planes_cache) > 1 and \
+                    sum(map(lambda cached: cached.nbytes, self._planes_cache.values())) > self._memory_budget:
+
+                self._planes_cache.popitem(False)
+
+        return plane
+
+    def evaluate(self, x, y, z, K):
+
+        if isinstance(x, u.Quantity):
+
+            x = x.to(u.deg).value
+            y = y.to(u.deg).value
+            z = z.to(self._energy_unit).value
+
+        elif self.z_unit is not None:
+
+            z = z * self.z_unit.to(self._energy_unit)
+
+        sky_grid = get_sky_grid(x, y)
+
+        if sky_grid is not None:
+
+            n_points = sky_grid.n_points
+
+            # The points might be a chunk of a larger grid (see Function3D). The pixels and the planes are cached for
+            # the whole grid, so that all the chunks share them, and the points of this chunk are selected afterwards
+
+            root = sky_grid.root
+
+            pixels_key = root.key
+
+            flat_indices, iz = self._get_from_cache(self._pixels_cache, pixels_key, 10,
+                                                    lambda: self._compute_pixels(np.array(root.lon),
+                                                                                 np.array(root.lat)))
+
+            if root is not sky_grid:
+
+                selected = (iz >= sky_grid.offset) & (iz < sky_grid.offset + n_points)
+
+                iz = iz[selected] - sky_grid.offset
+
+            else:
+
+                selected = slice(None)
+
+        else:
+
+            x = np.ascontiguousarray(x, dtype=float)
+            y = np.ascontiguousarray(y, dtype=float)
+
+            n_points = x.shape[0]
+
+            pixels_key = (x.shape, hashlib.md5(x).hexdigest(), hashlib.md5(y).hexdigest())
+
+            flat_indices, iz = self._get_from_cache(self._pixels_cache, pixels_key, 10,
+                                                    lambda: self._compute_pixels(x, y))
+
+            selected = slice(None)
+
+        # Find the planes bracketing each energy, and the interpolation weights
+
+        log_energies = np.log(np.array(z, dtype=float, ndmin=1))
+
+        in_range = np.flatnonzero((log_energies >= self._log_energies[0]) &
+                                  (log_energies <= self._log_energies[-1]))
+
+        log_energies = log_energies[in_range]
+
+        lower = np.clip(np.searchsorted(self._log_energies, log_energies, 'right') - 1,
+                        0, self._log_energies.shape[0] - 2)
+
+        weights = (log_energies - self._log_energies[lower]) / \
+                  (self._log_energies[lower + 1] - self._log_energies[lower])
+
+        plane_indices = np.unique(np.concatenate([lower, lower + 1]))
+
+        if self._memory_budget is None or plane_indices.shape[0] * flat_indices.shape[0] * 8 <= self._memory_budget:
+
+            # The planes are cached for all the pixels of the input (or of the whole grid), so that they are shared
+            # by all the chunks of the evaluation
+
+            get_plane = lambda plane_index: self._get_plane(pixels_key, flat_indices, plane_index)[selected]
+
+        else:
+
+            # The planes needed on the whole input would not fit in the memory budget, so we read only the pixels
+            # of these points, without caching them
+
+            these_flat_indices = flat_indices[selected]
+
+            get_plane = lambda plane_index: self._read_plane(these_flat_indices, plane_index)
+
+        planes = dict(map(lambda plane_index: (plane_index, get_plane(plane_index)), plane_indices))
+
+        lower_values = np.array(map(lambda plane_index: planes[plane_index], lower), ndmin=2).T
+        upper_values = np.array(map(lambda plane_index: planes[plane_index], lower + 1), ndmin=2).T
+
+        # Power-law interpolation where both planes are positive, linear interpolation otherwise
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            values = np.where((lower_values > 0) & (upper_values > 0),
+                              lower_values * np.power(upper_values / lower_values, weights),
+                              lower_values + (upper_values - lower_values) * weights)
+
+        result = np.zeros((n_points, np.size(z)))
+
+        if values.size > 0:
+
+            result[np.ix_(iz, in_range)] = values
+
+        return K * result
+
+    def get_boundaries(self):
+
+        # Edges of the first and last pixels
+
+        lon_edges = self._refX + (np.array([0.5, self._nX + 0.5]) - self._refXpix) * self._delXpix
+        lat_edges = self._refY + (np.array([0.5, self._nY + 0.5]) - self._refYpix) * self._delYpix
+
+        min_lat = max(-90., lat_edges.min())
+        max_lat = min(90., lat_edges.max())
+
+        if self._nX * abs(self._delXpix) >= 360.:
+
+            min_lon = 0.
+            max_lon = 360.
+
+        else:
+
+            min_lon = np.mod(lon_edges.min(), 360.)
+            max_lon = np.mod(lon_edges.max(), 360.)
+
+        return (min_lon, max_lon), (min_lat, max_lat)
+
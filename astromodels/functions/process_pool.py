@@ -0,0 +1,274 @@
+import multiprocessing
+import multiprocessing.sharedctypes
+import traceback
+
+import numpy as np
+
+from astromodels.functions.function import get_function_class
+
+
+def _process_pool_worker(connection, input_buffer, output_buffer):
+    """
+    Main loop of a worker of the FunctionProcessPool. It keeps one instance for each class it has been asked to evaluate,
+    reads the energies from the shared input buffer and writes the results in its own shared output buffer.
+
+    :param connection: the worker end of the pipe used to receive commands
+    :param input_buffer: the shared buffer containing the energies (common to all workers)
+    :param output_buffer: the shared buffer where this worker writes its results
+    :return: (none)
+    """
+
+    input_array = np.frombuffer(input_buffer, dtype=float)
+    output_array = np.frombuffer(output_buffer, dtype=float)
+
+    instances = {}
+
+    while True:
+
+        message = connection.recv()
+
+        if message is None:
+
+            # Shutdown
+
+            break
+
+        class_name, mode, n_energies, parameters_values = message
+
+        try:
+
+            if class_name not in instances:
+
+                instances[class_name] = get_function_class(class_name)()
+
+            instance = instances[class_name]
+
+            x = input_array[:n_energies]
+
+            if mode == 'integral':
+
+                # x contains the edges of contiguous bins
+
+                result = instance._integral(x[:-1], x[1:], *parameters_values)
+
+            else:
+
+                result = instance.evaluate(x, *parameters_values)
+
+            result = np.array(result, ndmin=1, copy=False, dtype=float)
+
+            output_array[:result.shape[0]] = result
+
+        except Exception:
+
+            connection.send(('error', traceback.format_exc()))
+
+        else:
+
+            connection.send(('ok', result.shape[0]))
+
+
+class FunctionProcessPool(object):
+    """
+    A persistent pool of worker processes which evaluates known functions in parallel. This is useful for XSPEC models
+    (available also as astromodels.xspec.XspecProcessPool) and for other slow models based on C extensions. XSPEC
+    routines hold global state and cannot be run concurrently in threads, so each worker keeps its own instances of the
+    models. Only the class name and the current values of the parameters are sent to the workers for each evaluation,
+    while the energies and the results are exchanged through shared memory.
+
+    Use it as:
+
+        with FunctionProcessPool(4) as pool:
+
+            values1, values2 = pool.evaluate([XS_apec_instance, XS_mekal_instance], energies)
+
+    :param n_workers: number of worker processes (default: number of CPUs)
+    :param buffer_size: initial number of energies which can be exchanged with the workers. The buffers are
+    enlarged automatically if needed
+    """
+
+    def __init__(self, n_workers=None, buffer_size=10000):
+
+        if n_workers is None:
+
+            n_workers = multiprocessing.cpu_count()
+
+        assert n_workers >= 1, "You need at least one worker"
+
+        self._n_workers = int(n_workers)
+
+        self._buffer_size = int(buffer_size)
+
+        self._workers = []
+
+    @property
+    def n_workers(self):
+
+        return self._n_workers
+
+    def _start(self):
+
+        # The buffers must be created before the workers are started, so that they are inherited by them
+
+        self._input_buffer = multiprocessing.sharedctypes.RawArray('d', self._buffer_size)
+        self._input_array = np.frombuffer(self._input_buffer, dtype=float)
+
+        self._workers = []
+
+        for i in range(self._n_workers):
+
+            output_buffer = multiprocessing.sharedctypes.RawArray('d', self._buffer_size)
+
+            parent_connection, worker_connection = multiprocessing.Pipe()
+
+            process = multiprocessing.Process(target=_process_pool_worker,
+                                              args=(worker_connection, self._input_buffer, output_buffer))
+
+            # Make sure that the workers do not survive the main process
+
+            process.daemon = True
+
+            process.start()
+
+            self._workers.append((process, parent_connection, np.frombuffer(output_buffer, dtype=float)))
+
+    def close(self):
+        """
+        Stop all the workers
+
+        :return: (none)
+        """
+
+        for process, connection, _ in self._workers:
+
+            try:
+
+                connection.send(None)
+
+            except (IOError, OSError):  # pragma: no cover
+
+                pass
+
+            process.join()
+
+        self._workers = []
+
+    def _terminate(self):
+
+        for process, connection, _ in self._workers:
+
+            process.terminate()
+
+            process.join()
+
+            connection.close()
+
+        self._workers = []
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        self.close()
+
+    def _run(self, functions, x, mode):
+
+        x = np.array(x, ndmin=1, copy=False, dtype=float)
+
+        n_energies = x.shape[0]
+
+        if n_energies > self._buffer_size:
+
+            # The buffers are too small. Restart the workers with larger ones
+
+            self.close()
+
+            self._buffer_size = n_energies
+
+        if not self._workers:
+
+            self._start()
+
+        # No worker is running at this point, so we can safely overwrite the input buffer
+
+        self._input_array[:n_energies] = x
+
+        results = []
+
+        # Dispatch the functions to the workers, one per worker at the time
+
+        for start in range(0, len(functions), self._n_workers):
+
+            batch = functions[start:start + self._n_workers]
+
+            for function, (_, connection, _) in zip(batch, self._workers):
+
+                parameters_values = tuple(parameter.value for parameter in function.parameters.values())
+
+                connection.send((function.__class__.__name__, mode, n_energies, parameters_values))
+
+            # Collect the replies of all the workers of the batch before reporting any error, otherwise the replies
+            # left in the pipes would be read as the results of the next evaluation
+
+            errors = []
+
+            restart = False
+
+            for function, (_, connection, output_array) in zip(batch, self._workers):
+
+                try:
+
+                    status, payload = connection.recv()
+
+                except (EOFError, IOError, OSError):
+
+                    # The worker died (for example because of a crash in a C extension)
+
+                    status, payload = 'error', 'The worker process died'
+
+                    restart = True
+
+                if status != 'ok':
+
+                    errors.append("Evaluation of %s in the process pool failed:\n%s" % (function.name, payload))
+
+                else:
+
+                    results.append(np.array(output_array[:payload]))
+
+            if errors:
+
+                if restart:
+
+                    # The workers will be started again at the next evaluation
+
+                    self._terminate()
+
+                raise RuntimeError(errors[0])
+
+        return results
+
+    def evaluate(self, functions, x):
+        """
+        Evaluate the provided functions at the energies x in parallel
+
+        :param functions: a list of instances of XSPEC models (or of other known functions)
+        :param x: energies in keV
+        :return: a list with the result for each function
+        """
+
+        return self._run(functions, x, 'evaluate')
+
+    def integral(self, functions, edges):
+        """
+        Compute in parallel the integral of the provided XSPEC models over contiguous bins (see the integral method
+        of the XSPEC models)
+
+        :param functions: a list of instances of XSPEC models
+        :param edges: edges of the bins in keV (n + 1 values for n bins)
+        :return: a list with the result for each function
+        """
+
+        return self._run(functions, edges, 'integral')
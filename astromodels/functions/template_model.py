@@ -1,11 +1,17 @@
 import collections
+import hashlib
+import itertools
+import multiprocessing
+import shutil
+import uuid
+import weakref
 
 import astropy.units as u
 import numpy as np
 import os
-import pandas as pd
 import re
 import scipy.interpolate
+import scipy.sparse
 import warnings
 from pandas import HDFStore
 
@@ -19,7 +25,8 @@ from astromodels.core.my_yaml import my_yaml
 _TINY_ = 1e-50
 
 
-__all__ = ["IncompleteGrid", "ValuesNotInGrid", "MissingDataFile", "TemplateModelFactory", "TemplateModel"]
+__all__ = ["IncompleteGrid", "ValuesNotInGrid", "MissingDataFile", "TemplateModelFactory", "TemplateModel",
+           "convert_legacy_template"]
 
 
 class IncompleteGrid(RuntimeError):
@@ -38,10 +45,209 @@ class MissingDataFile(RuntimeError):
 _classes_cache = {}
 
 
+# Version of the on-disk layout of the templates (see _write_template)
+_TEMPLATE_FORMAT_VERSION = 1
+
+
+def _get_template_paths(model_name):
+    """
+    Returns the paths for the template with the provided name
+
+    :param model_name: name of the template
+    :return: a tuple (template directory, path of the template in the legacy format)
+    """
+
+    data_dir_path = get_user_data_path()
+
+    template_dir = os.path.abspath(os.path.join(data_dir_path, '%s.template' % model_name))
+
+    legacy_file = os.path.abspath(os.path.join(data_dir_path, '%s.h5' % model_name))
+
+    return template_dir, legacy_file
+
+
+def _write_template(template_dir, metadata, parameters_grids, energies, log_data):
+    """
+    Write a template with the following layout:
+
+        [name].template/
+            metadata.yml : name, description, interpolation settings, names of the parameters and format version
+            energies.npy : the tabulated energies (keV)
+            grid_[i].npy : the grid of the i-th parameter
+            log_data.npy : log10 of the differential fluxes, as one contiguous array with one axis for each parameter
+                           (in the same order as in metadata.yml) and the energy as the last axis. It can be
+                           memory-mapped, so that only the needed pages are loaded
+
+    The template is first written in a temporary directory which is then moved in place, so that an incomplete
+    template can never be found in the data directory.
+
+    :param template_dir: the directory of the template (must not exist)
+    :param metadata: a dictionary with the keys name, description, interpolation_degree and spline_smoothing_factor
+    :param parameters_grids: an ordered dictionary with the grid for each parameter
+    :param energies: the energies of the template
+    :param log_data: array with the log10 of the differential fluxes
+    :return: (none)
+    """
+
+    temp_dir = "%s.%s" % (template_dir, uuid.uuid4().hex)
+
+    os.makedirs(temp_dir)
+
+    try:
+
+        _write_template_header(temp_dir, metadata, parameters_grids, energies)
+
+        np.save(os.path.join(temp_dir, 'log_data.npy'), log_data)
+
+        os.rename(temp_dir, template_dir)
+
+    except:
+
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+        raise
+
+
+def _write_template_header(template_dir, metadata, parameters_grids, energies):
+
+    this_metadata = collections.OrderedDict()
+
+    this_metadata['format_version'] = _TEMPLATE_FORMAT_VERSION
+    this_metadata['name'] = str(metadata['name'])
+    this_metadata['description'] = str(metadata['description'])
+    this_metadata['interpolation_degree'] = int(metadata['interpolation_degree'])
+    this_metadata['spline_smoothing_factor'] = int(metadata['spline_smoothing_factor'])
+    this_metadata['parameters'] = map(str, parameters_grids.keys())
+
+    with open(os.path.join(template_dir, 'metadata.yml'), 'w+') as f:
+
+        my_yaml.dump(this_metadata, f, default_flow_style=False)
+
+    np.save(os.path.join(template_dir, 'energies.npy'), np.array(energies, dtype=float))
+
+    for i, parameter_name in enumerate(parameters_grids.keys()):
+
+        np.save(os.path.join(template_dir, 'grid_%i.npy' % i), np.array(parameters_grids[parameter_name], dtype=float))
+
+
+def _read_template(template_dir):
+    """
+    Read a template written by _write_template. The data are memory-mapped, so they are not read from disk until
+    needed.
+
+    :param template_dir: the directory of the template
+    :return: a tuple (metadata, grids, energies, log_data)
+    """
+
+    with open(os.path.join(template_dir, 'metadata.yml')) as f:
+
+        metadata = my_yaml.load(f)
+
+    if metadata['format_version'] > _TEMPLATE_FORMAT_VERSION:  # pragma: no cover
+
+        raise IOError("The template in %s has been written with a newer version of astromodels" % template_dir)
+
+    parameters_grids = collections.OrderedDict()
+
+    for i, parameter_name in enumerate(metadata['parameters']):
+
+        parameters_grids[parameter_name] = np.load(os.path.join(template_dir, 'grid_%i.npy' % i))
+
+    energies = np.load(os.path.join(template_dir, 'energies.npy'))
+
+    log_data = np.load(os.path.join(template_dir, 'log_data.npy'), mmap_mode='r')
+
+    return metadata, parameters_grids, energies, log_data
+
+
+def _read_legacy_template(filename):
+    """
+    Read a template saved in the legacy format (a pandas data frame in a HDF5 file)
+
+    :param filename: the .h5 file
+    :return: a tuple (metadata, grids, energies, log_data) like _read_template
+    """
+
+    with HDFStore(filename) as store:
+
+        data_frame = store['data_frame']
+
+        parameters_grids = collections.OrderedDict()
+
+        processed_parameters = 0
+
+        for key in store.keys():
+
+            match = re.search('p_([0-9]+)_(.+)', key)
+
+            if match is None:
+
+                continue
+
+            else:
+
+                tokens = match.groups()
+
+                this_parameter_number = int(tokens[0])
+                this_parameter_name = str(tokens[1])
+
+                assert this_parameter_number == processed_parameters, "Parameters out of order!"
+
+                parameters_grids[this_parameter_name] = np.array(store[key].values, dtype=float)
+
+                processed_parameters += 1
+
+        energies = np.array(store['energies'].values, dtype=float)
+
+        # Now get the metadata
+
+        metadata = store.get_storer('data_frame').attrs.metadata
+
+    data_shape = map(lambda x: x.shape[0], parameters_grids.values())
+
+    log_data = np.log10(np.array(data_frame[list(energies)].values, dtype=float)).reshape(data_shape +
+                                                                                         [energies.shape[0]])
+
+    return metadata, parameters_grids, energies, log_data
+
+
+def convert_legacy_template(model_name, overwrite=False):
+    """
+    Convert a template saved with a previous version of astromodels (a .h5 file in the data directory) to the
+    current layout. The old file is not touched.
+
+    :param model_name: the name of the template
+    :param overwrite: whether to overwrite the template in the new format, if it exists already
+    :return: the path to the converted template
+    """
+
+    template_dir, legacy_file = _get_template_paths(model_name)
+
+    if not os.path.exists(legacy_file):
+
+        raise MissingDataFile("The data file %s does not exists." % legacy_file)
+
+    if os.path.exists(template_dir):
+
+        if overwrite:
+
+            shutil.rmtree(template_dir)
+
+        else:
+
+            raise IOError("The template %s exists already in the new format" % template_dir)
+
+    metadata, parameters_grids, energies, log_data = _read_legacy_template(legacy_file)
+
+    _write_template(template_dir, metadata, parameters_grids, energies, log_data)
+
+    return template_dir
+
+
 class TemplateModelFactory(object):
 
     def __init__(self, name, description, energies, names_of_parameters,
-                 interpolation_degree=1, spline_smoothing_factor=0):
+                 interpolation_degree=1, spline_smoothing_factor=0, streaming=False, single_precision=False):
 
         # Store model name
 
@@ -79,9 +285,24 @@ class TemplateModelFactory(object):
 
             self._parameters_grids[parameter_name] = None
 
-        self._data_frame = None
-        self._multi_index = None
-        self._interpolators = None
+        # This will contain the log10 of the differential fluxes, with one axis for each parameter and the energy as
+        # the last axis, and the map of the grid points which have been filled. They are allocated when the first
+        # data set is added.
+        # In streaming mode they are arrays on disk (in the work directory) instead of in memory, so the grid does not
+        # need to fit in memory and an interrupted construction can be resumed by creating a new factory with the
+        # same name, energies and grids
+
+        self._log_data = None
+        self._completed = None
+
+        self._streaming = bool(streaming)
+
+        # In single precision the data are stored (and then interpolated) as float32 instead of float64, which halves
+        # the memory and the disk space needed (see TemplateModel for the accuracy)
+
+        self._dtype = np.float32 if single_precision else np.float64
+
+        self._work_directory = "%s.partial" % _get_template_paths(self._name)[0]
 
         self._interpolation_degree = interpolation_degree
 
@@ -91,6 +312,8 @@ class TemplateModelFactory(object):
 
         assert parameter_name in self._parameters_grids, "Parameter %s is not part of this model" % parameter_name
 
+        assert self._log_data is None, "You cannot change the grids after adding data"
+
         grid_ = np.array(grid)
 
         assert grid_.shape[0] > 1, "A grid for a parameter must contain at least two elements"
@@ -101,7 +324,7 @@ class TemplateModelFactory(object):
 
         self._parameters_grids[parameter_name] = grid_
 
-    def add_interpolation_data(self, differential_fluxes, **parameters_values_input):
+    def _get_log_data(self):
 
         # Verify that the grid has been defined for all parameters
 
@@ -112,18 +335,147 @@ class TemplateModelFactory(object):
                 raise IncompleteGrid("You need to define a grid for all parameters, by using the "
                                      "define_parameter_grid method.")
 
-        if self._data_frame is None:
+        if self._log_data is None:
+
+            data_shape = map(lambda x: x.shape[0], self._parameters_grids.values())
+
+            if self._streaming:
+
+                self._open_work_directory(data_shape)
+
+            else:
+
+                # This is the first data set. Pre-fill the data matrix with nans, so we will know if some elements
+                # have not been filled
+
+                self._log_data = np.full(data_shape + [self._energies.shape[0]], np.nan, dtype=self._dtype)
+
+                self._completed = np.zeros(data_shape, dtype=bool)
+
+        return self._log_data
+
+    def _get_metadata(self):
+
+        return {'description': self._description,
+                'name': self._name,
+                'interpolation_degree': int(self._interpolation_degree),
+                'spline_smoothing_factor': self._spline_smoothing_factor}
+
+    def _open_work_directory(self, data_shape):
+
+        # The work directory has the same layout as a template (see _write_template), plus the map of the grid
+        # points already filled
+
+        log_data_file = os.path.join(self._work_directory, 'log_data.npy')
+        completed_file = os.path.join(self._work_directory, 'completed.npy')
+
+        if os.path.exists(self._work_directory):
+
+            # Resume a previous construction, after making sure that it is for the same template
+
+            metadata, parameters_grids, energies, _ = _read_template(self._work_directory)
+
+            same_template = (metadata['parameters'] == self._parameters_grids.keys() and
+                             metadata['interpolation_degree'] == self._interpolation_degree and
+                             metadata['spline_smoothing_factor'] == self._spline_smoothing_factor and
+                             np.array_equal(energies, self._energies) and
+                             all(map(lambda (grid1, grid2): np.array_equal(grid1, grid2),
+                                     zip(parameters_grids.values(), self._parameters_grids.values()))))
 
-            # This is the first data set, create the data frame
+            if not same_template:
 
-            # Create the multi-index
+                raise IOError("The directory %s contains a partial template with different energies or grids. "
+                              "Remove it if you want to start a new template." % self._work_directory)
 
-            self._multi_index = pd.MultiIndex.from_product(self._parameters_grids.values(),
-                                                           names=self._parameters_grids.keys())
+            self._log_data = np.load(log_data_file, mmap_mode='r+')
+            self._completed = np.load(completed_file, mmap_mode='r+')
 
-            # Pre-fill the data matrix with nans, so we will know if some elements have not been filled
+            if self._log_data.dtype != self._dtype:
 
-            self._data_frame = pd.DataFrame(index=self._multi_index, columns=self._energies)
+                raise IOError("The directory %s contains a partial template with a different precision. "
+                              "Remove it if you want to start a new template." % self._work_directory)
+
+        else:
+
+            temp_dir = "%s.%s" % (self._work_directory, uuid.uuid4().hex)
+
+            os.makedirs(temp_dir)
+
+            _write_template_header(temp_dir, self._get_metadata(), self._parameters_grids, self._energies)
+
+            # The files are created sparse, so no disk space is used for the points not computed yet
+
+            np.lib.format.open_memmap(os.path.join(temp_dir, 'log_data.npy'), mode='w+', dtype=self._dtype,
+                                      shape=tuple(data_shape + [self._energies.shape[0]])).flush()
+
+            np.lib.format.open_memmap(os.path.join(temp_dir, 'completed.npy'), mode='w+', dtype=bool,
+                                      shape=tuple(data_shape)).flush()
+
+            os.rename(temp_dir, self._work_directory)
+
+            self._open_work_directory(data_shape)
+
+    def _flush(self):
+
+        # Make sure that what has been computed so far is on disk (data first, so that a point is never marked as
+        # completed before its data have been written)
+
+        if self._streaming and self._log_data is not None:
+
+            self._log_data.flush()
+            self._completed.flush()
+
+    def get_missing_points(self):
+        """
+        Returns the values of the parameters for the grid points which have not been filled yet
+
+        :return: a (n_missing_points, n_parameters) array
+        """
+
+        self._get_log_data()
+
+        missing = np.argwhere(~self._completed)
+
+        return np.array(map(lambda grid, indices: grid[indices],
+                            self._parameters_grids.values(), missing.T), dtype=float).T
+
+    def is_complete(self):
+        """
+        Returns whether all the points of the grid have been filled (this only reads the map of the filled points,
+        not the data)
+
+        :return: True or False
+        """
+
+        if any(map(lambda grid: grid is None, self._parameters_grids.values())):
+
+            return False
+
+        self._get_log_data()
+
+        return bool(np.all(self._completed))
+
+    def _get_grid_indices(self, parameters_values):
+
+        # Returns the position in the grid of each row of parameters_values (one column per parameter)
+
+        indices = []
+
+        for i, grid in enumerate(self._parameters_grids.values()):
+
+            idx = np.clip(np.searchsorted(grid, parameters_values[:, i]), 0, grid.shape[0] - 1)
+
+            if not np.all(grid[idx] == parameters_values[:, i]):
+
+                not_in_grid = parameters_values[grid[idx] != parameters_values[:, i]][0]
+
+                raise ValuesNotInGrid("The provided parameter values (%s) are not in the defined grid" % not_in_grid)
+
+            indices.append(idx)
+
+        return tuple(indices)
+
+    def add_interpolation_data(self, differential_fluxes, **parameters_values_input):
 
         # Make sure we have all parameters and order the values in the same way as the dictionary
         parameters_values = np.zeros(len(self._parameters_grids)) * np.nan
@@ -140,6 +492,34 @@ class TemplateModelFactory(object):
 
         assert np.all(np.isfinite(parameters_values)), "You didn't specify all parameters' values."
 
+        if isinstance(differential_fluxes, u.Quantity):
+
+            differential_fluxes = differential_fluxes.reshape((1, -1))
+
+        else:
+
+            differential_fluxes = np.array(differential_fluxes, ndmin=2)
+
+        self.add_interpolation_data_bulk(parameters_values.reshape((1, -1)), differential_fluxes)
+
+    def add_interpolation_data_bulk(self, parameters_values, differential_fluxes):
+        """
+        Add many data sets at once.
+
+        :param parameters_values: a (n_points, n_parameters) array with the values of the parameters for each data set,
+        in the same order as the names_of_parameters provided to the constructor
+        :param differential_fluxes: a (n_points, n_energies) array with the differential fluxes for each data set
+        (in keV^-1 cm^-2 s^-1 if not a Quantity)
+        :return: none
+        """
+
+        log_data = self._get_log_data()
+
+        parameters_values = np.array(parameters_values, dtype=float, ndmin=2)
+
+        assert parameters_values.shape[1] == len(self._parameters_grids), "You need to provide a value for each " \
+                                                                          "parameter"
+
         # Make sure we are dealing with pure numpy arrays (list and astropy.Quantity instances will be transformed)
         # First we transform the input into a u.Quantity (if it's not already)
 
@@ -149,12 +529,13 @@ class TemplateModelFactory(object):
 
         # Then we transform it in the right units and we cast it back to a pure np.array
 
-        differential_fluxes = np.array(differential_fluxes.to(1 / (u.keV * u.s * u.cm ** 2)).value)
+        differential_fluxes = np.array(differential_fluxes.to(1 / (u.keV * u.s * u.cm ** 2)).value, dtype=float,
+                                       ndmin=2)
 
         # Now let's check for valid inputs
 
-        assert self._energies.shape[0] == differential_fluxes.shape[0], "Differential fluxes and energies must have " \
-                                                                        "the same number of elements"
+        assert differential_fluxes.shape == (parameters_values.shape[0], self._energies.shape[0]), \
+            "Differential fluxes must have one row for each set of parameters' values, and one column for each energy"
 
         # Check that the provided value does not contains nan, inf nor zero (as the interpolation happens in the
         # log space)
@@ -170,84 +551,219 @@ class TemplateModelFactory(object):
             idx = (differential_fluxes == 0)  # type: np.ndarray
             differential_fluxes[idx] = _TINY_
 
-        # Now set the corresponding values in the data frame
+        # Now scatter the values in the data matrix, and mark the points as filled
+
+        grid_indices = self._get_grid_indices(parameters_values)
+
+        log_data[grid_indices] = np.log10(differential_fluxes)
+
+        self._completed[grid_indices] = True
 
-        # Now set the values in the data frame
+    def fill_grid(self, flux_generator, n_workers=1, checkpoint_file=None, checkpoint_interval=100):
+        """
+        Fill all the missing points of the grid by calling flux_generator(energies, **parameters_values), where
+        energies are in keV and the returned differential fluxes are in keV^-1 cm^-2 s^-1 (if not a Quantity).
+
+        :param flux_generator: the function computing the differential fluxes. If n_workers > 1 this must be pickleable
+        (for example, a function defined at the top level of a module)
+        :param n_workers: number of processes to use (default: 1, i.e., compute everything in this process)
+        :param checkpoint_file: (optional) a .npy file where the partial results are written every
+        checkpoint_interval points (the map of the points already computed is kept in a second file, with
+        '.completed.npy' appended to the name). Only the new points are written each time. If the file exists, the
+        points already computed are read from it and not computed again. This is not needed in streaming mode, where
+        the results are always written to the work directory
+        :param checkpoint_interval: number of points computed between two checkpoints
+        :return: none
+        """
+
+        log_data = self._get_log_data()
+
+        assert checkpoint_file is None or not self._streaming, "You do not need a checkpoint file in streaming mode"
+
+        if checkpoint_file is not None:
+
+            checkpoint_data, checkpoint_completed = self._open_checkpoint(checkpoint_file)
+
+            # Keep what we already have, and add what is in the checkpoint
+
+            idx = ~self._completed & checkpoint_completed
+
+            log_data[idx] = checkpoint_data[idx]
+
+            self._completed[idx] = True
+
+            # Then add to the checkpoint what we had and it did not have
+
+            idx = self._completed & ~checkpoint_completed
+
+            _write_checkpoint(checkpoint_data, checkpoint_completed, idx, log_data[idx])
+
+        # Find the points which still need to be computed
+
+        parameters_values = self.get_missing_points()
+
+        tasks = map(lambda values: (flux_generator, self._energies, self._parameters_grids.keys(), values),
+                    parameters_values)
+
+        if n_workers > 1:
+
+            pool = multiprocessing.Pool(n_workers)
+
+            results = pool.imap(_evaluate_grid_point, tasks, chunksize=max(1, checkpoint_interval // (4 * n_workers)))
+
+        else:
+
+            pool = None
+
+            results = itertools.imap(_evaluate_grid_point, tasks)
 
         try:
 
-            self._data_frame.loc[tuple(parameters_values)] = pd.to_numeric(differential_fluxes)
+            for start in range(0, len(tasks), checkpoint_interval):
+
+                stop = min(start + checkpoint_interval, len(tasks))
+
+                fluxes = map(lambda _: next(results), range(start, stop))
+
+                self.add_interpolation_data_bulk(parameters_values[start:stop], u.Quantity(fluxes))
+
+                if checkpoint_file is not None:
+
+                    # Write only the points just computed
 
-        except KeyError:
+                    grid_indices = self._get_grid_indices(parameters_values[start:stop])
 
-            raise ValuesNotInGrid("The provided parameter values (%s) are not in the defined grid" % parameters_values)
+                    _write_checkpoint(checkpoint_data, checkpoint_completed, grid_indices, log_data[grid_indices])
 
-    @staticmethod
-    def _clean_cols_for_hdf(data):
+                self._flush()
 
-        types = data.apply(lambda x: pd.lib.infer_dtype(x.values))
+        finally:
 
-        for col in types.index:
+            if pool is not None:
 
-            data[col] = pd.to_numeric(data[col])
+                pool.terminate()
 
-        return data
+                pool.join()
+
+    def _open_checkpoint(self, checkpoint_file):
+
+        # Returns the data and the map of the completed points stored in the checkpoint, as arrays on disk. They are
+        # created if they do not exist, with the same layout as the work directory in streaming mode
+
+        checkpoint_file = os.path.abspath(os.path.expandvars(os.path.expanduser(checkpoint_file)))
+
+        completed_file = "%s.completed.npy" % os.path.splitext(checkpoint_file)[0]
+
+        data_shape = self._log_data.shape
+
+        if not os.path.exists(checkpoint_file):
+
+            # The map is put in place first, so that the data file exists only if the map exists as well. The files
+            # are created sparse, so no disk space is used for the points not computed yet
+
+            for filename, dtype, shape in [(completed_file, bool, data_shape[:-1]),
+                                           (checkpoint_file, self._dtype, data_shape)]:
+
+                temp_file = "%s.%s.tmp.npy" % (filename, uuid.uuid4().hex)
+
+                np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype, shape=shape).flush()
+
+                os.rename(temp_file, filename)
+
+        checkpoint_data = np.load(checkpoint_file, mmap_mode='r+')
+        checkpoint_completed = np.load(completed_file, mmap_mode='r+')
+
+        if checkpoint_data.shape != data_shape or checkpoint_completed.shape != data_shape[:-1]:
+
+            raise IOError("The checkpoint file %s does not match this grid" % checkpoint_file)
+
+        return checkpoint_data, checkpoint_completed
 
     def save_data(self, overwrite=False):
 
         # First make sure that the whole data matrix has been filled
 
-        assert not self._data_frame.isnull().values.any(), "You have NaNs in the data matrix. Usually this means " \
-                                                           "that you didn't fill it up completely, or that some of " \
-                                                           "your data contains nans. Cannot save the file."
+        assert self.is_complete(), "You have NaNs in the data matrix. Usually this means that you didn't fill it up " \
+                                   "completely, or that some of your data contains nans. Cannot save the file."
 
-        # Get the data directory
+        template_dir, legacy_file = _get_template_paths(self._name)
 
-        data_dir_path = get_user_data_path()
+        # Check that it does not exists
 
-        # Sanitize the data file
+        for filename_sanitized in [template_dir, legacy_file]:
 
-        filename_sanitized = os.path.abspath(os.path.join(data_dir_path, '%s.h5' % self._name))
+            if os.path.exists(filename_sanitized):
 
-        # Check that it does not exists
-        if os.path.exists(filename_sanitized):
+                if overwrite:
 
-            if overwrite:
+                    try:
 
-                try:
+                        if os.path.isdir(filename_sanitized):
 
-                    os.remove(filename_sanitized)
+                            shutil.rmtree(filename_sanitized)
 
-                except:
+                        else:
 
-                    raise IOError("The file %s already exists and cannot be removed (maybe you do not have "
-                                  "permissions to do so?). " % filename_sanitized)
+                            os.remove(filename_sanitized)
 
-            else:
+                    except:
+
+                        raise IOError("The file %s already exists and cannot be removed (maybe you do not have "
+                                      "permissions to do so?). " % filename_sanitized)
+
+                else:
+
+                    raise IOError("The file %s already exists! You cannot call two different "
+                                  "template models with the same name" % filename_sanitized)
 
-                raise IOError("The file %s already exists! You cannot call two different "
-                              "template models with the same name" % filename_sanitized)
+        # Write the template
 
-        # Open the HDF5 file and write objects
+        if self._streaming:
+
+            # The work directory is already a template, we only need to move it in place
+
+            self._flush()
+
+            os.remove(os.path.join(self._work_directory, 'completed.npy'))
+
+            os.rename(self._work_directory, template_dir)
+
+            self._log_data = None
+            self._completed = None
+
+        else:
 
-        with HDFStore(filename_sanitized) as store:
+            _write_template(template_dir, self._get_metadata(), self._parameters_grids, self._energies,
+                            self._log_data)
 
-            # The _clean_cols_for_hdf is needed because for some reasons the format of some columns
-            # is not accepted by .to_hdf otherwise
 
-            self._clean_cols_for_hdf(self._data_frame).to_hdf(store, 'data_frame')
+def _evaluate_grid_point(args):
 
-            store.get_storer('data_frame').attrs.metadata = {'description': self._description,
-                                                             'name': self._name,
-                                                             'interpolation_degree': int(self._interpolation_degree),
-                                                             'spline_smoothing_factor': self._spline_smoothing_factor
-                                                             }
+    # Compute the fluxes for one point of the grid (this is used by TemplateModelFactory.fill_grid, possibly in
+    # another process)
 
-            for i, parameter_name in enumerate(self._parameters_grids.keys()):
+    flux_generator, energies, names_of_parameters, parameters_values = args
 
-                store['p_%i_%s' % (i, parameter_name)] = pd.Series(self._parameters_grids[parameter_name])
+    fluxes = flux_generator(energies, **dict(zip(names_of_parameters, parameters_values)))
+
+    if not isinstance(fluxes, u.Quantity):
+
+        fluxes = np.array(fluxes) * 1 / (u.keV * u.s * u.cm ** 2)
+
+    return fluxes.to(1 / (u.keV * u.s * u.cm ** 2))
+
+
+def _write_checkpoint(checkpoint_data, checkpoint_completed, indices, log_data):
+
+    # Write the data first, so that a point is never marked as completed before its data are on disk (this is
+    # used by TemplateModelFactory.fill_grid)
+
+    checkpoint_data[indices] = log_data
+    checkpoint_data.flush()
+
+    checkpoint_completed[indices] = True
+    checkpoint_completed.flush()
 
-            store['energies'] = pd.Series(self._energies)
 
 # This adds a method to a class at runtime
 
@@ -280,6 +796,389 @@ class RectBivariateSplineWrapper(object):
         return res[0][0]
 
 
+class SplineWeights(object):
+    """
+    Computes the weights w_i(p) such that the interpolating spline of the provided degree through the points
+    (grid_i, y_i) evaluated at p is sum_i w_i(p) * y_i. Since the interpolating spline (without smoothing) is linear
+    in the y_i, the weights do not depend on them and can be computed once for all the energies of a template.
+
+    """
+
+    def __init__(self, grid, degree):
+
+        n_points = grid.shape[0]
+
+        # The knots depend only on the grid, so they are the same for all the "unit" data sets
+
+        tcks = [scipy.interpolate.splrep(grid, unit_vector, k=degree, s=0) for unit_vector in np.eye(n_points)]
+
+        knots = tcks[0][0]
+
+        coefficients = np.array(map(lambda tck: tck[1], tcks)).T
+
+        self._spline = scipy.interpolate.BSpline(knots, coefficients, degree)
+
+    def __call__(self, x):
+
+        return self._spline(x)
+
+
+# This is a registry of the data of the templates currently in use, keyed by the path of the template, the
+# modification time of its data file and the options used to load it. All the TemplateModel instances (and their
+# copies) using the same template with the same options share the same _TemplateData instance, which is removed from
+# the registry automatically when no instance uses it anymore
+_template_data_registry = weakref.WeakValueDictionary()
+
+
+def _get_template_data(template_dir, energy_range=None, fixed_parameters=(), single_precision=False):
+    """
+    Returns the data for the template in the provided directory, reading them only if they are not already in use
+
+    :param template_dir: the directory of the template
+    :param energy_range: (optional) a tuple (e_min, e_max) (in keV, any of them can be None). Only the energies
+    needed to interpolate within this range are loaded
+    :param fixed_parameters: (optional) a tuple of (parameter name, value) pairs. These parameters are removed from
+    the interpolation by interpolating the template at the provided values once and for all
+    :param single_precision: (optional) if True, data are converted to float32 (if not already stored as float32)
+    :return: a _TemplateData instance
+    """
+
+    key = (template_dir, os.path.getmtime(os.path.join(template_dir, 'log_data.npy')), energy_range,
+           fixed_parameters, single_precision)
+
+    template_data = _template_data_registry.get(key)
+
+    if template_data is None:
+
+        template_data = _TemplateData(template_dir, energy_range, fixed_parameters, single_precision)
+
+        _template_data_registry[key] = template_data
+
+    return template_data
+
+
+def _get_linear_weights(grid, value):
+
+    # Returns the index of the cell of the grid containing the value, and the weights of the two extremes of the cell
+    # for the linear interpolation (values outside of the grid are extrapolated)
+
+    idx = min(max(np.searchsorted(grid, value) - 1, 0), grid.shape[0] - 2)
+
+    t = (value - grid[idx]) / (grid[idx + 1] - grid[idx])
+
+    return idx, np.array([1 - t, t])
+
+
+def _get_linear_weights_matrix(grid, values, dtype=float):
+
+    # Returns the sparse matrix M such that M.dot(y) is the linear interpolation of the points (grid, y) at the provided
+    # values (values outside of the grid are extrapolated, like the B-spline of degree 1 does). Each row contains the
+    # weights of the two extremes of the cell of the grid containing the value (see _get_linear_weights)
+
+    idx = np.clip(np.searchsorted(grid, values) - 1, 0, grid.shape[0] - 2)
+
+    t = (values - grid[idx]) / (grid[idx + 1] - grid[idx])
+
+    rows = np.repeat(np.arange(values.shape[0]), 2)
+    columns = np.column_stack((idx, idx + 1)).ravel()
+    weights = np.column_stack((1 - t, t)).ravel().astype(dtype)
+
+    return scipy.sparse.csr_matrix((weights, (rows, columns)), shape=(values.shape[0], grid.shape[0]))
+
+
+class _TemplateData(object):
+    """
+    Contains the (read-only) data of a template and everything which is needed to interpolate them. Since the data
+    are memory-mapped, forked processes share the same memory pages.
+
+    :param template_dir: the directory of the template
+    :param energy_range: (optional) a tuple (e_min, e_max) (see _get_template_data)
+    :param fixed_parameters: (optional) a tuple of (parameter name, value) pairs (see _get_template_data)
+    :param single_precision: (optional) whether to convert the data to float32 (see _get_template_data)
+    """
+
+    def __init__(self, template_dir, energy_range=None, fixed_parameters=(), single_precision=False):
+
+        self.template_dir = template_dir
+
+        self.energy_range = energy_range
+
+        self.fixed_parameters = fixed_parameters
+
+        self.single_precision = single_precision
+
+        self.metadata, self.parameters_grids, self.energies, self.log_data = _read_template(template_dir)
+
+        self.interpolation_degree = self.metadata['interpolation_degree']
+
+        self.spline_smoothing_factor = self.metadata['spline_smoothing_factor']
+
+        if energy_range is not None:
+
+            self._select_energies(*energy_range)
+
+        self._prepare_interpolators()
+
+        if single_precision and self.log_data.dtype != np.float32:
+
+            # NOTE: this reads the data in memory (after the selection of the energies and the fixed parameters).
+            # Templates saved in single precision are instead kept memory-mapped
+
+            self.log_data = self.log_data.astype(np.float32)
+
+        # The interpolation is performed in the same precision as the data
+
+        self.dtype = self.log_data.dtype
+
+    def __reduce__(self):
+
+        # When pickled (or copied) we only store the location of the template and the options, so that copies of a
+        # TemplateModel share the same data instead of duplicating them
+
+        return _get_template_data, (self.template_dir, self.energy_range, self.fixed_parameters,
+                                    self.single_precision)
+
+    def _select_energies(self, e_min, e_max):
+
+        # Keep only the energies within the range, plus a margin so that the interpolation within the range is
+        # not affected (for linear interpolation this means the two energies bracketing the range)
+
+        n_energies = self.energies.shape[0]
+
+        margin = max(self.interpolation_degree, 1)
+
+        first = 0 if e_min is None else max(np.searchsorted(self.energies, e_min, 'right') - margin, 0)
+
+        last = n_energies if e_max is None else min(np.searchsorted(self.energies, e_max, 'left') + margin,
+                                                    n_energies)
+
+        # We need at least interpolation_degree + 1 energies for the spline
+
+        n_needed = self.interpolation_degree + 1
+
+        if last - first < n_needed:
+
+            last = min(first + n_needed, n_energies)
+
+            first = max(last - n_needed, 0)
+
+        # NOTE: this is a view of the memory-mapped data, so nothing is read from disk here
+
+        self.energies = self.energies[first:last]
+
+        self.log_data = self.log_data[..., first:last]
+
+    def _prepare_interpolators(self):
+
+        # Figure out the shape of the data matrices
+        data_shape = map(lambda x: x.shape[0], self.parameters_grids.values())
+
+        # NOTE: the whole template is stored in self.log_data as one N-d array, with one axis for each parameter
+        # and the energy as the last axis. We interpolate on the logarithm
+
+        assert list(self.log_data.shape) == data_shape + [self.energies.shape[0]], "Template data are corrupted"
+
+        # These are the parameters which are not fixed, i.e., the ones we need to interpolate on
+
+        fixed_parameters = dict(self.fixed_parameters)
+
+        for parameter_name in fixed_parameters:
+
+            if parameter_name not in self.parameters_grids:
+
+                raise ValueError("Parameter %s is not part of this template" % parameter_name)
+
+            grid = self.parameters_grids[parameter_name]
+
+            if not grid.min() <= fixed_parameters[parameter_name] <= grid.max():
+
+                raise ValueError("The value for parameter %s is outside of its grid" % parameter_name)
+
+        self.interpolated_axes = [i for i, parameter_name in enumerate(self.parameters_grids.keys())
+                                  if parameter_name not in fixed_parameters]
+
+        self.grids = map(lambda i: np.array(self.parameters_grids.values()[i], dtype=float), self.interpolated_axes)
+
+        # Weights for the interpolation in energy (see compute_energy_interpolation_matrix)
+
+        self._log_energies = np.log10(np.array(self.energies, dtype=float))
+
+        self._energy_spline_weights = SplineWeights(self._log_energies, self.interpolation_degree)
+
+        # By default we use linear interpolation in the parameters' space, which is computed for all energies at once
+        # by the contraction of the 2^n_parameters values around the requested point with the linear weights
+
+        self._interpolation_mode = 'linear'
+
+        self._interpolators = None
+
+        self._spline_weights = None
+
+        if len(self.parameters_grids.values()) == 2:
+
+            x, y = self.parameters_grids.values()
+
+            # Make sure that the requested polynomial degree is less than the number of data sets in
+            # both directions
+
+            msg = "You cannot use an interpolation degree of %s if you don't provide at least %s points " \
+                  "in the %s direction. Increase the number of templates or decrease the interpolation " \
+                  "degree."
+
+            if len(x) <= self.interpolation_degree:
+
+                raise RuntimeError(msg % (self.interpolation_degree, self.interpolation_degree+1, 'x'))
+
+            if len(y) <= self.interpolation_degree:
+
+                raise RuntimeError(msg % (self.interpolation_degree, self.interpolation_degree + 1, 'y'))
+
+            if self.spline_smoothing_factor != 0:
+
+                # A smoothing spline is not linear in the data, so we need one interpolator for each energy
+
+                if len(fixed_parameters) > 0:
+
+                    raise RuntimeError("You cannot fix parameters in a template using a smoothing spline")
+
+                self._interpolation_mode = 'smoothing_spline'
+
+                self._interpolators = []
+
+                for i in range(self.energies.shape[0]):
+
+                    this_interpolator = RectBivariateSplineWrapper(x, y, self.log_data[..., i],
+                                                                   kx=self.interpolation_degree,
+                                                                   ky=self.interpolation_degree,
+                                                                   s=self.spline_smoothing_factor)
+
+                    self._interpolators.append(this_interpolator)
+
+            elif self.interpolation_degree != 1:
+
+                # An interpolating spline in 2d is the product of the interpolating splines along the two axes,
+                # so we can precompute the weights for each axis and contract them with the data
+
+                self._interpolation_mode = 'spline'
+
+                self._spline_weights = map(lambda grid: SplineWeights(grid, self.interpolation_degree), self.grids)
+
+        # In more than 2d we can only use linear interpolation
+
+        if len(fixed_parameters) > 0:
+
+            self._slice_fixed_parameters(fixed_parameters)
+
+    def _slice_fixed_parameters(self, fixed_parameters):
+
+        # Interpolate the template at the values of the fixed parameters, once and for all. This is exact, because
+        # both the linear interpolation and the interpolating spline are tensor products of 1d interpolations.
+        # We go backward so that the position of the axes still to be processed does not change
+
+        log_data = self.log_data
+
+        for axis in range(len(self.parameters_grids) - 1, -1, -1):
+
+            parameter_name = self.parameters_grids.keys()[axis]
+
+            if parameter_name not in fixed_parameters:
+
+                continue
+
+            grid = np.array(self.parameters_grids[parameter_name], dtype=float)
+
+            value = fixed_parameters[parameter_name]
+
+            if self._interpolation_mode == 'spline':
+
+                weights = SplineWeights(grid, self.interpolation_degree)(value)
+
+            else:
+
+                # Only the two slabs around the value are needed (and read from disk)
+
+                idx, weights = _get_linear_weights(grid, value)
+
+                log_data = np.take(log_data, [idx, idx + 1], axis=axis)
+
+            log_data = np.tensordot(weights, log_data, axes=(0, axis))
+
+        self.log_data = np.ascontiguousarray(log_data, dtype=self.log_data.dtype)
+
+    def interpolate_parameters(self, parameters_values):
+        """
+        Returns the logarithm of the template interpolated at the provided parameters' values, for all the energies
+        of the template.
+
+        :param parameters_values: values for all the parameters of the template (the values of the fixed parameters
+        are ignored)
+        :return: array with the log10 of the interpolated template, one element for each energy
+        """
+
+        if self._interpolation_mode == 'smoothing_spline':
+
+            return np.array(map(lambda interpolator: interpolator(parameters_values), self._interpolators))
+
+        parameters_values = map(lambda i: parameters_values[i], self.interpolated_axes)
+
+        if self._interpolation_mode == 'spline':
+
+            weights = map(lambda (spline_weights, value): spline_weights(value).astype(self.dtype),
+                          zip(self._spline_weights, parameters_values))
+
+            cell = self.log_data
+
+        else:
+
+            # Find the cell of the grid which contains the point, and the linear weights along each axis
+
+            weights = []
+            cell_slices = []
+
+            for grid, value in zip(self.grids, parameters_values):
+
+                idx, this_weights = _get_linear_weights(grid, value)
+
+                weights.append(this_weights.astype(self.dtype))
+                cell_slices.append(slice(idx, idx + 2))
+
+            cell = self.log_data[tuple(cell_slices)]
+
+        # Contract one parameter axis at the time. At the end only the energy axis remains
+
+        for this_weights in weights:
+
+            cell = np.tensordot(this_weights, cell, axes=(0, 0))
+
+        return cell
+
+    def compute_energy_interpolation_matrix(self, energies, scale):
+        """
+        Returns the matrix M such that M.dot(log_values) is the spline through the points
+        (log10(scale * tabulated energies), log_values), evaluated at log10(energies). Since the spline is linear in
+        the log_values, M depends only on the scale and on the requested energies (see
+        TemplateModel._get_energy_interpolation_matrix for the cache).
+
+        :param energies: requested energies
+        :param scale: the value of the scale parameter
+        :return: the interpolation matrix (a sparse matrix for linear interpolation)
+        """
+
+        # log10(energies) - log10(scale) is equivalent to interpolating on log10(scale * tabulated energies)
+
+        log_energies = np.log10(np.ravel(energies)) - np.log10(scale)
+
+        if self.interpolation_degree == 1:
+
+            # Only two elements per row are different from zero, so we build directly the sparse matrix
+
+            return _get_linear_weights_matrix(self._log_energies, log_energies, self.dtype)
+
+        else:
+
+            return self._energy_spline_weights(log_energies).astype(self.dtype)
+
+
 class TemplateModel(Function1D):
 
     r"""
@@ -301,75 +1200,94 @@ class TemplateModel(Function1D):
 
     __metaclass__ = FunctionMeta
 
-    def _custom_init_(self, model_name, other_name=None):
+    def _custom_init_(self, model_name, other_name=None, e_min=None, e_max=None, fixed_parameters=None,
+                      single_precision=False):
         """
         Custom initialization for this model
         
         :param model_name: the name of the model, corresponding to the root of the .h5 file in the data directory
         :param other_name: (optional) the name to be used as name of the model when used in astromodels. If None 
         (default), use the same name as model_name
+        :param e_min: (optional) minimum energy which will be requested (keV if not a Quantity). Only the tabulated
+        energies needed to interpolate within [e_min, e_max] are used, so the model is extrapolated outside this
+        range. The range refers to the tabulated energies, i.e., to scale = 1
+        :param e_max: (optional) maximum energy which will be requested (see e_min)
+        :param fixed_parameters: (optional) a dictionary {parameter name: value}. These parameters are interpolated
+        once and for all at the provided values when loading the template, and cannot be changed afterwards. This
+        reduces the number of dimensions of the interpolation
+        :param single_precision: (optional) if True, store and interpolate the template in float32 instead of float64
+        (templates saved in single precision by the TemplateModelFactory are always used in single precision). The
+        template contains log10 of the fluxes, so the relative error on the fluxes is about 2.3 times the absolute
+        error on the log10 values, which is dominated by the rounding to float32 (6e-8 in relative terms). Within the
+        tabulated energies it stays below 1e-6 * max(|log10(flux)|), for example below 1e-5 for fluxes around 1e-10
+        (errors are amplified when extrapolating outside of the tabulated energies)
         :return: none
         """
 
 
-        # Get the data directory
+        template_dir, legacy_file = _get_template_paths(model_name)
 
-        data_dir_path = get_user_data_path()
+        if not os.path.exists(template_dir):
 
-        # Sanitize the data file
+            if os.path.exists(legacy_file):
 
-        filename_sanitized = os.path.abspath(os.path.join(data_dir_path, '%s.h5' % model_name))
+                # This is a template saved with a previous version of astromodels. Convert it
 
-        if not os.path.exists(filename_sanitized):
+                warnings.warn("Converting template %s to the new format" % legacy_file)
 
-            raise MissingDataFile("The data file %s does not exists. Did you use the "
-                                  "TemplateFactory?" % (filename_sanitized))
+                convert_legacy_template(model_name)
 
-        # Open the template definition and read from it
-
-        self._data_file = filename_sanitized
-
-        with HDFStore(filename_sanitized) as store:
+            else:
 
-            self._data_frame = store['data_frame']
+                raise MissingDataFile("The data file %s does not exists. Did you use the "
+                                      "TemplateFactory?" % (template_dir))
 
-            self._parameters_grids = collections.OrderedDict()
+        # Get the data of the template (which are shared with all other instances using the same template)
 
-            processed_parameters = 0
+        self._data_file = template_dir
 
-            for key in store.keys():
+        if e_min is not None or e_max is not None:
 
-                match = re.search('p_([0-9]+)_(.+)', key)
+            energy_range = tuple(map(lambda e: float(e.to(u.keV).value) if isinstance(e, u.Quantity) else e,
+                                     [e_min, e_max]))
 
-                if match is None:
+        else:
 
-                    continue
+            energy_range = None
 
-                else:
+        if fixed_parameters is None:
 
-                    tokens = match.groups()
+            fixed_parameters = {}
 
-                    this_parameter_number = int(tokens[0])
-                    this_parameter_name = str(tokens[1])
+        fixed_parameters = tuple(sorted(map(lambda (key, value): (str(key), float(value)), fixed_parameters.items())))
 
-                    assert this_parameter_number == processed_parameters, "Parameters out of order!"
+        self._template_data = _get_template_data(template_dir, energy_range, fixed_parameters, bool(single_precision))
 
-                    self._parameters_grids[this_parameter_name] = store[key]
+        description = self._template_data.metadata['description']
+        name = self._template_data.metadata['name']
 
-                    processed_parameters += 1
+        # Keep the options used to load the template, so that they can be saved and the model can be restored
+        # exactly (see to_dict). This is needed only if some option has been used, or if the name of the function is
+        # not the name of the template
 
-            self._energies = store['energies']
+        if energy_range is not None or fixed_parameters or single_precision or \
+                (other_name is not None and other_name != model_name):
 
-            # Now get the metadata
+            self._template_options = {'model_name': model_name,
+                                      'e_min': None if energy_range is None else energy_range[0],
+                                      'e_max': None if energy_range is None else energy_range[1],
+                                      'fixed_parameters': dict(fixed_parameters),
+                                      'single_precision': bool(single_precision)}
 
-            metadata = store.get_storer('data_frame').attrs.metadata
+        else:
 
-            description = metadata['description']
-            name = metadata['name']
+            self._template_options = None
 
-            self._interpolation_degree = metadata['interpolation_degree']
+        # This will contain the matrices for the interpolation in energy (see _get_energy_interpolation_matrix).
+        # Each instance has its own cache, since instances sharing the same template usually have different
+        # scales or are evaluated on different energies
 
-            self._spline_smoothing_factor = metadata['spline_smoothing_factor']
+        self._energy_interpolation_cache = collections.OrderedDict()
 
         # Make the dictionary of parameters
 
@@ -386,85 +1304,69 @@ class TemplateModel(Function1D):
         parameters['K'] = Parameter('K', 1.0)
         parameters['scale'] = Parameter('scale', 1.0)
 
-        for parameter_name in self._parameters_grids.keys():
-
-            grid = self._parameters_grids[parameter_name]
-
-            parameters[parameter_name] = Parameter(parameter_name, grid.median(),
-                                                   min_value=grid.min(),
-                                                   max_value=grid.max())
-
-        if other_name is None:
-
-            super(TemplateModel, self).__init__(name, function_definition, parameters)
+        for parameter_name in self._template_data.parameters_grids.keys():
 
-        else:
+            grid = self._template_data.parameters_grids[parameter_name]
 
-            super(TemplateModel, self).__init__(other_name, function_definition, parameters)
+            if parameter_name in dict(fixed_parameters):
 
-        # Finally prepare the interpolators
+                # The parameter is kept (so that the model can be saved and restored), but it cannot be changed
 
-        self._prepare_interpolators()
-
-    def _prepare_interpolators(self):
+                value = dict(fixed_parameters)[parameter_name]
 
-        # Figure out the shape of the data matrices
-        data_shape = map(lambda x: x.shape[0], self._parameters_grids.values())
+                parameters[parameter_name] = Parameter(parameter_name, value, min_value=value, max_value=value,
+                                                       free=False)
 
-        self._interpolators = []
+            else:
 
-        for energy in self._energies:
+                parameters[parameter_name] = Parameter(parameter_name, float(np.median(grid)),
+                                                       min_value=float(grid.min()),
+                                                       max_value=float(grid.max()))
 
-            # Make interpolator for this energy
-            # NOTE: we interpolate on the logarithm
+        if other_name is None:
 
-            this_data = np.array(np.log10(self._data_frame[energy].values).reshape(*data_shape), dtype=float)
+            super(TemplateModel, self).__init__(name, function_definition, parameters)
 
-            if len(self._parameters_grids.values()) == 2:
+        else:
 
-                x, y = self._parameters_grids.values()
+            super(TemplateModel, self).__init__(other_name, function_definition, parameters)
 
-                # Make sure that the requested polynomial degree is less than the number of data sets in
-                # both directions
+    def _set_units(self, x_unit, y_unit):
 
-                msg = "You cannot use an interpolation degree of %s if you don't provide at least %s points " \
-                      "in the %s direction. Increase the number of templates or decrease the interpolation " \
-                      "degree."
+        self.K.unit = y_unit
 
-                if len(x) <= self._interpolation_degree:
+        self.scale.unit = 1 / x_unit
 
-                    raise RuntimeError(msg % (self._interpolation_degree, self._interpolation_degree+1, 'x'))
+    # This function will be substituted during construction by another version with
+    # all the parameters of this template
 
-                if len(y) <= self._interpolation_degree:
+    def evaluate(self, x, K, scale, *args):
 
-                    raise RuntimeError(msg % (self._interpolation_degree, self._interpolation_degree + 1, 'y'))
+        return K * self._interpolate(x, scale, args)
 
-                this_interpolator = RectBivariateSplineWrapper(x, y, this_data,
-                                                               kx=self._interpolation_degree,
-                                                               ky=self._interpolation_degree,
-                                                               s=self._spline_smoothing_factor)
+    def _get_energy_interpolation_matrix(self, energies, scale):
 
-            else:
+        # The matrix depends only on the scale and on the requested energies, which in a fit usually never change.
+        # Hence, we keep the last few of them in a least recently used cache: a hit moves the element to the end,
+        # and the first element is removed when the cache is full
 
-                # In more than 2d we can only use linear interpolation
+        energies = np.atleast_1d(energies)
 
-                this_interpolator = scipy.interpolate.RegularGridInterpolator(self._parameters_grids.values(),
-                                                                              this_data)
+        key = (float(scale), energies.size, hashlib.md5(energies.tostring()).hexdigest())
 
-            self._interpolators.append(this_interpolator)
+        interpolation_matrix = self._energy_interpolation_cache.pop(key, None)
 
-    def _set_units(self, x_unit, y_unit):
+        if interpolation_matrix is None:
 
-        self.K.unit = y_unit
+            interpolation_matrix = self._template_data.compute_energy_interpolation_matrix(energies, scale)
 
-        self.scale.unit = 1 / x_unit
+            if len(self._energy_interpolation_cache) >= 10:
 
-    # This function will be substituted during construction by another version with
-    # all the parameters of this template
+                self._energy_interpolation_cache.popitem(False)
 
-    def evaluate(self, x, K, scale, *args):
+        self._energy_interpolation_cache[key] = interpolation_matrix
 
-        return K * self._interpolate(x, scale, args)
+        return interpolation_matrix
 
     def _interpolate(self, energies, scale, parameters_values):
 
@@ -480,26 +1382,25 @@ class TemplateModel(Function1D):
 
             scale = scale.to(1 / u.keV).value
 
-        log_energies = np.log10(energies)
-
-        e_tilde = self._energies * scale
-
         # Gather all interpolations for these parameters' values at all defined energies
         # (these are the logarithm of the values)
 
-        log_interpolations = np.array(map(lambda i:self._interpolators[i](parameters_values),
-                                          range(self._energies.shape[0])))
+        parameters_values = map(lambda value: value.value if isinstance(value, u.Quantity) else value,
+                                parameters_values)
+
+        log_interpolations = self._template_data.interpolate_parameters(parameters_values)
 
         # Now interpolate the interpolations to get the flux at the requested energies
 
         # NOTE: the variable "interpolations" contains already the log10 of the values,
 
-        interpolator = scipy.interpolate.InterpolatedUnivariateSpline(np.log10(e_tilde),
-                                                                      log_interpolations,
-                                                                      k=self._interpolation_degree,
-                                                                      ext=0)
+        energies = np.array(energies, copy=False, dtype=float)
+
+        interpolation_matrix = self._get_energy_interpolation_matrix(energies, scale)
+
+        # (the exponentiation is always made in double precision)
 
-        values = np.power(10, interpolator(log_energies))
+        values = np.power(10, interpolation_matrix.dot(log_interpolations).astype(float)).reshape(energies.shape)
 
         # The division by scale results from the differential:
         # E = e * scale
@@ -523,4 +1424,11 @@ class TemplateModel(Function1D):
         #
         #     data['extra_setup'] = {'data_file': self._data_file}
 
+        # Save the options used to load the template (if any), so that the ModelParser can restore the model with the
+        # same ones
+
+        if not minimal and self._template_options is not None:
+
+            data['template_options'] = self._template_options
+
         return data
\ No newline at end of file
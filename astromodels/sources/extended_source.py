@@ -8,7 +8,10 @@ from astromodels.core.tree import Node
 from astromodels.core.units import get_units
 from astromodels.functions.functions import Constant
 from astromodels.sources.source import Source, EXTENDED_SOURCE
+from astromodels.utils.bounding_box_index import is_inside_boundaries
 from astromodels.utils.pretty_list import dict_to_list
+from astromodels.utils.separable_cube import SeparableCube
+from astromodels.utils.sky_grid import _get_input_type, angular_distance_on_grid, get_sky_grid
 
 
 class ExtendedSource(Source, Node):
@@ -125,17 +128,20 @@ class ExtendedSource(Source, Node):
 
         return self._spatial_shape
 
-    def __call__(self, lon, lat, energies):
+    def __call__(self, lon, lat, energies, separable=False):
         """
         Returns brightness of source at the given position and energy
 
         :param lon: longitude (array or float)
         :param lat: latitude (array or float)
         :param energies: energies (array or float)
+        :param separable: (optional) if True, instead of the full cube return a SeparableCube which keeps the spatial
+        and spectral factors separated (only for 2D spatial shapes). Default: False
         :return: differential flux at given position and energy
         """
 
-        assert type(lat) == type(lon) and type(lon) == type(energies), "Type mismatch in input of call"
+        assert _get_input_type(lat) == _get_input_type(lon) and _get_input_type(lon) == _get_input_type(energies), \
+            "Type mismatch in input of call"
 
         if not isinstance(lat, np.ndarray):
 
@@ -169,17 +175,22 @@ class ExtendedSource(Source, Node):
 
             brightness = self._spatial_shape(lon, lat)
 
-            # In this case the spectrum is the same everywhere
-            n_points = lat.shape[0]
-            n_energies = differential_flux.shape[0]
+            # In this case the spectrum is the same everywhere, so the cube is just the outer product of the
+            # brightness and of the spectrum
 
-            # The following is a little obscure, but it is 6x faster than doing a for loop
+            cube = SeparableCube(np.array(brightness, ndmin=1, copy=False, subok=True),
+                                 np.array(differential_flux, ndmin=1, copy=False, subok=True))
 
-            cube = np.repeat(differential_flux, n_points).reshape(n_energies, n_points).T
-            result = (cube.T * brightness).T
+            if separable:
+
+                return cube
+
+            result = cube.materialize()
 
         else:
 
+            assert not separable, "A separable cube is only possible for 2D spatial shapes"
+
             result = self._spatial_shape(lon, lat, energies) * differential_flux
 
         # Do not clip the output, otherwise it will not be possible to use ext. sources
@@ -187,6 +198,83 @@ class ExtendedSource(Source, Node):
 
         return np.squeeze(result)
 
+    def get_sparse_flux(self, lon, lat, energies):
+        """
+        Returns the brightness of the source only for the points which can receive a contribution from it, i.e.,
+        the points within the boundaries of the spatial shape (see get_boundaries) and within its bounding cone (if
+        the shape provides one, see Function.get_bounding_cone). The other points are never evaluated, so the cost
+        scales with the size of the source instead of the number of points. Inputs are without units (in the
+        current units).
+
+        :param lon: longitudes (array)
+        :param lat: latitudes (array)
+        :param energies: energies (array)
+        :return: a tuple (indices, fluxes) where indices are the indices of the selected points and fluxes is an array
+        with shape (n_selected_points, n_energies) containing the differential flux of those points
+        """
+
+        sky_grid = get_sky_grid(lon, lat)
+
+        lon = np.array(lon, dtype=float, ndmin=1, copy=False)
+        lat = np.array(lat, dtype=float, ndmin=1, copy=False)
+        energies = np.array(energies, dtype=float, ndmin=1, copy=False)
+
+        # Select first with the boundaries, which only requires comparisons
+
+        indices = np.flatnonzero(is_inside_boundaries(lon, lat, self.get_boundaries()))
+
+        cone = self._spatial_shape.get_bounding_cone()
+
+        if cone is not None and indices.shape[0] > 0:
+
+            lon0, lat0, radius = cone
+
+            if sky_grid is not None:
+
+                # Use the cached unit vectors of the grid. The small tolerance makes sure that we do not lose points
+                # exactly on the edge because of rounding
+
+                cos_angsep = sky_grid.cos_angular_distance(lon0, lat0, indices)
+
+                indices = indices[cos_angsep >= np.cos(np.deg2rad(radius)) - 1e-12]
+
+            else:
+
+                angsep = angular_distance_on_grid(lon0, lat0, lon[indices], lat[indices])
+
+                indices = indices[angsep <= radius]
+
+        n_energies = energies.shape[0]
+
+        if indices.shape[0] == 0:
+
+            return indices, np.zeros((0, n_energies))
+
+        differential_flux = np.sum([component.shape(energies) for component in self.components.values()], 0)
+
+        # When all the points are selected, the spatial shape gets the coordinates of the SkyGrid (if any), so that
+        # it can use it
+
+        if sky_grid is not None and indices.shape[0] == sky_grid.n_points:
+
+            lon_selected, lat_selected = sky_grid.lon, sky_grid.lat
+
+        else:
+
+            lon_selected, lat_selected = lon[indices], lat[indices]
+
+        if self._spatial_shape.n_dim == 2:
+
+            brightness = self._spatial_shape(lon_selected, lat_selected)
+
+            fluxes = np.outer(brightness, differential_flux)
+
+        else:
+
+            fluxes = self._spatial_shape(lon_selected, lat_selected, energies) * differential_flux
+
+        return indices, fluxes.reshape(indices.shape[0], n_energies)
+
     def has_free_parameters(self):
         """
         Returns True or False whether there is any parameter in this source
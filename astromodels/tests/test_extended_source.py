@@ -0,0 +1,141 @@
+import numpy as np
+import pytest
+
+from astromodels.core.memoization import use_astromodels_memoization
+from astromodels.functions.functions import Powerlaw
+from astromodels.functions.functions_2D import Gaussian_on_sphere, Disk_on_sphere, Ellipse_on_sphere
+from astromodels.functions.functions_3D import Continuous_injection_diffusion
+from astromodels.sources.extended_source import ExtendedSource
+from astromodels.utils.sky_grid import SkyGrid
+
+
+def _get_roi(lon0, lat0, size, n_points=300):
+
+    # A square grid of points around the provided position, with longitudes in the 0..360 range
+
+    lons, lats = np.meshgrid(np.linspace(lon0 - size / 2.0, lon0 + size / 2.0, n_points),
+                             np.linspace(lat0 - size / 2.0, lat0 + size / 2.0, n_points))
+
+    return np.mod(lons.flatten(), 360.0), lats.flatten()
+
+
+def test_sparse_flux():
+
+    energies = np.logspace(1, 3, 10)
+
+    # The source at lon0 = 359.5 checks the wrapping of the longitude
+
+    for lon0 in [100.0, 359.5]:
+
+        lon, lat = _get_roi(lon0, 20.0, 30.0)
+
+        grid = SkyGrid(lon, lat)
+
+        shapes = [Disk_on_sphere(lon0=lon0, lat0=20.0, radius=1.0),
+                  Ellipse_on_sphere(lon0=lon0, lat0=20.0, a=1.0, b=0.5, theta=30.0),
+                  Gaussian_on_sphere(lon0=lon0, lat0=20.0, sigma=0.5)]
+
+        for shape in shapes:
+
+            source = ExtendedSource("test", shape, Powerlaw())
+
+            with use_astromodels_memoization(False):
+
+                dense = source(lon, lat, energies)
+
+                indices, fluxes = source.get_sparse_flux(lon, lat, energies)
+
+                indices_grid, fluxes_grid = source.get_sparse_flux(grid.lon, grid.lat, energies)
+
+            # Only a small fraction of the points must have been selected
+
+            assert 0 < indices.shape[0] < 0.05 * lon.shape[0]
+
+            assert fluxes.shape == (indices.shape[0], energies.shape[0])
+
+            assert np.allclose(fluxes, dense[indices], rtol=1e-12, atol=0)
+
+            # Everything else must be (close to) zero
+
+            others = np.ones(lon.shape[0], bool)
+            others[indices] = False
+
+            assert np.all(dense[others] <= 1e-5 * dense.max())
+
+            # The cached unit vectors of the grid can only add points exactly on the edge
+
+            assert np.all(np.in1d(indices, indices_grid))
+            assert indices_grid.shape[0] - indices.shape[0] <= 2
+
+    # No points inside
+
+    source = ExtendedSource("test", Disk_on_sphere(lon0=100.0, lat0=20.0, radius=1.0), Powerlaw())
+
+    indices, fluxes = source.get_sparse_flux([200.0, 201.0], [-20.0, -21.0], energies)
+
+    assert indices.shape == (0,)
+    assert fluxes.shape == (0, 10)
+
+
+def test_sparse_flux_3D():
+
+    energies = np.logspace(1, 3, 10)
+
+    lon, lat = _get_roi(100.0, 20.0, 60.0, 200)
+
+    source = ExtendedSource("test", Continuous_injection_diffusion(lon0=100.0, lat0=20.0, rdiff0=2.0), Powerlaw())
+
+    with use_astromodels_memoization(False):
+
+        dense = source(lon, lat, energies)
+
+        indices, fluxes = source.get_sparse_flux(lon, lat, energies)
+
+    assert 0 < indices.shape[0] < lon.shape[0]
+
+    assert np.allclose(fluxes, dense[indices], rtol=1e-12, atol=0)
+
+
+def test_separable_cube():
+
+    energies = np.logspace(1, 3, 20)
+
+    lon, lat = _get_roi(100.0, 20.0, 10.0, 30)
+
+    source = ExtendedSource("test", Gaussian_on_sphere(lon0=100.0, lat0=20.0, sigma=2.0), Powerlaw())
+
+    dense = source(lon, lat, energies)
+
+    cube = source(lon, lat, energies, separable=True)
+
+    assert cube.shape == dense.shape
+    assert cube.spatial.shape == (lon.shape[0],)
+    assert cube.spectral.shape == (energies.shape[0],)
+
+    assert np.allclose(cube.materialize(), dense, rtol=1e-12, atol=0)
+    assert np.allclose(np.asarray(cube), dense, rtol=1e-12, atol=0)
+
+    # Contractions with response matrices
+
+    energy_dispersion = np.random.uniform(0, 1, (20, 5))
+    psf = np.random.uniform(0, 1, (7, lon.shape[0]))
+
+    assert np.allclose(cube.dot(energy_dispersion).materialize(), np.dot(dense, energy_dispersion), rtol=1e-10)
+    assert np.allclose(cube.rdot(psf).materialize(), np.dot(psf, dense), rtol=1e-10)
+    assert np.allclose(cube.rdot(psf).dot(energy_dispersion).materialize(),
+                       np.dot(np.dot(psf, dense), energy_dispersion), rtol=1e-10)
+
+    assert np.allclose(cube.dot(energy_dispersion[:, 0]), np.dot(dense, energy_dispersion[:, 0]), rtol=1e-10)
+    assert np.allclose(cube.rdot(psf[0]), np.dot(psf[0], dense), rtol=1e-10)
+
+    assert np.allclose(cube.sum(), dense.sum(), rtol=1e-10)
+    assert np.allclose(cube.sum(axis=0), dense.sum(axis=0), rtol=1e-10)
+    assert np.allclose(cube.sum(axis=1), dense.sum(axis=1), rtol=1e-10)
+
+    # Not possible for 3D shapes
+
+    source = ExtendedSource("test", Continuous_injection_diffusion(), Powerlaw())
+
+    with pytest.raises(AssertionError):
+
+        _ = source(lon, lat, energies, separable=True)
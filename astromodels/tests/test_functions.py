@@ -1,14 +1,26 @@
 import pytest
 
 import astropy.units as u
+from astropy.coordinates import SkyCoord, FK4
+from astropy.io import fits
 import numpy as np
 import pickle
 
 from astromodels.functions.function import FunctionMeta, Function1D, Function2D, FunctionDefinitionError, \
-    UnknownParameter, DesignViolation, get_function, get_function_class, UnknownFunction, list_functions
+    UnknownParameter, DesignViolation, get_function, get_function_class, UnknownFunction, list_functions, \
+    register_lazy_function
 from astromodels.functions.functions import Powerlaw, Line
-from astromodels.functions.functions_2D import Gaussian_on_sphere
-from astromodels.functions.functions_3D import Continuous_injection_diffusion
+from astromodels.functions.functions_2D import Gaussian_on_sphere, Disk_on_sphere, Ellipse_on_sphere, \
+    Latitude_galactic_diffuse, SpatialTemplate_2D
+from astromodels.functions.functions_3D import Continuous_injection_diffusion, SpatialTemplate_3D
+from astromodels.functions.dark_matter.dm_models import DMFitFunction, DMSpectra
+from astromodels.core.memoization import use_astromodels_memoization
+from astromodels.sources.extended_source import ExtendedSource
+from astromodels.sources.point_source import PointSource
+from astromodels.core.model import Model
+from astromodels.core.model_parser import clone_model
+from astromodels.utils.angular_distance import angular_distance
+from astromodels.utils.sky_grid import SkyGrid
 from astromodels.functions import function as function_module
 
 __author__ = 'giacomov'
@@ -848,4 +860,598 @@ def test_function3D():
 
     with pytest.raises(TypeError):
 
-        c.set_units("not existent", u.deg, u.keV, 1.0 / (u.keV * u.s * u.deg**2 * u.cm**2))
\ No newline at end of file
+        c.set_units("not existent", u.deg, u.keV, 1.0 / (u.keV * u.s * u.deg**2 * u.cm**2))
+
+
+def test_lazy_functions():
+
+    created = []
+
+    def class_factory():
+
+        created.append(get_a_function_class())
+
+    # get_a_function_class creates a class called Test_function
+
+    function_module._known_functions.pop("Test_function", None)
+
+    register_lazy_function("Test_function", class_factory)
+
+    # Nothing must have been created yet
+
+    assert len(created) == 0
+
+    with pytest.raises(UnknownFunction):
+
+        _ = get_function_class("not_existant")
+
+    assert len(created) == 0
+
+    # Now the class must be created
+
+    f = get_function("Test_function")
+
+    assert len(created) == 1
+
+    assert isinstance(f, created[0])
+
+    # The second time the class must not be created again
+
+    assert get_function_class("Test_function") is created[0]
+
+    assert len(created) == 1
+
+
+def test_dm_single_precision():
+
+    energies = np.logspace(5, 8, 50)
+
+    for dm_class in [DMFitFunction, DMSpectra]:
+
+        double = dm_class()
+        single = dm_class()
+        single.set_single_precision()
+
+        assert single._get_interpolator().table.dtype == np.float32
+
+        for mass in [50.0, 345.0, 5000.0]:
+
+            double.mass = mass
+            single.mass = mass
+
+            # NOTE: memoization is shared between instances, so we need to disable it to compare them
+
+            with use_astromodels_memoization(False):
+
+                assert np.allclose(single(energies), double(energies), rtol=1e-6, atol=0)
+
+        # The precision is kept when cloning or pickling a model, also within a composite function
+
+        assert 'single_precision' not in double.to_dict()
+
+        for shape in [single, single.duplicate() * Powerlaw()]:
+
+            model = Model(PointSource("test", ra=0.0, dec=0.0, spectral_shape=shape))
+
+            for restored_model in [clone_model(model), pickle.loads(pickle.dumps(model))]:
+
+                restored = restored_model.test.spectrum.main.shape
+
+                restored_dm = restored.functions[0] if shape is not single else restored
+
+                assert isinstance(restored_dm, dm_class)
+                assert restored_dm._get_interpolator().table.dtype == np.float32
+
+        single.set_single_precision(False)
+
+        assert single._get_interpolator().table.dtype == np.float64
+
+
+def test_dm_shared_tables():
+
+    energies = np.logspace(5, 8, 50)
+
+    for dm_class in [DMFitFunction, DMSpectra]:
+
+        dm1 = dm_class()
+        dm2 = dm_class()
+
+        # The interpolators are shared, and are not copied with the instances
+
+        assert dm1._get_interpolator() is dm2._get_interpolator()
+
+        assert len(pickle.dumps(dm1)) < 100000
+
+        # Changing the channel changes the spectrum
+
+        dm1.mass = 500.0
+
+        with use_astromodels_memoization(False):
+
+            bb = dm1(energies)
+
+            dm1.channel = 3
+
+            tautau = dm1(energies)
+
+            clone = pickle.loads(pickle.dumps(dm1))
+
+            assert np.all(clone(energies) == tautau)
+
+        assert not np.allclose(bb, tautau, atol=0)
+
+
+def test_dm_interpolation():
+
+    from scipy.interpolate import RegularGridInterpolator
+    from astromodels.functions.dark_matter import dm_models
+
+    # The interpolation kernel must be equivalent to the RegularGridInterpolator (including the extrapolation)
+
+    log_x = np.linspace(-11, 0.5, 300)
+
+    for table_name in ['fermi', 'combined']:
+
+        interpolator = dm_models._get_dm_interpolator(table_name, np.float64)
+
+        for channel in [1, 4, 12]:
+
+            ichan = dm_models._channel_index_mapping[channel]
+
+            reference = RegularGridInterpolator([interpolator.masses, dm_models._x], interpolator.table[ichan],
+                                                bounds_error=False, fill_value=None)
+
+            for mass in [1.0, 2.0, 91.2, 345.0, 9e3, 5e5, 2e6]:
+
+                assert np.allclose(interpolator(channel, mass, log_x), reference((mass, log_x)), rtol=1e-9, atol=0)
+
+
+def test_dm_multiple_channels():
+
+    energies = np.logspace(5, 8.5, 40)
+
+    masses = [50.0, 345.0, 5000.0]
+
+    for dm_class in [DMFitFunction, DMSpectra]:
+
+        dm = dm_class()
+        dm.sigmav = 3e-26
+
+        spectra = dm.get_spectra(energies, masses=masses)
+
+        assert spectra.shape == (12, 3, 40)
+
+        with use_astromodels_memoization(False):
+
+            for i, channel in enumerate(range(1, 13)):
+
+                for j, mass in enumerate(masses):
+
+                    dm.channel = channel
+                    dm.mass = mass
+
+                    assert np.allclose(spectra[i, j], dm(energies), rtol=1e-12, atol=0)
+
+        # Default: the current mass, and units
+
+        spectra = dm.get_spectra(energies * u.keV, channels=[2, 3])
+
+        assert spectra.shape == (2, 1, 40)
+
+        with use_astromodels_memoization(False):
+
+            dm.channel = 3
+
+            assert np.allclose(spectra[1, 0], dm(energies), rtol=1e-12, atol=0)
+
+
+def test_sky_grid():
+
+    lon = np.linspace(0.0, 359.0, 500)
+    lat = np.linspace(-89.0, 89.0, 500)
+
+    grid = SkyGrid(lon, lat)
+
+    assert grid.n_points == 500
+    assert grid.unit_vectors.shape == (3, 500)
+
+    # The coordinates cannot be changed, otherwise the cache would be stale
+
+    with pytest.raises(ValueError):
+
+        grid.lon[0] = 10.0
+
+    energies = np.logspace(0, 3, 500)
+
+    with use_astromodels_memoization(False):
+
+        for shape in [Gaussian_on_sphere(lon0=100.0, lat0=20.0, sigma=15.0),
+                      Disk_on_sphere(lon0=100.0, lat0=20.0, radius=15.0),
+                      Ellipse_on_sphere(lon0=100.0, lat0=20.0, a=15.0, b=10.0, theta=30.0)]:
+
+            expected = shape(lon, lat)
+
+            assert np.allclose(shape(grid.lon, grid.lat), expected, rtol=1e-10, atol=0)
+
+            # The position can change, the grid stays the same
+
+            shape.lon0 = 250.0
+
+            assert np.allclose(shape(grid.lon, grid.lat), shape(lon, lat), rtol=1e-10, atol=0)
+
+        c = Continuous_injection_diffusion(lon0=100.0, lat0=20.0, rdiff0=15.0)
+
+        assert np.allclose(c(grid.lon, grid.lat, energies), c(lon, lat, energies), rtol=1e-10, atol=0)
+
+        source = ExtendedSource("test", Gaussian_on_sphere(lon0=100.0, lat0=20.0, sigma=15.0), Powerlaw())
+
+        assert np.allclose(source(grid.lon, grid.lat, energies[:10]), source(lon, lat, energies[:10]),
+                           rtol=1e-10, atol=0)
+
+
+def test_latitude_galactic_diffuse_cache():
+
+    f = Latitude_galactic_diffuse(K=2.0, sigma_b=5.0)
+
+    ra = np.linspace(0, 359.0, 100)
+    dec = np.linspace(-80.0, 80.0, 100)
+
+    b = SkyCoord(ra=ra, dec=dec, frame='icrs', unit='deg').galactic.b.value
+
+    with use_astromodels_memoization(False):
+
+        assert np.allclose(f(ra, dec), 2.0 * np.exp(-b ** 2 / 50.0), rtol=1e-12)
+
+        # The second time the latitudes come from the cache
+
+        assert len(f._galactic_latitude_cache) == 1
+
+        f.sigma_b = 3.0
+
+        assert np.allclose(f(ra, dec), 2.0 * np.exp(-b ** 2 / 18.0), rtol=1e-12)
+
+        assert len(f._galactic_latitude_cache) == 1
+
+        # Changing the input or the frame must not use the cache
+
+        assert np.allclose(f(ra[:50], dec[:50]), 2.0 * np.exp(-b[:50] ** 2 / 18.0), rtol=1e-12)
+
+        f.set_frame(FK4())
+
+        b_fk4 = SkyCoord(ra=ra, dec=dec, frame=FK4(), unit='deg').galactic.b.value
+
+        assert np.allclose(f(ra, dec), 2.0 * np.exp(-b_fk4 ** 2 / 18.0), rtol=1e-12)
+
+        assert len(f._galactic_latitude_cache) == 3
+
+
+def test_spatial_template_2D(tmpdir):
+
+    # A small template with 1 deg pixels centered on (100, 20)
+
+    data = np.random.uniform(0, 1, (21, 21))
+
+    header = fits.Header()
+    header['CRPIX1'] = 10
+    header['CRPIX2'] = 10
+    header['CDELT1'] = 1.0
+    header['CDELT2'] = 1.0
+    header['CRVAL1'] = 100.0
+    header['CRVAL2'] = 20.0
+
+    fits_file = str(tmpdir.join("template.fits"))
+
+    fits.PrimaryHDU(data, header).writeto(fits_file)
+
+    ra = np.random.uniform(85.0, 115.0, 1000)
+    dec = np.random.uniform(5.0, 35.0, 1000)
+
+    x_pix = ((ra - 100.0) + 10).astype(int)
+    y_pix = ((dec - 20.0) + 10).astype(int)
+
+    inside = (x_pix >= 0) & (x_pix < 21) & (y_pix >= 0) & (y_pix < 21)
+
+    expected = np.zeros(1000)
+    expected[inside] = data[x_pix[inside], y_pix[inside]]
+
+    for memmap in [False, True]:
+
+        shape = SpatialTemplate_2D(K=2.0)
+        shape.load_file(fits_file, memmap=memmap)
+
+        with use_astromodels_memoization(False):
+
+            assert np.all(shape(ra, dec) == 2.0 * expected)
+
+            # The pixels are cached only for SkyGrid inputs
+
+            assert len(shape._pixels_cache) == 0
+
+            grid = SkyGrid(ra, dec)
+
+            assert np.all(shape(grid.lon, grid.lat) == 2.0 * expected)
+
+            # The second time the pixels come from the cache
+
+            shape.K = 3.0
+
+            assert np.all(shape(grid.lon, grid.lat) == 3.0 * expected)
+
+            assert len(shape._pixels_cache) == 1
+
+            # Sub-grids use the pixels of the whole grid
+
+            subgrid = grid.get_subgrid(100, 300)
+
+            assert np.all(shape(subgrid.lon, subgrid.lat) == 3.0 * expected[100:300])
+
+            assert len(shape._pixels_cache) == 1
+
+            # The cache is not copied
+
+            assert len(shape.duplicate()._pixels_cache) == 0
+            assert len(pickle.loads(pickle.dumps(shape))._pixels_cache) == 0
+
+
+def _write_map_cube(filename, data, energies):
+
+    # A map cube with 1 deg pixels, with the first pixel centered on (350, -10) so that it crosses lon = 0
+
+    header = fits.Header()
+    header['CRPIX1'] = 1
+    header['CRPIX2'] = 1
+    header['CDELT1'] = 1.0
+    header['CDELT2'] = 1.0
+    header['CRVAL1'] = 350.0
+    header['CRVAL2'] = -10.0
+
+    energies_hdu = fits.BinTableHDU.from_columns([fits.Column(name='Energy', format='D', unit='MeV',
+                                                              array=energies)], name='ENERGIES')
+
+    fits.HDUList([fits.PrimaryHDU(data, header), energies_hdu]).writeto(filename)
+
+
+def test_spatial_template_3D(tmpdir):
+
+    # Shape (n_energies, n_lat, n_lon)
+
+    energies = np.array([100.0, 1000.0, 10000.0])
+
+    data = np.random.uniform(1, 2, (3, 21, 31))
+
+    data[:, 0, 0] = 0.0
+
+    fits_file = str(tmpdir.join("cube.fits"))
+
+    _write_map_cube(fits_file, data, energies)
+
+    shape = SpatialTemplate_3D(K=2.0)
+    shape.load_file(fits_file, max_cached_planes=2)
+
+    # Pixel centers (the map covers lon 349.5...20.5 and lat -10.5...10.5)
+
+    lon = np.array([350.0, 351.2, 0.0, 10.4, 20.0, 30.0, 355.0])
+    lat = np.array([-10.0, -9.8, 0.0, 5.2, 10.0, 0.0, 11.0])
+
+    i_lon = np.array([0, 1, 10, 20, 30])
+    i_lat = np.array([0, 0, 10, 15, 20])
+
+    with use_astromodels_memoization(False):
+
+        # Energies on the planes (the last one is outside the cube)
+
+        values = shape(lon, lat, np.array([100.0, 1000.0, 10000.0, 100.0, 1000.0, 10000.0, 100.0]))
+
+        assert values.shape == (7, 7)
+
+        assert np.allclose(values[:5, :3], 2.0 * data[:, i_lat, i_lon].T, rtol=1e-12)
+
+        # Outside of the cube
+
+        assert np.all(values[5:] == 0)
+
+        # Between planes the interpolation is a power law (or linear when one of the values is zero)
+
+        e = np.array([50.0, 316.0, 20000.0])
+
+        values = shape(lon, lat, e)
+
+        w = np.log(316.0 / 100.0) / np.log(10.0)
+
+        expected = 2.0 * data[0, i_lat, i_lon] ** (1 - w) * data[1, i_lat, i_lon] ** w
+        expected[0] = 2.0 * data[1, 0, 0] * w
+
+        assert np.allclose(values[:5, 1], expected, rtol=1e-12)
+
+        assert np.all(values[:, [0, 2]] == 0)
+
+        # The caches are bounded
+
+        assert len(shape._planes_cache) <= 2
+
+        # Units
+
+        shape.set_units(u.deg, u.deg, u.keV, 1 / (u.keV * u.cm**2 * u.s * u.deg**2))
+
+        values = shape(lon * u.deg, lat * u.deg, np.array([1e5, 1e6, 1e7, 1e5, 1e6, 1e7, 1e5]) * u.keV)
+
+        assert np.allclose(values[:5, :3].value, 2.0 * data[:, i_lat, i_lon].T, rtol=1e-12)
+
+        # Inside an extended source, as a template
+
+        source = ExtendedSource("diffuse", shape)
+
+        source.spectrum.main.shape.k = 1.0
+
+        assert np.allclose(source(lon[:5], lat[:5], energies * 1000.0), 2.0 * data[:, i_lat, i_lon].T, rtol=1e-12)
+
+    (min_lon, max_lon), (min_lat, max_lat) = shape.get_boundaries()
+
+    assert (min_lon, max_lon, min_lat, max_lat) == (349.5, 20.5, -10.5, 10.5)
+
+    # The copies do not copy the cube
+
+    shape_copy = shape.duplicate()
+
+    assert shape_copy._data is None
+
+    with use_astromodels_memoization(False):
+
+        assert np.allclose(shape_copy(lon, lat, energies * 1000.0), shape(lon, lat, energies * 1000.0))
+
+
+def test_function3D_memory_budget():
+
+    c = Continuous_injection_diffusion(lon0=10.0, lat0=5.0, rdiff0=3.0)
+
+    lon = np.random.uniform(0.0, 20.0, 1000)
+    lat = np.random.uniform(-5.0, 15.0, 1000)
+    energies = np.logspace(6, 10, 50)
+
+    assert c.memory_budget == Continuous_injection_diffusion._default_memory_budget
+
+    with use_astromodels_memoization(False):
+
+        c.memory_budget = None
+
+        expected = c(lon, lat, energies)
+
+        assert expected.shape == (1000, 50)
+
+        # A budget allowing for 100 points at a time
+
+        c.memory_budget = 100 * 50 * 8 * Continuous_injection_diffusion._n_temporary_arrays
+
+        assert np.all(c(lon, lat, energies) == expected)
+
+        # Even with a budget too small for a single point
+
+        c.memory_budget = 1
+
+        assert np.all(c(lon[:10], lat[:10], energies) == expected[:10])
+
+    with pytest.raises(AssertionError):
+
+        c.memory_budget = 0
+
+
+def test_function3D_memory_budget_sky_grid(tmpdir):
+
+    lon = np.random.uniform(0.0, 20.0, 1000)
+    lat = np.random.uniform(-5.0, 15.0, 1000)
+    energies = np.logspace(6, 10, 50)
+
+    grid = SkyGrid(lon, lat)
+
+    c = Continuous_injection_diffusion(lon0=10.0, lat0=5.0, rdiff0=3.0)
+
+    with use_astromodels_memoization(False):
+
+        c.memory_budget = None
+
+        expected = c(grid.lon, grid.lat, energies)
+
+        assert np.allclose(expected, c(lon, lat, energies), rtol=1e-10)
+
+        # The chunks are sub-grids of the grid, so the results are the same as without chunks
+
+        c.memory_budget = 100 * 50 * 8 * Continuous_injection_diffusion._n_temporary_arrays
+
+        assert np.all(c(grid.lon, grid.lat, energies) == expected)
+
+        assert len(grid._subgrids) == 10
+
+        subgrid = grid.get_subgrid(200, 300)
+
+        assert subgrid is grid._subgrids[(200, 300)]
+        assert subgrid.root is grid and subgrid.offset == 200
+        assert np.all(subgrid.unit_vectors == grid.unit_vectors[:, 200:300])
+        assert np.all(subgrid.get_subgrid(10, 20).lon == lon[210:220])
+        assert subgrid.get_subgrid(10, 20) is grid.get_subgrid(210, 220)
+
+    # The caches of SpatialTemplate_3D are shared by all the chunks
+
+    data = np.random.uniform(1, 2, (3, 21, 31))
+
+    fits_file = str(tmpdir.join("cube.fits"))
+
+    _write_map_cube(fits_file, data, np.array([100.0, 1000.0, 10000.0]))
+
+    shape = SpatialTemplate_3D(K=2.0)
+    shape.load_file(fits_file)
+
+    lon = np.mod(np.random.uniform(-15.0, 25.0, 1000), 360.0)
+
+    grid = SkyGrid(lon, lat)
+
+    energies = np.array([200.0, 500.0, 5000.0])
+
+    with use_astromodels_memoization(False):
+
+        shape.memory_budget = None
+
+        expected = shape(grid.lon, grid.lat, energies)
+
+        assert np.all(expected == shape(lon, lat, energies))
+
+        shape._pixels_cache.clear()
+        shape._planes_cache.clear()
+
+        shape.memory_budget = 100 * 3 * 8 * SpatialTemplate_3D._n_temporary_arrays
+
+        assert np.all(shape(grid.lon, grid.lat, energies) == expected)
+
+        assert len(shape._pixels_cache) == 1
+        assert len(shape._planes_cache) == 3
+
+        # The cached planes never exceed the memory budget
+
+        other_grid = SkyGrid(lon[::-1], lat[::-1])
+
+        assert np.all(shape(other_grid.lon, other_grid.lat, energies) == expected[::-1])
+
+        assert sum(map(lambda plane: plane.nbytes, shape._planes_cache.values())) <= shape.memory_budget
+
+        # If the planes on the whole grid do not fit in the memory budget, only the pixels of each chunk are read
+
+        shape._planes_cache.clear()
+
+        shape.memory_budget = 50 * 3 * 8 * SpatialTemplate_3D._n_temporary_arrays
+
+        assert np.all(shape(grid.lon, grid.lat, energies) == expected)
+
+        assert len(shape._planes_cache) == 0
+
+
+def test_disk_ellipse_containment():
+
+    lon = np.random.uniform(80.0, 120.0, 100000)
+    lat = np.random.uniform(0.0, 40.0, 100000)
+
+    grid = SkyGrid(lon, lat)
+
+    disk = Disk_on_sphere(lon0=100.0, lat0=20.0, radius=10.0)
+    ellipse = Ellipse_on_sphere(lon0=100.0, lat0=20.0, a=10.0, b=5.0, theta=30.0)
+
+    # Reference with the exact angular distance. Points too close to the edges are excluded
+
+    angsep = angular_distance(100.0, 20.0, lon, lat)
+
+    f = np.sqrt(10.0 ** 2 - 5.0 ** 2)
+
+    angsep_sum = angular_distance(100.0 - f * np.cos(30.0), 20.0 - f * np.sin(30.0), lon, lat) + \
+                 angular_distance(100.0 + f * np.cos(30.0), 20.0 + f * np.sin(30.0), lon, lat)
+
+    with use_astromodels_memoization(False):
+
+        for shape, distance, size in [(disk, angsep, 10.0), (ellipse, angsep_sum, 20.0)]:
+
+            far_from_edge = np.abs(distance - size) > 1e-5
+
+            expected = (distance <= size)[far_from_edge]
+
+            for x, y in [(lon, lat), (grid.lon, grid.lat)]:
+
+                inside = shape(x, y) > 0
+
+                assert np.all(inside[far_from_edge] == expected)
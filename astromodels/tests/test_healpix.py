@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from astromodels.utils.healpix import get_number_of_pixels, get_pixel_centers, get_pixel_index, nest_to_ring, \
+    ring_to_nest, get_healpix_geometry
+
+
+def test_pixel_centers():
+
+    # Known values
+
+    lon, lat = get_pixel_centers(1, np.arange(12))
+
+    assert np.allclose(lon, [45, 135, 225, 315, 0, 90, 180, 270, 45, 135, 225, 315])
+    assert np.allclose(lat[:4], np.rad2deg(np.arcsin(2.0 / 3.0)))
+    assert np.allclose(lat[4:8], 0.0)
+
+    assert np.all(nest_to_ring(2, np.arange(4)) == [13, 5, 4, 0])
+
+    for nside in [1, 2, 4, 16, 64]:
+
+        n_pixels = get_number_of_pixels(nside)
+
+        pixels = np.arange(n_pixels)
+
+        for nest in [False, True]:
+
+            lon, lat = get_pixel_centers(nside, pixels, nest=nest)
+
+            assert np.all(get_pixel_index(nside, lon, lat, nest=nest) == pixels)
+
+        # The NESTED and RING schemes are permutations of each other
+
+        ring_pixels = nest_to_ring(nside, pixels)
+
+        assert np.all(np.sort(ring_pixels) == pixels)
+        assert np.all(ring_to_nest(nside, ring_pixels) == pixels)
+
+    with pytest.raises(AssertionError):
+
+        _ = nest_to_ring(3, [0])
+
+
+def test_equal_area():
+
+    # Uniformly distributed points must fill all the pixels (almost) equally
+
+    nside = 4
+
+    lon = np.random.uniform(0, 360, 480000)
+    lat = np.rad2deg(np.arcsin(np.random.uniform(-1, 1, 480000)))
+
+    counts = np.bincount(get_pixel_index(nside, lon, lat), minlength=get_number_of_pixels(nside))
+
+    # 2500 points per pixel on average, so the fluctuations are about 2%
+
+    assert np.all(np.abs(counts / 2500.0 - 1) < 0.1)
+
+
+def test_healpix_geometry():
+
+    geometry = get_healpix_geometry(8)
+
+    assert get_healpix_geometry(8) is geometry
+
+    assert geometry.n_pixels == 768
+    assert np.isclose(geometry.pixel_area * geometry.n_pixels, 4 * np.pi)
+
+    start, stop = geometry.get_latitude_range(-10.0, 20.0)
+
+    inside = (geometry.lat >= -10.0) & (geometry.lat <= 20.0)
+
+    assert np.all(np.flatnonzero(inside) == np.arange(start, stop))
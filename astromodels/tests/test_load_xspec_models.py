@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 try:
@@ -24,3 +26,156 @@ def test_xspec_load():
 
     # no need to do anything really
     pass
+
+
+@skip_if_xspec_is_not_available
+def test_xspec_lazy_classes():
+
+    import sys
+    import astromodels.xspec
+    import astromodels.xspec.factory as factory
+    from astromodels.functions.function import _known_functions, get_function_class
+
+    # The import above must not have created any class which has not been used yet
+
+    not_created = [name for name in astromodels.xspec.new_functions if name not in _known_functions]
+
+    assert len(not_created) >= 2
+
+    first, second = not_created[:2]
+
+    this_class = getattr(astromodels.xspec, first)
+
+    assert first in _known_functions
+    assert second not in _known_functions
+
+    # All the ways of getting the class return the same class
+
+    assert getattr(factory, first) is this_class
+    assert get_function_class(first) is this_class
+
+    # The generated code is in the cache directory, which is in sys.path so that the class can be imported in any
+    # other process as well
+
+    code_directory = os.path.dirname(os.path.abspath(sys.modules[this_class.__module__].__file__))
+
+    assert code_directory in sys.path
+
+    assert code_directory == factory.get_cache_directory(factory.find_model_dat())
+
+    _ = this_class()
+
+    with pytest.raises(AttributeError):
+
+        _ = astromodels.xspec.XS_not_existent
+
+
+@skip_if_xspec_is_not_available
+def test_xspec_cache(tmpdir):
+
+    import cPickle
+    import astromodels.xspec.factory as factory
+
+    model_dat = tmpdir.join("model.dat")
+
+    with open(factory.find_model_dat()) as f:
+
+        model_dat.write(f.read())
+
+    cache_directory = factory.get_cache_directory(str(model_dat), str(tmpdir))
+
+    assert cache_directory.startswith(str(tmpdir))
+
+    assert factory.get_cache_directory(str(model_dat), str(tmpdir)) == cache_directory
+
+    # Any change to model.dat gives a different cache
+
+    model_dat.write("\n", mode='a')
+
+    new_cache_directory = factory.get_cache_directory(str(model_dat), str(tmpdir))
+
+    assert new_cache_directory != cache_directory
+
+    # The first call parses model.dat, the second one reads the cache
+
+    definitions = factory.get_cached_models(str(model_dat), new_cache_directory)
+
+    assert definitions == factory.get_models(str(model_dat))
+
+    cache_file = os.path.join(new_cache_directory, 'model_definitions.pkl')
+
+    assert os.path.exists(cache_file)
+
+    definitions.popitem()
+
+    with open(cache_file, 'wb') as f:
+
+        cPickle.dump(definitions, f)
+
+    assert factory.get_cached_models(str(model_dat), new_cache_directory) == definitions
+
+
+@skip_if_xspec_is_not_available
+def test_xspec_integral():
+
+    import numpy as np
+    import astropy.units as u
+    import scipy.integrate
+    from astromodels.xspec import XS_powerlaw, XS_bbody
+
+    edges = np.logspace(0, 1, 11)
+
+    for function in [XS_powerlaw(phoindex=1.7), XS_bbody(kt=2.0)]:
+
+        integrals = function.integral(edges)
+
+        assert integrals.shape == (10,)
+
+        # Compare with the numerical integration of the differential flux
+
+        for e1, e2, integral in zip(edges[:-1], edges[1:], integrals):
+
+            expected = scipy.integrate.quad(lambda e: function.evaluate(np.array([e]),
+                                                                        *[p.value for p in
+                                                                          function.parameters.values()])[0],
+                                            e1, e2)[0]
+
+            assert np.isclose(integral, expected, rtol=1e-4)
+
+        # Bounds given separately, and not sorted
+
+        idx = np.random.permutation(10)
+
+        assert np.allclose(function.integral(edges[:-1][idx], edges[1:][idx]), integrals[idx], rtol=1e-12)
+
+        # Only one bin
+
+        assert np.allclose(function.integral(edges[:2]), integrals[:1], rtol=1e-12)
+
+        # Units
+
+        integrals_quantity = function.integral(edges * u.keV)
+
+        assert integrals_quantity.unit == u.Unit('1 / (cm2 s)')
+        assert np.allclose(integrals_quantity.value, integrals, rtol=1e-12)
+
+
+@skip_if_xspec_is_not_available
+def test_xspec_process_pool():
+
+    import numpy as np
+    from astromodels.xspec import XspecProcessPool, XS_powerlaw, XS_bbody
+
+    edges = np.logspace(0, 1, 11)
+
+    functions = [XS_powerlaw(phoindex=1.7), XS_bbody(kt=2.0)]
+
+    with XspecProcessPool(2) as pool:
+
+        for function, result in zip(functions, pool.evaluate(functions, edges)):
+
+            assert np.allclose(result, function(edges), rtol=1e-12)
+
+        for function, result in zip(functions, pool.integral(functions, edges)):
+
+            assert np.allclose(result, function.integral(edges), rtol=1e-12)
@@ -12,6 +12,7 @@ from astromodels.functions.priors import Uniform_prior
 from astromodels.functions.functions_2D import Gaussian_on_sphere
 from astromodels.core.parameter import Parameter, IndependentVariable
 from astromodels.core.model_parser import *
+from astromodels.utils.bounding_box_index import is_inside_boundaries
 from astromodels import u
 import numpy as np
 
@@ -748,3 +749,112 @@ def test_model_parser():
         _ = ModelParser("__test.yml")
 
     os.remove("__test.yml")
+
+
+def test_extended_sources_index():
+
+    sources = [ExtendedSource("ext1", Gaussian_on_sphere(lon0=10.0, lat0=20.0), Powerlaw()),
+               ExtendedSource("ext2", Gaussian_on_sphere(lon0=355.0, lat0=-30.0), Powerlaw()),
+               ExtendedSource("ext3", Gaussian_on_sphere(lon0=180.0, lat0=80.0), Powerlaw())]
+
+    m = Model(*sources)
+
+    for source in sources:
+
+        source.spatial_shape.sigma.max_value = 5.0
+
+    ra = np.random.uniform(-180.0, 360.0, 20000)
+    dec = np.random.uniform(-90.0, 90.0, 20000)
+
+    def check():
+
+        expected = np.array(map(lambda source: is_inside_boundaries(ra, dec, source.get_boundaries()), sources))
+
+        point_indices, source_ids = m.find_extended_sources_containing(ra, dec)
+
+        found = np.zeros_like(expected)
+        found[source_ids, point_indices] = True
+
+        assert np.all(found == expected)
+
+        assert np.all(m.is_inside_any_extended_source(ra, dec) == np.any(expected, axis=0))
+
+    check()
+
+    # A source crossing lon = 0
+
+    assert m.is_inside_any_extended_source(358.0, -30.0) is True
+    assert m.is_inside_any_extended_source(-2.0, -30.0) is True
+    assert m.is_inside_any_extended_source(3.0, -30.0) is True
+    assert m.is_inside_any_extended_source(100.0, -30.0) is False
+
+    # Changing the parameters must update the index
+
+    sources[1].spatial_shape.lon0 = 100.0
+
+    assert m.is_inside_any_extended_source(100.0, -30.0) is True
+    assert m.is_inside_any_extended_source(358.0, -30.0) is False
+
+    check()
+
+
+def test_to_healpix_cube():
+
+    from astromodels.functions.functions_2D import Disk_on_sphere
+    from astromodels.utils.healpix import get_pixel_index, get_pixel_centers, nest_to_ring
+
+    pts = PointSource("pts", ra=10.0, dec=20.0, spectral_shape=Powerlaw())
+    gauss = ExtendedSource("gauss", Gaussian_on_sphere(lon0=100.0, lat0=-30.0, sigma=2.0), Powerlaw(index=-2.5))
+    disk = ExtendedSource("disk", Disk_on_sphere(lon0=359.0, lat0=0.0, radius=3.0), Powerlaw(index=-1.5))
+
+    m = Model(pts, gauss, disk)
+
+    nside = 64
+    energies = np.logspace(1, 3, 4)
+
+    cube = m.to_healpix_cube(nside, energies)
+
+    assert cube.shape == (4, 12 * nside ** 2)
+
+    # The extended sources are evaluated on sub-grids of the pixel centers, which keep their unit vectors
+
+    from astromodels.utils.healpix import get_healpix_geometry
+
+    sky_grid = get_healpix_geometry(nside).sky_grid
+
+    assert len(sky_grid._subgrids) > 0
+
+    (_, _), (min_lat, max_lat) = disk.get_boundaries()
+
+    start, stop = get_healpix_geometry(nside).get_latitude_range(min_lat, max_lat)
+
+    assert (start, stop) in sky_grid._subgrids
+
+    # The point source is in its pixel
+
+    pixel = get_pixel_index(nside, 10.0, 20.0)[0]
+
+    assert np.allclose(cube[:, pixel], pts(energies), rtol=1e-12)
+
+    # The extended sources are normalized to 1, so the total flux is the sum of the spectra (apart from the
+    # pixelization of the disk)
+
+    total = pts(energies) + gauss.spectrum.main.shape(energies) + disk.spectrum.main.shape(energies)
+
+    assert np.allclose(cube.sum(axis=1), total, rtol=0.02)
+
+    # The other pixels contain the brightness at their center times their solid angle
+
+    lon, lat = get_pixel_centers(nside, np.arange(12 * nside ** 2))
+
+    others = np.arange(12 * nside ** 2) != pixel
+
+    expected = ((gauss(lon, lat, energies) + disk(lon, lat, energies)) * 4 * np.pi / (12 * nside ** 2)).T
+
+    assert np.allclose(cube[:, others], expected[:, others], rtol=1e-10, atol=1e-5 * expected.max())
+
+    # NESTED scheme
+
+    cube_nest = m.to_healpix_cube(nside, energies, nest=True)
+
+    assert np.all(cube_nest == cube[:, nest_to_ring(nside, np.arange(12 * nside ** 2))])
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from astromodels.functions.function import FunctionMeta, Function1D, _known_functions
+from astromodels.functions.functions import Powerlaw, Line
+from astromodels.functions.process_pool import FunctionProcessPool
+
+
+def test_process_pool():
+
+    energies = np.logspace(0, 3, 50)
+
+    functions = [Powerlaw(index=-1.5), Powerlaw(index=-2.5), Line(a=2.0, b=3.0)]
+
+    # The buffers are smaller than the input, so they must be enlarged. There are more functions than workers, so
+    # they are evaluated in two batches
+
+    with FunctionProcessPool(2, buffer_size=10) as pool:
+
+        results = pool.evaluate(functions, energies)
+
+        assert len(results) == 3
+
+        for function, result in zip(functions, results):
+
+            assert np.allclose(result, function(energies), rtol=1e-12)
+
+        # This class is created after the workers have been started, so they cannot know it and its evaluation fails
+
+        class Test_pool_function(Function1D):
+            r"""
+            description :
+
+                A test function
+
+            parameters :
+
+                a :
+
+                    desc : linear coefficient
+                    initial value : 1
+
+            """
+
+            __metaclass__ = FunctionMeta
+
+            def _set_units(self, x_unit, y_unit):
+
+                self.a.unit = y_unit / x_unit
+
+            def evaluate(self, x, a):
+
+                return a * x
+
+        try:
+
+            with pytest.raises(RuntimeError):
+
+                _ = pool.evaluate([Test_pool_function(), functions[0]], energies)
+
+        finally:
+
+            _known_functions.pop("Test_pool_function")
+
+        # The failure must not affect the next evaluations (the other workers of the failed batch must not leave
+        # their replies behind). Use a different number of energies, so that a stale reply cannot go unnoticed
+
+        new_energies = np.logspace(0, 2, 20)
+
+        for i in range(3):
+
+            functions[1].index = -2.0 - i / 10.0
+
+            results = pool.evaluate(functions[1:], new_energies)
+
+            assert results[0].shape == results[1].shape == (20,)
+
+            assert np.allclose(results[0], functions[1](new_energies), rtol=1e-12)
+            assert np.allclose(results[1], functions[2](new_energies), rtol=1e-12)
+
+    # The pool can be restarted after being closed
+
+    results = pool.evaluate(functions[:1], energies)
+
+    assert np.allclose(results[0], functions[0](energies), rtol=1e-12)
+
+    pool.close()
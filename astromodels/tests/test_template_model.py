@@ -1,8 +1,16 @@
 import pytest
 import os
 import numpy as np
-
-from astromodels.functions.template_model import TemplateModel, TemplateModelFactory, MissingDataFile
+import scipy.interpolate
+import shutil
+import pandas as pd
+import astropy.units as u
+
+from astromodels.functions.template_model import TemplateModel, TemplateModelFactory, MissingDataFile, \
+    ValuesNotInGrid, convert_legacy_template
+from astromodels.utils.configuration import get_user_data_path
+from astromodels.core.parameter import SettingOutOfBounds
+from astromodels.core.memoization import use_astromodels_memoization
 from astromodels.functions.functions import Band, Powerlaw
 from astromodels import Model, PointSource, clone_model, load_model
 import pickle
@@ -17,6 +25,20 @@ def get_comparison_function():
 
     return mo
 
+
+def band_generator(energies, alpha, xp):
+
+    mo = get_comparison_function()
+    mo.alpha = alpha
+    mo.xp = xp
+
+    return mo(energies)
+
+
+def failing_generator(energies, **parameters_values):
+
+    raise RuntimeError("This should not be called")
+
 @pytest.mark.slow
 def test_template_factory():
 
@@ -96,6 +118,481 @@ def test_template_function():
                                          "with parameters %s!" % (new_energies[idx], deltas[idx], [a,b,xp]))
 
 
+def test_template_interpolation():
+
+    # Linear interpolation (3 parameters) must match the RegularGridInterpolator for each energy
+
+    tm = TemplateModel('__test')
+
+    parameters_values = [0.3, 150.0, -2.2]
+
+    log_values = tm._template_data.interpolate_parameters(parameters_values)
+
+    for i in range(tm._template_data.log_data.shape[-1]):
+
+        interpolator = scipy.interpolate.RegularGridInterpolator(tm._template_data.grids,
+                                                                 tm._template_data.log_data[..., i])
+
+        assert np.allclose(log_values[i], interpolator(parameters_values)[0])
+
+    # The linear interpolation in energy is a sparse matrix with two elements per row, which must match the linear
+    # spline in log space (also when extrapolating)
+
+    new_energies = np.logspace(0.5, 3.5, 77)
+
+    interpolation_matrix = tm._template_data.compute_energy_interpolation_matrix(new_energies, 1.3)
+
+    assert interpolation_matrix.shape == (77, tm._template_data.energies.shape[0])
+    assert interpolation_matrix.nnz == 2 * 77
+
+    spline = scipy.interpolate.InterpolatedUnivariateSpline(np.log10(tm._template_data.energies * 1.3),
+                                                            log_values, k=1, ext=0)
+
+    assert np.allclose(interpolation_matrix.dot(log_values), spline(np.log10(new_energies)))
+
+    # Scalar input
+
+    value = tm.evaluate(100.0, 1.0, 1.0, *parameters_values)
+
+    assert np.ndim(value) == 0
+    assert np.allclose(value, tm.evaluate(np.array([100.0]), 1.0, 1.0, *parameters_values))
+
+    # Spline interpolation (2 parameters) must match the RectBivariateSpline for each energy
+
+    mo = get_comparison_function()
+
+    energies = np.logspace(1, 3, 30)
+
+    t = TemplateModelFactory('__test_spline', 'A test template', energies, ['alpha', 'xp'], interpolation_degree=3)
+
+    alpha_grid = np.linspace(-1.5, 1, 8)
+    xp_grid = np.logspace(1, 3, 9)
+
+    t.define_parameter_grid('alpha', alpha_grid)
+    t.define_parameter_grid('xp', xp_grid)
+
+    for a in alpha_grid:
+
+        for xp in xp_grid:
+
+            mo.alpha = a
+            mo.xp = xp
+
+            t.add_interpolation_data(mo(energies), alpha=a, xp=xp)
+
+    t.save_data(overwrite=True)
+
+    tm = TemplateModel('__test_spline')
+
+    for parameters_values in ([0.3, 150.0], [-1.2, 900.0], [1.0, 10.0]):
+
+        log_values = tm._template_data.interpolate_parameters(parameters_values)
+
+        for i in range(energies.shape[0]):
+
+            interpolator = scipy.interpolate.RectBivariateSpline(alpha_grid, xp_grid,
+                                                                 tm._template_data.log_data[..., i],
+                                                                 kx=3, ky=3, s=0)
+
+            assert np.allclose(log_values[i], interpolator(*parameters_values)[0][0])
+
+    # The cached interpolation in energy must match the spline in log space
+
+    new_energies = np.logspace(0.5, 3.5, 77)
+
+    for scale in [1.0, 1.7, 1.0]:
+
+        tm.scale = scale
+
+        log_values = tm._template_data.interpolate_parameters([tm.alpha.value, tm.xp.value])
+
+        spline = scipy.interpolate.InterpolatedUnivariateSpline(np.log10(tm._template_data.energies * scale),
+                                                                log_values, k=3, ext=0)
+
+        assert np.allclose(tm(new_energies), np.power(10, spline(np.log10(new_energies))) / scale)
+
+    assert len(tm._energy_interpolation_cache) == 2
+
+    # The cache keeps the 10 most recently used matrices
+
+    first_matrix = tm._get_energy_interpolation_matrix(new_energies, 1.0)
+
+    for scale in np.linspace(2.0, 3.0, 9):
+
+        _ = tm._get_energy_interpolation_matrix(new_energies, scale)
+
+        assert tm._get_energy_interpolation_matrix(new_energies, 1.0) is first_matrix
+
+    assert len(tm._energy_interpolation_cache) == 10
+
+    assert (1.7, new_energies.size) not in map(lambda key: key[:2], tm._energy_interpolation_cache.keys())
+
+
+def test_template_many_instances():
+
+    # Many sources using the same template share its data, but each has its own cache of interpolation matrices
+
+    instances = map(lambda i: TemplateModel('__test'), range(12))
+
+    for i, tm in enumerate(instances):
+
+        tm.scale = 1.0 + 0.1 * i
+        tm.scale.fix = True
+
+    template_data = instances[0]._template_data
+
+    assert all(map(lambda tm: tm._template_data is template_data, instances))
+
+    n_computed = []
+
+    compute_energy_interpolation_matrix = template_data.compute_energy_interpolation_matrix
+
+    def counting_compute(energies, scale):
+
+        n_computed.append(scale)
+
+        return compute_energy_interpolation_matrix(energies, scale)
+
+    template_data.compute_energy_interpolation_matrix = counting_compute
+
+    new_energies = np.logspace(1, 3, 40)
+
+    try:
+
+        with use_astromodels_memoization(False):
+
+            for _ in range(5):
+
+                for tm in instances:
+
+                    _ = tm(new_energies)
+
+    finally:
+
+        del template_data.compute_energy_interpolation_matrix
+
+    # Each matrix has been computed only once
+
+    assert len(n_computed) == 12
+
+    assert all(map(lambda tm: len(tm._energy_interpolation_cache) == 1, instances))
+
+
+def test_template_partial_loading():
+
+    # NOTE: memoization is shared between instances, so we need to disable it to compare different instances
+
+    with use_astromodels_memoization(False):
+
+        _test_template_partial_loading()
+
+
+def _test_template_partial_loading():
+
+    new_energies = np.logspace(1.3, 2.7, 33)
+
+    # Energy window (the linear interpolation within the window is unchanged)
+
+    tm = TemplateModel('__test')
+    tm.alpha = 0.3
+    tm.xp = 150.0
+    tm.beta = -2.2
+
+    tm_window = TemplateModel('__test', e_min=20.0, e_max=500 * u.keV)
+    tm_window.alpha = 0.3
+    tm_window.xp = 150.0
+    tm_window.beta = -2.2
+
+    assert tm_window._template_data.energies.shape[0] < tm._template_data.energies.shape[0]
+    assert np.allclose(tm_window(new_energies), tm(new_energies))
+
+    # Fixed parameters are removed from the interpolation
+
+    tm_fixed = TemplateModel('__test', e_min=20.0, e_max=500.0, fixed_parameters={'beta': -2.2})
+    tm_fixed.alpha = 0.3
+    tm_fixed.xp = 150.0
+
+    assert tm_fixed._template_data.log_data.ndim == 3
+    assert np.allclose(tm_fixed(new_energies), tm(new_energies))
+
+    with pytest.raises(SettingOutOfBounds):
+
+        tm_fixed.beta.value = -2.0
+
+    # Copies share the same data
+
+    clone = pickle.loads(pickle.dumps(tm_fixed))
+
+    assert clone._template_data is tm_fixed._template_data
+    assert np.allclose(clone(new_energies), tm(new_energies))
+
+    # Same with a spline interpolation
+
+    tm = TemplateModel('__test_spline')
+    tm.alpha = -0.7
+    tm.xp = 150.0
+
+    tm_fixed = TemplateModel('__test_spline', fixed_parameters={'xp': 150.0})
+    tm_fixed.alpha = -0.7
+
+    assert np.allclose(tm_fixed(new_energies), tm(new_energies))
+
+    with pytest.raises(ValueError):
+
+        TemplateModel('__test_spline', fixed_parameters={'xp': 1e5})
+
+
+def test_template_single_precision():
+
+    with use_astromodels_memoization(False):
+
+        _test_template_single_precision()
+
+
+def _test_template_single_precision():
+
+    new_energies = np.logspace(1, 3, 77)
+
+    for model_name, parameters_values in [('__test', {'alpha': 0.3, 'xp': 150.0, 'beta': -2.2}),
+                                          ('__test_spline', {'alpha': -0.7, 'xp': 170.0})]:
+
+        tm = TemplateModel(model_name)
+        tm_single = TemplateModel(model_name, single_precision=True)
+
+        assert tm_single._template_data.log_data.dtype == np.float32
+
+        for parameter_name, value in parameters_values.items():
+
+            tm.parameters[parameter_name].value = value
+            tm_single.parameters[parameter_name].value = value
+
+        # This is the accuracy bound stated in the documentation
+
+        tolerance = 1e-6 * np.abs(tm._template_data.log_data).max()
+
+        assert np.allclose(tm_single(new_energies), tm(new_energies), rtol=tolerance, atol=0)
+
+    # Template saved in single precision
+
+    energies = np.logspace(1, 3, 20)
+
+    t = TemplateModelFactory('__test_single', 'A test template', energies, ['alpha', 'xp'], single_precision=True)
+
+    t.define_parameter_grid('alpha', np.linspace(-1.5, 1, 5))
+    t.define_parameter_grid('xp', np.logspace(1, 3, 6))
+
+    t.fill_grid(band_generator)
+
+    t.save_data(overwrite=True)
+
+    tm_single = TemplateModel('__test_single')
+    tm_single.alpha = 0.3
+    tm_single.xp = 150.0
+
+    assert isinstance(tm_single._template_data.log_data, np.memmap)
+    assert tm_single._template_data.log_data.dtype == np.float32
+
+    reference = TemplateModelFactory('__test_single', 'A test template', energies, ['alpha', 'xp'])
+
+    reference.define_parameter_grid('alpha', np.linspace(-1.5, 1, 5))
+    reference.define_parameter_grid('xp', np.logspace(1, 3, 6))
+
+    reference.fill_grid(band_generator)
+
+    reference.save_data(overwrite=True)
+
+    tm = TemplateModel('__test_single')
+    tm.alpha = 0.3
+    tm.xp = 150.0
+
+    assert tm._template_data.log_data.dtype == np.float64
+    assert np.allclose(tm_single(energies), tm(energies), rtol=1e-6 * np.abs(reference._log_data).max(), atol=0)
+
+
+def test_template_factory_bulk(tmpdir):
+
+    energies = np.logspace(1, 3, 20)
+
+    alpha_grid = np.linspace(-1.5, 1, 5)
+    xp_grid = np.logspace(1, 3, 6)
+
+    def get_factory():
+
+        t = TemplateModelFactory('__test_bulk', 'A test template', energies, ['alpha', 'xp'])
+
+        t.define_parameter_grid('alpha', alpha_grid)
+        t.define_parameter_grid('xp', xp_grid)
+
+        return t
+
+    # Reference: one point at the time
+
+    t1 = get_factory()
+
+    for a in alpha_grid:
+
+        for xp in xp_grid:
+
+            t1.add_interpolation_data(band_generator(energies, a, xp), alpha=a, xp=xp)
+
+    # All points at once (in a different order)
+
+    t2 = get_factory()
+
+    parameters_values = np.array([[a, xp] for xp in xp_grid for a in alpha_grid])
+
+    t2.add_interpolation_data_bulk(parameters_values, map(lambda (a, xp): band_generator(energies, a, xp),
+                                                          parameters_values))
+
+    assert np.all(t2._log_data == t1._log_data)
+
+    with pytest.raises(ValuesNotInGrid):
+
+        t2.add_interpolation_data_bulk([[0.123, 10.0]], [band_generator(energies, 0.123, 10.0)])
+
+    # Using a pool of processes, with checkpoints
+
+    checkpoint_file = str(tmpdir.join('__test_bulk_checkpoint.npy'))
+
+    t3 = get_factory()
+
+    t3.fill_grid(band_generator, n_workers=2, checkpoint_file=checkpoint_file, checkpoint_interval=7)
+
+    assert np.allclose(t3._log_data, t1._log_data)
+
+    # Everything is in the checkpoint, so nothing needs to be computed
+
+    t4 = get_factory()
+
+    t4.fill_grid(failing_generator, checkpoint_file=checkpoint_file)
+
+    assert np.allclose(t4._log_data, t1._log_data)
+
+    # An interrupted run is resumed from the last checkpoint
+
+    computed = []
+    max_points = [10]
+
+    def interrupted_generator(energies, alpha, xp):
+
+        if len(computed) == max_points[0]:
+
+            raise RuntimeError("Interrupted")
+
+        computed.append((alpha, xp))
+
+        return band_generator(energies, alpha, xp)
+
+    interrupted_checkpoint_file = str(tmpdir.join('__test_bulk_interrupted.npy'))
+
+    t5 = get_factory()
+
+    with pytest.raises(RuntimeError):
+
+        t5.fill_grid(interrupted_generator, checkpoint_file=interrupted_checkpoint_file, checkpoint_interval=4)
+
+    assert np.load(str(tmpdir.join('__test_bulk_interrupted.completed.npy'))).sum() == 8
+
+    del computed[:]
+    max_points[0] = None
+
+    t6 = get_factory()
+
+    t6.fill_grid(interrupted_generator, checkpoint_file=interrupted_checkpoint_file, checkpoint_interval=4)
+
+    assert len(computed) == 22
+
+    assert np.allclose(t6._log_data, t1._log_data)
+
+    t4.save_data(overwrite=True)
+
+    tm = TemplateModel('__test_bulk')
+    tm.alpha = alpha_grid[2]
+    tm.xp = xp_grid[3]
+
+    assert np.allclose(tm(energies), band_generator(energies, alpha_grid[2], xp_grid[3]))
+
+
+def test_template_factory_streaming():
+
+    energies = np.logspace(1, 3, 20)
+
+    alpha_grid = np.linspace(-1.5, 1, 5)
+    xp_grid = np.logspace(1, 3, 6)
+
+    def get_factory(streaming):
+
+        t = TemplateModelFactory('__test_streaming', 'A test template', energies, ['alpha', 'xp'],
+                                 streaming=streaming)
+
+        t.define_parameter_grid('alpha', alpha_grid)
+        t.define_parameter_grid('xp', xp_grid)
+
+        return t
+
+    reference = get_factory(False)
+
+    reference.fill_grid(band_generator)
+
+    if os.path.exists(reference._work_directory):
+
+        shutil.rmtree(reference._work_directory)
+
+    # Fill only part of the grid, then "crash"
+
+    t1 = get_factory(True)
+
+    parameters_values = t1.get_missing_points()
+
+    assert parameters_values.shape == (30, 2)
+
+    t1.add_interpolation_data_bulk(parameters_values[:12], map(lambda (a, xp): band_generator(energies, a, xp),
+                                                               parameters_values[:12]))
+
+    assert not t1.is_complete()
+
+    with pytest.raises(AssertionError):
+
+        t1.save_data(overwrite=True)
+
+    del t1
+
+    # Resume
+
+    t2 = get_factory(True)
+
+    assert t2.get_missing_points().shape == (18, 2)
+
+    t2.fill_grid(band_generator, checkpoint_interval=5)
+
+    assert t2.is_complete()
+
+    t2.save_data(overwrite=True)
+
+    assert not os.path.exists(t2._work_directory)
+
+    tm = TemplateModel('__test_streaming')
+
+    assert np.allclose(tm._template_data.log_data, reference._log_data)
+
+    # A partial template with different grids cannot be resumed
+
+    t3 = get_factory(True)
+
+    t3.add_interpolation_data(band_generator(energies, alpha_grid[0], xp_grid[0]), alpha=alpha_grid[0], xp=xp_grid[0])
+
+    t4 = TemplateModelFactory('__test_streaming', 'A test template', energies, ['alpha', 'xp'], streaming=True)
+
+    t4.define_parameter_grid('alpha', alpha_grid[:-1])
+    t4.define_parameter_grid('xp', xp_grid)
+
+    with pytest.raises(IOError):
+
+        t4.get_missing_points()
+
+    shutil.rmtree(t3._work_directory)
+
+
 def test_input_output():
 
     tm = TemplateModel('__test')
@@ -118,6 +615,73 @@ def test_input_output():
 
     assert np.allclose(clone.test.spectrum.main.shape(xx), fake_model.test.spectrum.main.shape(xx))
 
+    # Instances and clones of the same template share its data
+
+    assert TemplateModel('__test')._template_data is tm._template_data
+    assert clone.test.spectrum.main.shape._template_data is tm._template_data
+
+    # A template without options is saved as before
+
+    assert 'template_options' not in tm.to_dict()
+
+    # The options used to load a template are saved with the model
+
+    tm_options = TemplateModel('__test', other_name='my_template', e_min=20.0, e_max=500.0,
+                               fixed_parameters={'beta': -2.2})
+    tm_options.alpha = 0.3
+
+    model_options = Model(PointSource("test", ra=0.0, dec=0.0, spectral_shape=tm_options))
+
+    for restored_model in [clone_model(model_options), pickle.loads(pickle.dumps(model_options))]:
+
+        restored = restored_model.test.spectrum.main.my_template
+
+        assert restored._template_data is tm_options._template_data
+        assert restored.beta.value == -2.2
+        assert restored.alpha.value == 0.3
+
+        with pytest.raises(SettingOutOfBounds):
+
+            restored.beta.value = -2.0
+
+        assert np.allclose(restored(xx), tm_options(xx))
+
+    model_options.save("__test_options.yml", overwrite=True)
+
+    restored = load_model("__test_options.yml").test.spectrum.main.my_template
+
+    os.remove("__test_options.yml")
+
+    assert restored._template_data is tm_options._template_data
+    assert np.allclose(restored(xx), tm_options(xx))
+
+    # Also as part of a composite function
+
+    composite = tm_options * Powerlaw() + TemplateModel('__test', e_min=10.0)
+
+    assert sorted(composite.to_dict()['template_options'].keys()) == ['__test{3}', 'my_template{1}']
+
+    model_composite = Model(PointSource("test", ra=0.0, dec=0.0, spectral_shape=composite))
+
+    for restored_model in [clone_model(model_composite), pickle.loads(pickle.dumps(model_composite))]:
+
+        restored = restored_model.test.spectrum.main.shape
+
+        assert restored.functions[0]._template_data is tm_options._template_data
+        assert restored.functions[0].name == 'my_template'
+        assert restored.functions[2]._template_data is composite.functions[2]._template_data
+        assert restored.beta_1.value == -2.2
+
+        assert np.allclose(restored(xx), composite(xx))
+
+    model_composite.save("__test_options.yml", overwrite=True)
+
+    restored = load_model("__test_options.yml").test.spectrum.main.shape
+
+    os.remove("__test_options.yml")
+
+    assert np.allclose(restored(xx), composite(xx))
+
     # Test pickling
     dump = pickle.dumps(clone)
 
@@ -126,6 +690,7 @@ def test_input_output():
     assert clone2.get_number_of_point_sources() == 1
     assert tm.data_file == clone2.test.spectrum.main.shape.data_file
     assert np.allclose(clone2.test.spectrum.main.shape(xx), fake_model.test.spectrum.main.shape(xx))
+    assert clone2.test.spectrum.main.shape._template_data is tm._template_data
 
     # Test pickling with other functions
     new_shape = tm * Powerlaw()
@@ -153,3 +718,84 @@ def test_input_output():
 
     os.remove("__test.yml")
 
+
+
+def test_legacy_template_conversion():
+
+    # Write a template in the format used by previous versions of astromodels
+
+    mo = get_comparison_function()
+
+    energies = np.logspace(1, 3, 20)
+
+    alpha_grid = np.linspace(-1.5, 1, 5)
+    xp_grid = np.logspace(1, 3, 6)
+
+    data_frame = pd.DataFrame(index=pd.MultiIndex.from_product([alpha_grid, xp_grid], names=['alpha', 'xp']),
+                              columns=energies)
+
+    for a in alpha_grid:
+
+        for xp in xp_grid:
+
+            mo.alpha = a
+            mo.xp = xp
+
+            data_frame.loc[(a, xp)] = pd.to_numeric(mo(energies))
+
+    for column in data_frame.columns:
+
+        data_frame[column] = pd.to_numeric(data_frame[column])
+
+    legacy_file = os.path.join(get_user_data_path(), '__test_legacy.h5')
+
+    if os.path.exists(legacy_file):
+
+        os.remove(legacy_file)
+
+    shutil.rmtree(os.path.join(get_user_data_path(), '__test_legacy.template'), ignore_errors=True)
+
+    with pd.HDFStore(legacy_file) as store:
+
+        data_frame.to_hdf(store, 'data_frame')
+
+        store.get_storer('data_frame').attrs.metadata = {'description': 'A legacy template',
+                                                         'name': '__test_legacy',
+                                                         'interpolation_degree': 1,
+                                                         'spline_smoothing_factor': 0}
+
+        store['p_0_alpha'] = pd.Series(alpha_grid)
+        store['p_1_xp'] = pd.Series(xp_grid)
+        store['energies'] = pd.Series(energies)
+
+    # The template is converted automatically when used
+
+    tm = TemplateModel('__test_legacy')
+
+    tm.alpha = mo.alpha.value
+    tm.xp = mo.xp.value
+
+    assert np.allclose(tm(energies), mo(energies))
+
+    # The converted template must exist now, so a new conversion must fail unless we overwrite
+
+    with pytest.raises(IOError):
+
+        convert_legacy_template('__test_legacy')
+
+    convert_legacy_template('__test_legacy', overwrite=True)
+
+    os.remove(legacy_file)
+
+    tm = TemplateModel('__test_legacy')
+
+    tm.alpha = mo.alpha.value
+    tm.xp = mo.xp.value
+
+    assert np.allclose(tm(energies), mo(energies))
+
+    shutil.rmtree(tm.data_file)
+
+    with pytest.raises(MissingDataFile):
+
+        _ = TemplateModel('__test_legacy')
@@ -0,0 +1,167 @@
+import numpy as np
+
+
+def is_inside_boundaries(lon, lat, boundaries):
+    """
+    Returns a boolean mask which is True for the points inside the provided boundaries (as returned by
+    get_boundaries). The longitude range can wrap around 360 (i.e., min. lon > max. lon)
+
+    :param lon: longitudes (deg)
+    :param lat: latitudes (deg)
+    :param boundaries: a tuple of tuples ((min. lon, max. lon), (min lat, max lat))
+    :return: boolean array
+    """
+
+    (min_lon, max_lon), (min_lat, max_lat) = boundaries
+
+    inside = (lat >= min_lat) & (lat <= max_lat)
+
+    if max_lon - min_lon < 360.0:
+
+        # Measure the longitudes starting from the minimum one, so that the wrapping is handled automatically
+
+        inside &= np.mod(lon - min_lon, 360.0) <= np.mod(max_lon - min_lon, 360.0)
+
+    return inside
+
+
+class BoundingBoxIndex(object):
+    """
+    A spatial index for a set of boxes on the sky (as returned by get_boundaries), which allows to find quickly
+    the boxes containing many points. The sky is divided in cells, and each cell keeps the list of the boxes
+    overlapping it, so that each point is only checked against the few boxes in its cell.
+
+    :param boundaries: list of boundaries, each one a tuple of tuples ((min. lon, max. lon), (min lat, max lat)).
+    The longitude range can wrap around 360 (i.e., min. lon > max. lon)
+    :param cell_size: size of the cells of the index (deg)
+    """
+
+    def __init__(self, boundaries, cell_size=5.0):
+
+        self._n_boxes = len(boundaries)
+
+        self._cell_size = float(cell_size)
+        self._n_lon_cells = int(np.ceil(360.0 / self._cell_size))
+        self._n_lat_cells = int(np.ceil(180.0 / self._cell_size))
+
+        # Store the boxes as arrays, with the longitude range as (min. lon, width) so that the test for the points
+        # is the same as in is_inside_boundaries
+
+        self._min_lon = np.zeros(self._n_boxes)
+        self._lon_width = np.zeros(self._n_boxes)
+        self._min_lat = np.zeros(self._n_boxes)
+        self._max_lat = np.zeros(self._n_boxes)
+
+        cells = []
+        boxes = []
+
+        for i, ((min_lon, max_lon), (min_lat, max_lat)) in enumerate(boundaries):
+
+            if max_lon - min_lon >= 360.0:
+
+                min_lon, width = 0.0, 360.0
+
+            else:
+
+                min_lon, width = np.mod(min_lon, 360.0), np.mod(max_lon - min_lon, 360.0)
+
+            self._min_lon[i] = min_lon
+            self._lon_width[i] = width
+            self._min_lat[i] = min_lat
+            self._max_lat[i] = max_lat
+
+            # Now find the cells overlapping this box
+
+            lat_cells = np.arange(self._get_lat_cell(min_lat), self._get_lat_cell(max_lat) + 1)
+
+            first_lon_cell = self._get_lon_cell(min_lon)
+            n_lon_cells = min(int(np.floor((min_lon + width) / self._cell_size)) - first_lon_cell + 1,
+                              self._n_lon_cells)
+
+            lon_cells = np.mod(first_lon_cell + np.arange(n_lon_cells), self._n_lon_cells)
+
+            box_cells = (lat_cells[:, np.newaxis] * self._n_lon_cells + lon_cells[np.newaxis, :]).flatten()
+
+            cells.append(box_cells)
+            boxes.append(np.zeros(box_cells.shape[0], int) + i)
+
+        # Sort by cell, so that the boxes overlapping cell c are self._cell_boxes[offsets[c]:offsets[c + 1]]
+
+        cells = np.concatenate(cells) if len(cells) > 0 else np.zeros(0, int)
+        boxes = np.concatenate(boxes) if len(boxes) > 0 else np.zeros(0, int)
+
+        order = np.argsort(cells, kind='mergesort')
+
+        self._cell_boxes = boxes[order]
+
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(cells,
+                                                                   minlength=self._n_lon_cells * self._n_lat_cells))])
+
+    @property
+    def n_boxes(self):
+
+        return self._n_boxes
+
+    def _get_lon_cell(self, lon):
+
+        return np.minimum(np.floor(lon / self._cell_size).astype(int), self._n_lon_cells - 1)
+
+    def _get_lat_cell(self, lat):
+
+        return np.clip(np.floor((lat + 90.0) / self._cell_size).astype(int), 0, self._n_lat_cells - 1)
+
+    def find(self, lon, lat):
+        """
+        Finds the boxes containing the provided points
+
+        :param lon: longitudes of the points (deg)
+        :param lat: latitudes of the points (deg)
+        :return: a tuple (point_indices, box_indices) of arrays, where each pair of elements means that the point
+        point_indices[i] is inside the box box_indices[i]
+        """
+
+        lon = np.mod(np.array(lon, dtype=float, ndmin=1, copy=False), 360.0)
+        lat = np.array(lat, dtype=float, ndmin=1, copy=False)
+
+        cells = self._get_lat_cell(lat) * self._n_lon_cells + self._get_lon_cell(lon)
+
+        # Make the list of all the candidate pairs (point, box), i.e., of the boxes overlapping the cell
+        # of each point
+
+        starts = self._offsets[cells]
+        counts = self._offsets[cells + 1] - starts
+
+        point_indices = np.repeat(np.arange(lon.shape[0]), counts)
+
+        # Position of each pair within the list of the boxes of its cell
+
+        positions = np.arange(point_indices.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        box_indices = self._cell_boxes[np.repeat(starts, counts) + positions]
+
+        # Now check the candidates exactly
+
+        p_lon = lon[point_indices]
+        p_lat = lat[point_indices]
+
+        inside = (p_lat >= self._min_lat[box_indices]) & (p_lat <= self._max_lat[box_indices]) & \
+                 ((self._lon_width[box_indices] >= 360.0) |
+                  (np.mod(p_lon - self._min_lon[box_indices], 360.0) <= self._lon_width[box_indices]))
+
+        return point_indices[inside], box_indices[inside]
+
+    def is_inside_any(self, lon, lat):
+        """
+        Returns a boolean mask which is True for the points inside at least one of the boxes
+
+        :param lon: longitudes of the points (deg)
+        :param lat: latitudes of the points (deg)
+        :return: boolean array
+        """
+
+        point_indices, _ = self.find(lon, lat)
+
+        mask = np.zeros(np.size(lon), bool)
+        mask[point_indices] = True
+
+        return mask
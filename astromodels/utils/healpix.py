@@ -0,0 +1,377 @@
+import collections
+
+import numpy as np
+
+from astromodels.utils.sky_grid import SkyGrid
+
+# Native implementation of the HEALPix pixelization (Gorski et al. 2005, ApJ 622, 759), with both the RING and the
+# NESTED schemes. All the angles are in degrees, as longitude and latitude (not as colatitude like in healpy)
+
+# Position of the 12 base pixels (faces) in the ring/longitude plane
+
+_jrll = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_jpll = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+def _check_nside(nside, nest):
+
+    assert nside >= 1 and int(nside) == nside, "nside must be a positive integer"
+
+    if nest:
+
+        assert (int(nside) & (int(nside) - 1)) == 0, "nside must be a power of 2 for the NESTED scheme"
+
+
+def get_number_of_pixels(nside):
+    """
+    Returns the number of pixels of a HEALPix map
+
+    :param nside: the nside of the map
+    :return: 12 * nside ** 2
+    """
+
+    return 12 * nside ** 2
+
+
+def _pix2ang_ring(nside, ipix):
+
+    # Returns z = cos(colatitude) and the longitude (rad) of the centers of the provided pixels (RING scheme)
+
+    ipix = np.array(ipix, dtype=np.int64, ndmin=1)
+
+    n_pixels = get_number_of_pixels(nside)
+    n_cap = 2 * nside * (nside - 1)
+
+    z = np.zeros(ipix.shape[0])
+    phi = np.zeros(ipix.shape[0])
+
+    # North polar cap
+
+    idx = ipix < n_cap
+
+    if np.any(idx):
+
+        p = ipix[idx]
+
+        i = ((1 + np.sqrt(1 + 2 * p)) // 2).astype(np.int64)
+        j = p - 2 * i * (i - 1) + 1
+
+        z[idx] = 1.0 - i ** 2 / (3.0 * nside ** 2)
+        phi[idx] = (j - 0.5) * np.pi / (2.0 * i)
+
+    # Equatorial belt
+
+    idx = (ipix >= n_cap) & (ipix < n_pixels - n_cap)
+
+    if np.any(idx):
+
+        p = ipix[idx] - n_cap
+
+        i = p // (4 * nside) + nside
+        j = p % (4 * nside) + 1
+
+        # The rings with i + nside odd start at longitude 0, the others are shifted by half a pixel
+
+        s = (i + nside) % 2
+
+        z[idx] = 4.0 / 3.0 - 2.0 * i / (3.0 * nside)
+        phi[idx] = (j - 0.5 - s / 2.0) * np.pi / (2.0 * nside)
+
+    # South polar cap
+
+    idx = ipix >= n_pixels - n_cap
+
+    if np.any(idx):
+
+        p = n_pixels - ipix[idx]
+
+        i = ((1 + np.sqrt(2 * p - 1)) // 2).astype(np.int64)
+        j = 4 * i + 1 - (p - 2 * i * (i - 1))
+
+        z[idx] = -1.0 + i ** 2 / (3.0 * nside ** 2)
+        phi[idx] = (j - 0.5) * np.pi / (2.0 * i)
+
+    return z, phi
+
+
+def _ang2pix_ring(nside, z, phi):
+
+    # Returns the pixels (RING scheme) containing the provided positions (z = cos(colatitude), longitude in rad)
+
+    n_pixels = get_number_of_pixels(nside)
+    n_cap = 2 * nside * (nside - 1)
+
+    za = np.abs(z)
+
+    # Longitude in units of 90 deg, in [0, 4)
+
+    tt = np.mod(phi, 2 * np.pi) / (np.pi / 2.0)
+    tt = np.where(tt >= 4.0, 0.0, tt)
+
+    ipix = np.zeros(z.shape[0], dtype=np.int64)
+
+    # Equatorial belt
+
+    idx = za <= 2.0 / 3.0
+
+    if np.any(idx):
+
+        temp1 = nside * (0.5 + tt[idx])
+        temp2 = nside * z[idx] * 0.75
+
+        jp = (temp1 - temp2).astype(np.int64)
+        jm = (temp1 + temp2).astype(np.int64)
+
+        ir = nside + 1 + jp - jm
+        kshift = 1 - (ir & 1)
+
+        ip = np.mod((jp + jm - nside + kshift + 1) // 2, 4 * nside)
+
+        ipix[idx] = n_cap + (ir - 1) * 4 * nside + ip
+
+    # Polar caps
+
+    idx = ~idx
+
+    if np.any(idx):
+
+        tp = tt[idx] - np.floor(tt[idx])
+        tmp = nside * np.sqrt(3 * (1 - za[idx]))
+
+        jp = (tp * tmp).astype(np.int64)
+        jm = ((1.0 - tp) * tmp).astype(np.int64)
+
+        ir = jp + jm + 1
+        ip = np.mod((tt[idx] * ir).astype(np.int64), 4 * ir)
+
+        ipix[idx] = np.where(z[idx] > 0, 2 * ir * (ir - 1) + ip, n_pixels - 2 * ir * (ir + 1) + ip)
+
+    return ipix
+
+
+def nest_to_ring(nside, ipix):
+    """
+    Converts pixel indices from the NESTED to the RING scheme
+
+    :param nside: the nside of the map (a power of 2)
+    :param ipix: pixel indices in the NESTED scheme
+    :return: pixel indices in the RING scheme
+    """
+
+    _check_nside(nside, True)
+
+    ipix = np.array(ipix, dtype=np.int64, ndmin=1)
+
+    n_pixels = get_number_of_pixels(nside)
+    n_cap = 2 * nside * (nside - 1)
+
+    # Face and position (ix, iy) within the face. The bits of the index within the face are interleaved bits
+    # of ix (even bits) and iy (odd bits)
+
+    face = ipix // (nside ** 2)
+    ipf = ipix % (nside ** 2)
+
+    ix = np.zeros_like(ipf)
+    iy = np.zeros_like(ipf)
+
+    for bit in range(int(np.log2(nside))):
+
+        ix |= ((ipf >> (2 * bit)) & 1) << bit
+        iy |= ((ipf >> (2 * bit + 1)) & 1) << bit
+
+    # Ring number (1 ... 4 nside - 1)
+
+    jr = _jrll[face] * nside - ix - iy - 1
+
+    nr = np.where(jr < nside, jr, np.where(jr > 3 * nside, 4 * nside - jr, nside))
+
+    n_before = np.where(jr < nside, 2 * nr * (nr - 1),
+                        np.where(jr > 3 * nside, n_pixels - 2 * (nr + 1) * nr, n_cap + (jr - nside) * 4 * nside))
+
+    kshift = np.where((jr >= nside) & (jr <= 3 * nside), (jr - nside) & 1, 0)
+
+    # Index within the ring (1 ... 4 nr)
+
+    jp = (_jpll[face] * nr + ix - iy + 1 + kshift) // 2
+
+    jp = np.where(jp > 4 * nside, jp - 4 * nside, jp)
+    jp = np.where(jp < 1, jp + 4 * nside, jp)
+
+    return n_before + jp - 1
+
+
+def ring_to_nest(nside, ipix):
+    """
+    Converts pixel indices from the RING to the NESTED scheme
+
+    :param nside: the nside of the map (a power of 2)
+    :param ipix: pixel indices in the RING scheme
+    :return: pixel indices in the NESTED scheme
+    """
+
+    return get_healpix_geometry(nside).get_ring_to_nest()[np.array(ipix, dtype=np.int64, ndmin=1)]
+
+
+def get_pixel_centers(nside, ipix, nest=False):
+    """
+    Returns the centers of the provided pixels
+
+    :param nside: the nside of the map
+    :param ipix: pixel indices
+    :param nest: whether the indices are in the NESTED scheme (default: False, i.e., RING)
+    :return: a tuple (lon, lat) of arrays (deg)
+    """
+
+    _check_nside(nside, nest)
+
+    if nest:
+
+        ipix = nest_to_ring(nside, ipix)
+
+    z, phi = _pix2ang_ring(nside, ipix)
+
+    return np.rad2deg(phi), np.rad2deg(np.arcsin(z))
+
+
+def get_pixel_index(nside, lon, lat, nest=False):
+    """
+    Returns the indices of the pixels containing the provided positions
+
+    :param nside: the nside of the map
+    :param lon: longitudes (deg)
+    :param lat: latitudes (deg)
+    :param nest: whether to return indices in the NESTED scheme (default: False, i.e., RING)
+    :return: pixel indices
+    """
+
+    _check_nside(nside, nest)
+
+    lon = np.array(lon, dtype=float, ndmin=1)
+    lat = np.array(lat, dtype=float, ndmin=1)
+
+    ipix = _ang2pix_ring(nside, np.sin(np.deg2rad(lat)), np.deg2rad(lon))
+
+    if nest:
+
+        ipix = ring_to_nest(nside, ipix)
+
+    return ipix
+
+
+class HealpixGeometry(object):
+    """
+    The pixel centers of a HEALPix map (RING scheme), computed once. Use get_healpix_geometry to get the (cached)
+    instance for a given nside.
+
+    :param nside: the nside of the map
+    """
+
+    def __init__(self, nside):
+
+        _check_nside(nside, False)
+
+        self._nside = nside
+        self._n_pixels = get_number_of_pixels(nside)
+
+        lon, lat = get_pixel_centers(nside, np.arange(self._n_pixels))
+
+        self._sky_grid = SkyGrid(lon, lat)
+
+        self._ring_to_nest = None
+
+    @property
+    def nside(self):
+
+        return self._nside
+
+    @property
+    def n_pixels(self):
+
+        return self._n_pixels
+
+    @property
+    def pixel_area(self):
+        """
+        The area of each pixel (sr)
+        """
+
+        return 4 * np.pi / self._n_pixels
+
+    @property
+    def sky_grid(self):
+        """
+        The pixel centers, as a SkyGrid
+        """
+
+        return self._sky_grid
+
+    @property
+    def lon(self):
+
+        return self._sky_grid.lon
+
+    @property
+    def lat(self):
+
+        return self._sky_grid.lat
+
+    def get_latitude_range(self, min_lat, max_lat):
+        """
+        Returns the range of the pixels with center within the provided latitudes. In the RING scheme the pixels are
+        ordered by decreasing latitude, so this is a contiguous range
+
+        :param min_lat: minimum latitude (deg)
+        :param max_lat: maximum latitude (deg)
+        :return: a tuple (start, stop), such that the pixels are start, start + 1, ..., stop - 1
+        """
+
+        # -lat is sorted in increasing order
+
+        minus_lat = -self._sky_grid.lat
+
+        start = np.searchsorted(minus_lat, -max_lat, 'left')
+        stop = np.searchsorted(minus_lat, -min_lat, 'right')
+
+        return int(start), int(stop)
+
+    def get_ring_to_nest(self):
+        """
+        Returns the array giving the NESTED index of each pixel in the RING scheme (computed the first time)
+        """
+
+        if self._ring_to_nest is None:
+
+            ring_to_nest = np.zeros(self._n_pixels, dtype=np.int64)
+            ring_to_nest[nest_to_ring(self._nside, np.arange(self._n_pixels))] = np.arange(self._n_pixels)
+
+            self._ring_to_nest = ring_to_nest
+
+        return self._ring_to_nest
+
+
+# Geometries for the most recently used nside values (they can be big, so only a few are kept)
+
+_healpix_geometries = collections.OrderedDict()
+
+
+def get_healpix_geometry(nside):
+    """
+    Returns the HealpixGeometry for the provided nside. The last few geometries used are cached
+
+    :param nside: the nside of the map
+    :return: a HealpixGeometry instance
+    """
+
+    geometry = _healpix_geometries.pop(nside, None)
+
+    if geometry is None:
+
+        geometry = HealpixGeometry(nside)
+
+        if len(_healpix_geometries) >= 3:
+
+            _healpix_geometries.popitem(False)
+
+    _healpix_geometries[nside] = geometry
+
+    return geometry
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+class SeparableCube(object):
+    """
+    A cube with shape (n_points, n_energies) which is the outer product of a spatial factor (n_points) and of a
+    spectral factor (n_energies), like the brightness of an extended source with a 2D spatial shape. The cube is never
+    built unless explicitly requested (with materialize() or np.asarray), and the contractions with response matrices
+    only involve the factors:
+
+    > cube = source(ra, dec, energies, separable=True)
+    > counts = cube.dot(energy_dispersion)  # (n_points, n_channels), still separable
+    > counts = cube.rdot(psf_matrix)  # (n_pixels, n_energies), still separable
+
+    In Python 3 the @ operator can be used as well.
+
+    :param spatial: the spatial factor (array with n_points elements)
+    :param spectral: the spectral factor (array with n_energies elements)
+    """
+
+    def __init__(self, spatial, spectral):
+
+        self._spatial = spatial
+        self._spectral = spectral
+
+    @property
+    def spatial(self):
+        """
+        The spatial factor of the cube (n_points)
+        """
+
+        return self._spatial
+
+    @property
+    def spectral(self):
+        """
+        The spectral factor of the cube (n_energies)
+        """
+
+        return self._spectral
+
+    @property
+    def shape(self):
+
+        return self._spatial.shape[0], self._spectral.shape[0]
+
+    def materialize(self):
+        """
+        Builds the full cube
+
+        :return: an array with shape (n_points, n_energies)
+        """
+
+        return self._spatial[:, np.newaxis] * self._spectral[np.newaxis, :]
+
+    def __array__(self, dtype=None):
+
+        cube = self.materialize()
+
+        return cube if dtype is None else cube.astype(dtype)
+
+    def dot(self, matrix):
+        """
+        Contracts the energy axis of the cube with the provided matrix (for example an energy dispersion), i.e.,
+        returns the equivalent of np.dot(cube, matrix)
+
+        :param matrix: an array with shape (n_energies,) or (n_energies, n_channels)
+        :return: an array with shape (n_points,) if matrix is 1d, otherwise a SeparableCube with shape
+        (n_points, n_channels)
+        """
+
+        spectral = np.dot(self._spectral, matrix)
+
+        if np.ndim(spectral) == 0:
+
+            return self._spatial * spectral
+
+        else:
+
+            return SeparableCube(self._spatial, spectral)
+
+    def rdot(self, matrix):
+        """
+        Contracts the spatial axis of the cube with the provided matrix (for example a PSF), i.e., returns the
+        equivalent of np.dot(matrix, cube)
+
+        :param matrix: an array with shape (n_points,) or (n_pixels, n_points)
+        :return: an array with shape (n_energies,) if matrix is 1d, otherwise a SeparableCube with shape
+        (n_pixels, n_energies)
+        """
+
+        spatial = np.dot(matrix, self._spatial)
+
+        if np.ndim(spatial) == 0:
+
+            return spatial * self._spectral
+
+        else:
+
+            return SeparableCube(spatial, self._spectral)
+
+    def __matmul__(self, matrix):
+
+        return self.dot(matrix)
+
+    def __rmatmul__(self, matrix):
+
+        return self.rdot(matrix)
+
+    def sum(self, axis=None):
+        """
+        Sums the cube along the provided axis (or all the elements), like np.sum
+
+        :param axis: None, 0 (spatial axis) or 1 (energy axis)
+        :return: a number, or an array
+        """
+
+        if axis is None:
+
+            return np.sum(self._spatial) * np.sum(self._spectral)
+
+        elif axis == 0:
+
+            return np.sum(self._spatial) * self._spectral
+
+        else:
+
+            assert axis == 1, "The cube has only 2 axes"
+
+            return self._spatial * np.sum(self._spectral)
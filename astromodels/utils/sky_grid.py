@@ -0,0 +1,313 @@
+import collections
+import hashlib
+
+import numpy as np
+
+from astromodels.utils.angular_distance import angular_distance
+
+
+class SkyGridCoordinates(np.ndarray):
+    """
+    The longitudes or the latitudes of a SkyGrid. These are normal (read-only) arrays, which in addition keep a
+    reference to the grid they belong to, so that the spatial functions can use the quantities cached in the grid.
+    """
+
+    def __array_finalize__(self, obj):
+
+        # Only the arrays created by the SkyGrid belong to it (not their slices, copies or the results of
+        # operations on them)
+
+        self.sky_grid = None
+
+    def __array_wrap__(self, out_arr, context=None):
+
+        # The results of operations are normal arrays (or numbers)
+
+        out_arr = np.ndarray.__array_wrap__(self, out_arr, context).view(np.ndarray)
+
+        if out_arr.ndim == 0:
+
+            return out_arr[()]
+
+        else:
+
+            return out_arr
+
+
+def _get_input_type(x):
+
+    # Returns the type of the input for the type checks in the functions and in the sources, where the coordinates
+    # of a SkyGrid are just arrays
+
+    return np.ndarray if isinstance(x, SkyGridCoordinates) else type(x)
+
+
+def _get_unit_vector(lon, lat):
+
+    lon_rad = np.deg2rad(lon)
+    lat_rad = np.deg2rad(lat)
+
+    cos_lat = np.cos(lat_rad)
+
+    return np.array([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)])
+
+
+class SkyGrid(object):
+    """
+    A fixed set of points on the sky, for example the pixels of a likelihood analysis. The Cartesian unit vectors of
+    the points are computed once, so that the angular distance between all the points and a given position only
+    requires trigonometric functions of the latter.
+
+    Use the lon and lat attributes as input for the spatial functions (or for an extended source), like:
+
+    > grid = SkyGrid(ra, dec)
+    > values = Gaussian_on_sphere()(grid.lon, grid.lat)
+
+    :param lon: longitudes of the points (deg)
+    :param lat: latitudes of the points (deg)
+    """
+
+    def __init__(self, lon, lat):
+
+        lon = np.array(lon, dtype=float, ndmin=1)
+        lat = np.array(lat, dtype=float, ndmin=1)
+
+        assert lon.shape == lat.shape and lon.ndim == 1, "Longitudes and latitudes must be 1d arrays with the same " \
+                                                         "number of elements"
+
+        # Cartesian unit vectors, with shape (3, n_points)
+
+        self._set_points(lon, lat, _get_unit_vector(lon, lat))
+
+        self._root = self
+        self._offset = 0
+
+        # Sub-grids of this grid (see get_subgrid), keyed by their range of points
+
+        self._subgrids = collections.OrderedDict()
+
+        self._key = None
+
+    def _set_points(self, lon, lat, unit_vectors):
+
+        self._lon = lon.view(SkyGridCoordinates)
+        self._lat = lat.view(SkyGridCoordinates)
+
+        for coordinates in [self._lon, self._lat]:
+
+            coordinates.sky_grid = self
+
+            # Make sure the cache cannot become stale
+
+            coordinates.flags.writeable = False
+
+        self._unit_vectors = unit_vectors
+
+    @property
+    def lon(self):
+        """
+        The longitudes of the points (deg)
+        """
+
+        return self._lon
+
+    @property
+    def lat(self):
+        """
+        The latitudes of the points (deg)
+        """
+
+        return self._lat
+
+    @property
+    def n_points(self):
+
+        return self._lon.shape[0]
+
+    @property
+    def unit_vectors(self):
+        """
+        The Cartesian unit vectors of the points, as an array with shape (3, n_points)
+        """
+
+        return self._unit_vectors
+
+    @property
+    def root(self):
+        """
+        The grid this grid is a part of (see get_subgrid), or the grid itself if it is not a sub-grid
+        """
+
+        return self._root
+
+    @property
+    def offset(self):
+        """
+        The index of the first point of this grid in its root grid (0 if it is not a sub-grid)
+        """
+
+        return self._offset
+
+    @property
+    def key(self):
+        """
+        A hash of the coordinates of the points (computed the first time), which can be used as key for caches of
+        quantities depending on the points. Since the coordinates cannot be changed, it never becomes stale
+        """
+
+        if self._key is None:
+
+            self._key = hashlib.md5(np.ascontiguousarray(self._lon)).hexdigest() + \
+                        hashlib.md5(np.ascontiguousarray(self._lat)).hexdigest()
+
+        return self._key
+
+    def get_subgrid(self, start, stop):
+        """
+        Returns the grid made by the points start, start + 1, ..., stop - 1 of this grid (for example to evaluate a
+        function on chunks of the points). The sub-grid shares the memory and the unit vectors with this grid, and
+        knows its position in the root grid (see the root and offset properties). The last few sub-grids are cached,
+        so asking again for the same range returns the same instance
+
+        :param start: index of the first point
+        :param stop: index of the last point + 1
+        :return: a SkyGrid instance
+        """
+
+        # Sub-grids are always created from the root grid, so that sub-grids of sub-grids are cached as well
+
+        start, stop, _ = slice(start, stop).indices(self.n_points)
+
+        start, stop = self._offset + start, self._offset + max(start, stop)
+
+        root = self._root
+
+        subgrid = root._subgrids.pop((start, stop), None)
+
+        if subgrid is None:
+
+            subgrid = SkyGrid.__new__(SkyGrid)
+
+            subgrid._set_points(root._lon[start:stop].view(np.ndarray), root._lat[start:stop].view(np.ndarray),
+                                root._unit_vectors[:, start:stop])
+
+            subgrid._root = root
+            subgrid._offset = start
+            subgrid._subgrids = None
+            subgrid._key = None
+
+            if len(root._subgrids) >= 100:
+
+                root._subgrids.popitem(False)
+
+        root._subgrids[(start, stop)] = subgrid
+
+        return subgrid
+
+    def cos_angular_distance(self, lon0, lat0, indices=None):
+        """
+        Returns the cosine of the angular distance between the points and the provided position
+
+        :param lon0: longitude of the position (deg)
+        :param lat0: latitude of the position (deg)
+        :param indices: (optional) indices of the points to use (default: all)
+        :return: array with one element for each point
+        """
+
+        unit_vectors = self._unit_vectors if indices is None else self._unit_vectors[:, indices]
+
+        return _get_unit_vector(lon0, lat0).dot(unit_vectors)
+
+    def angular_distance(self, lon0, lat0):
+        """
+        Returns the angular distance between all the points and the provided position. This is computed as
+        arctan2(|v x c|, v . c), where v and c are the unit vectors of the points and of the position, which is the
+        Vincenty formula used by astromodels.utils.angular_distance (stable for all distances)
+
+        :param lon0: longitude of the position (deg)
+        :param lat0: latitude of the position (deg)
+        :return: angular distances (deg), one for each point
+        """
+
+        c = _get_unit_vector(lon0, lat0)
+
+        x, y, z = self._unit_vectors
+
+        cross_x = c[1] * z - c[2] * y
+        cross_y = c[2] * x - c[0] * z
+        cross_z = c[0] * y - c[1] * x
+
+        return np.rad2deg(np.arctan2(np.sqrt(cross_x ** 2 + cross_y ** 2 + cross_z ** 2), c.dot(self._unit_vectors)))
+
+
+def get_sky_grid(lon, lat):
+    """
+    Returns the SkyGrid which the provided coordinates belong to, or None if they do not come from a SkyGrid
+
+    :param lon: longitudes
+    :param lat: latitudes
+    :return: a SkyGrid instance or None
+    """
+
+    sky_grid = getattr(lon, 'sky_grid', None)
+
+    if sky_grid is not None and lat is sky_grid.lat:
+
+        return sky_grid
+
+    else:
+
+        return None
+
+
+def angular_distance_on_grid(lon0, lat0, lon, lat):
+    """
+    Returns the angular distance between a position and a set of points. If the points come from a SkyGrid, its
+    cached unit vectors are used, otherwise this is the same as astromodels.utils.angular_distance
+
+    :param lon0: longitude of the position (deg)
+    :param lat0: latitude of the position (deg)
+    :param lon: longitudes of the points (deg)
+    :param lat: latitudes of the points (deg)
+    :return: angular distances (deg)
+    """
+
+    sky_grid = get_sky_grid(lon, lat)
+
+    if sky_grid is not None:
+
+        return sky_grid.angular_distance(lon0, lat0)
+
+    else:
+
+        return angular_distance(lon0, lat0, lon, lat)
+
+
+def cos_angular_distance_on_grid(lon0, lat0, lon, lat):
+    """
+    Returns the cosine of the angular distance between a position and a set of points. If the points come from a
+    SkyGrid, its cached unit vectors are used, otherwise the spherical law of cosines is used (which requires only 3
+    trigonometric functions per point). This is useful for containment tests (angular distance <= radius, i.e.,
+    cosine >= cos(radius)), which do not need the angular distance itself
+
+    :param lon0: longitude of the position (deg)
+    :param lat0: latitude of the position (deg)
+    :param lon: longitudes of the points (deg)
+    :param lat: latitudes of the points (deg)
+    :return: cosine of the angular distances
+    """
+
+    sky_grid = get_sky_grid(lon, lat)
+
+    if sky_grid is not None:
+
+        return sky_grid.cos_angular_distance(lon0, lat0)
+
+    else:
+
+        lat_rad = np.deg2rad(lat)
+        lat0_rad = np.deg2rad(lat0)
+
+        return np.sin(lat_rad) * np.sin(lat0_rad) + \
+               np.cos(lat_rad) * np.cos(lat0_rad) * np.cos(np.deg2rad(lon - lon0))
+
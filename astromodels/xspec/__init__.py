@@ -1 +1,8 @@
-from .factory import *
\ No newline at end of file
+import sys
+
+from .factory import *
+from .factory import new_functions, _LazyXspecModule
+
+# Like the factory module, this package creates the classes for the XSPEC models only when they are first accessed
+
+sys.modules[__name__] = _LazyXspecModule(sys.modules[__name__])
@@ -1,14 +1,22 @@
 import collections
+import cPickle
+import functools
+import hashlib
 import sys
+import types
+import uuid
 
 import astropy.units as u
+import numpy as np
 import os
 import re
 import warnings
 
 from astromodels.core.my_yaml import my_yaml
-from astromodels.functions.function import get_function_class
+from astromodels.functions.function import get_function_class, register_lazy_function
+from astromodels.functions.process_pool import FunctionProcessPool
 from astromodels.utils.configuration import get_user_data_path
+from astromodels.version import __version__
 
 
 class XSpecNotAvailable(ImportWarning):
@@ -76,6 +84,80 @@ def find_model_dat():
     return os.path.abspath(final_path)
 
 
+def get_cache_directory(model_dat_path, data_path=None):
+    """
+    Returns the directory which contains the cache for the provided model.dat file, i.e., the parsed model
+    definitions and the generated code for the classes. The name of the directory contains the checksum of model.dat
+    (and of the code template) and the version of astromodels, so that a change in any of them will cause the cache
+    to be regenerated.
+
+    :param model_dat_path: the path to the model.dat file
+    :param data_path: the directory where to put the cache (default: the user data directory)
+    :return: path to the cache directory
+    """
+
+    if data_path is None:
+
+        data_path = get_user_data_path()
+
+    # The checksum includes also the template used to generate the code, so that the code is regenerated if the
+    # template changes
+
+    with open(model_dat_path, 'rb') as f:
+
+        checksum = hashlib.md5(f.read() + class_definition_code).hexdigest()
+
+    cache_directory = os.path.join(data_path, 'xspec_cache', '%s_%s' % (__version__, checksum))
+
+    if not os.path.exists(cache_directory):
+
+        os.makedirs(cache_directory)
+
+    return cache_directory
+
+
+def get_cached_models(model_dat_path, cache_directory):
+    """
+    Same as get_models, but the parsed definitions are read from (or saved into) the cache directory, so that
+    model.dat is parsed only once.
+
+    :param model_dat_path: the path to the model.dat file
+    :param cache_directory: the cache directory for this model.dat (see get_cache_directory)
+    :return: dictionary containing the definition of all XSpec models
+    """
+
+    cache_file = os.path.join(cache_directory, 'model_definitions.pkl')
+
+    if os.path.exists(cache_file):
+
+        try:
+
+            with open(cache_file, 'rb') as f:
+
+                return cPickle.load(f)
+
+        except Exception:  # pragma: no cover
+
+            # The cache is corrupted, regenerate it
+
+            warnings.warn("Cache file %s is corrupted. Regenerating it." % cache_file)
+
+    model_definitions = get_models(model_dat_path)
+
+    # Write to a temporary file and then move it in place, so that another process can never read
+    # a partially-written file
+
+    temp_file = '%s.%s' % (cache_file, uuid.uuid4().hex)
+
+    with open(temp_file, 'wb') as f:
+
+        cPickle.dump(model_definitions, f, cPickle.HIGHEST_PROTOCOL)
+
+    os.rename(temp_file, cache_file)
+
+    return model_definitions
+
+
 def get_models(model_dat_path):
     """
     Parse the model.dat file from Xspec and returns a dictionary containing the definition of all the models
@@ -416,15 +498,25 @@ $DOCSTRING$
             parameters_tuple = ($PARAMETERS_NAMES$,)
         
         # We need to make sure that the energy array is sorted because otherwise some Xspec models will give
-        # incorrect values
-        idx = np.argsort(x)
-        
-        # This is needed to be able to "reverse" the sort operation
-        rev_idx = np.argsort(idx)
-        
-        # Ordered input vector
-        
-        xx = x[idx]
+        # incorrect values. The input is almost always already sorted, in which case we skip the sorting
+        # (checking is O(n) while sorting and "un-sorting" is O(n log n))
+
+        if np.all(x[1:] >= x[:-1]):
+
+            xx = x
+
+            rev_idx = None
+
+        else:
+
+            idx = np.argsort(x)
+
+            # This is needed to be able to "reverse" the sort operation
+            rev_idx = np.argsort(idx)
+
+            # Ordered input vector
+
+            xx = x[idx]
         
         if self._differentiate:
 
@@ -479,20 +571,23 @@ $DOCSTRING$
 
                 final_value = self._model(parameters_tuple, ((xx)[0], (xx)[0]))
 
+        if rev_idx is not None:
+
+            final_value = final_value[rev_idx]
 
         if quantity:
 
             if self._model_type == 'add':
 
-                return final_value[rev_idx] * u.Unit('1 / (keV cm^2 s)')
+                return final_value * u.Unit('1 / (keV cm^2 s)')
 
             else:
 
-                return final_value[rev_idx] * u.dimensionless_unscaled
+                return final_value * u.dimensionless_unscaled
 
         else:
 
-            return final_value[rev_idx]
+            return final_value
 
     def has_fixed_units(self):
 
@@ -517,21 +612,108 @@ $DOCSTRING$
         # Create a tuple of the current values of the parameters
         parameters_tuple = ($PARAMETERS_NAMES$,)
 
-        return self._model(parameters_tuple, low_bounds, hi_bounds)
+        try:
+
+            return self._model(parameters_tuple, low_bounds, hi_bounds)
+
+        except TypeError:
+
+            # Xspec complains when there is only one bin, handle that as a special case
+
+            assert low_bounds.shape[0] == 1, "This is a bug, xspec call failed and there is more than one bin"
+
+            return np.array(self._model(parameters_tuple, (low_bounds[0], hi_bounds[0]))[0], ndmin=1)
+
+    def integral(self, e_lo, e_hi=None):
+        """
+        Returns the output of the Xspec function over the provided energy bins, computed with only one call to Xspec.
+        For additive models this is the integral of the differential flux in each bin (i.e., the photon flux), for
+        multiplicative models it is the average factor in each bin. This is much faster and more accurate than
+        evaluating the differential flux and integrating it.
+
+        :param e_lo: lower bounds of the bins (in keV if not a Quantity). If e_hi is None, these are the edges of
+        contiguous bins (i.e., n + 1 values for n bins)
+        :param e_hi: upper bounds of the bins (in keV if not a Quantity), or None
+        :return: the value for each bin
+        """
+
+        quantity = isinstance(e_lo, u.Quantity)
+
+        if quantity:
+
+            e_lo = e_lo.to('keV').value
+
+            if e_hi is not None:
+
+                e_hi = e_hi.to('keV').value
+
+        e_lo = np.array(e_lo, ndmin=1, copy=False, dtype=float)
+
+        if e_hi is None:
+
+            # Contiguous bins
+
+            e_lo, e_hi = e_lo[:-1], e_lo[1:]
+
+        else:
+
+            e_hi = np.array(e_hi, ndmin=1, copy=False, dtype=float)
+
+        assert e_lo.shape == e_hi.shape, "Lower and upper bounds of the bins must have the same number of elements"
+
+        # As in evaluate, make sure that the bins are sorted (but sort only if needed)
+
+        if np.all(e_lo[1:] >= e_lo[:-1]):
+
+            rev_idx = None
+
+        else:
+
+            idx = np.argsort(e_lo)
+
+            rev_idx = np.argsort(idx)
+
+            e_lo = e_lo[idx]
+            e_hi = e_hi[idx]
+
+        values = tuple(parameter.value for parameter in self.parameters.values())
+
+        result = np.array(self._integral(e_lo, e_hi, *values), ndmin=1, copy=False)
+
+        if rev_idx is not None:
+
+            result = result[rev_idx]
+
+        if quantity:
+
+            if self._model_type == 'add':
+
+                return result * u.Unit('1 / (cm^2 s)')
+
+            else:
+
+                return result * u.dimensionless_unscaled
+
+        else:
+
+            return result
 
 '''
 
 
-def xspec_model_factory(model_name, xspec_function, model_type, definition):
+def xspec_model_factory(model_name, xspec_function, model_type, definition, code_directory=None):
 
     class_name = 'XS_%s' % model_name
 
-    # Get the path to the user data directory
-    user_data_path = get_user_data_path()
+    # By default the code goes in the user data directory
+
+    if code_directory is None:
+
+        code_directory = get_user_data_path()
 
     # Check if the code for this function already exists
 
-    code_file_name = os.path.join(user_data_path, '%s.py' % class_name)
+    code_file_name = os.path.join(code_directory, '%s.py' % class_name)
 
     if os.path.exists(code_file_name):
 
@@ -581,9 +763,9 @@ def xspec_model_factory(model_name, xspec_function, model_type, definition):
             f.write("\n\n%s\n" % code)
 
     # Add the path to sys.path if it doesn't
-    if user_data_path not in sys.path:
+    if code_directory not in sys.path:
 
-        sys.path.append(user_data_path)
+        sys.path.append(code_directory)
 
     # Import the class in the current namespace (locals)
     with warnings.catch_warnings():
@@ -596,12 +778,29 @@ def xspec_model_factory(model_name, xspec_function, model_type, definition):
 
 
 def setup_xspec_models():
+    """
+    Register all the XSPEC models as known functions. The classes are not created here: each one is generated
+    (or read from the code cache) and imported the first time it is used, for example through get_function_class
+    or by importing it from this module.
+
+    :return: the list of the names of the classes for the XSPEC models
+    """
 
     classes = []
 
-    sys.stdout.write("Loading xspec models...")
+    model_dat_path = find_model_dat()
+
+    cache_directory = get_cache_directory(model_dat_path)
 
-    all_models = get_models(find_model_dat())
+    all_models = get_cached_models(model_dat_path, cache_directory)
+
+    # The generated code is imported from the cache directory, so it must be in sys.path. This is done here and not
+    # when the classes are created, so that classes generated in another process (for example pickled instances, or
+    # instances sent to the workers of a XspecProcessPool) can always be imported
+
+    if cache_directory not in sys.path:
+
+        sys.path.append(cache_directory)
 
     for (model_name, xspec_function, model_type) in all_models:
 
@@ -622,25 +821,65 @@ def setup_xspec_models():
         # (it happens in the metaclass), so we don't need to do anything special here after the
         # class type is created
 
-        this_class_name, this_class = xspec_model_factory(model_name, xspec_function, model_type, this_model)
+        this_class_name = 'XS_%s' % model_name
 
-        classes.append(this_class_name)
+        register_lazy_function(this_class_name, functools.partial(xspec_model_factory, model_name, xspec_function,
+                                                                  model_type, this_model, cache_directory))
 
-    sys.stdout.write("done\n")
+        classes.append(this_class_name)
 
     return classes
 
-# This will either work or issue a warning if XSpec is not available
 
-new_functions = setup_xspec_models()
+class _LazyXspecModule(types.ModuleType):
+    """
+    A replacement for this module (and for the astromodels.xspec package), which creates the class for a XSPEC model
+    the first time it is accessed as an attribute (like in "from astromodels.xspec import XS_powerlaw")
+    """
+
+    def __init__(self, module):
+
+        super(_LazyXspecModule, self).__init__(module.__name__, module.__doc__)
+
+        self.__dict__.update(module.__dict__)
 
-# Now import the new classes in the local namespace (if any)
-# This is needed to make the classes pickeable
+        # We need to keep a reference to the original module, otherwise its globals would be cleared when it
+        # gets garbage collected
 
-__all__ = []
+        self._original_module = module
+
+    def __getattr__(self, name):
+
+        # This is called only if the normal attribute lookup fails
+
+        if name in self.__dict__.get('new_functions', []):
+
+            this_class = get_function_class(name)
+
+            # Store it so next time the normal lookup will find it
+
+            setattr(self, name, this_class)
+
+            return this_class
+
+        raise AttributeError("Module %s has no attribute %s" % (self.__name__, name))
+
+
+# The process pool works with any known function (see astromodels.functions.process_pool), but it is mostly useful for
+# the XSPEC models, which cannot be evaluated concurrently in threads
+
+XspecProcessPool = FunctionProcessPool
+
+
+# This will either work or issue a warning if XSpec is not available
+
+new_functions = setup_xspec_models()
 
-for function_name in new_functions:
+# The classes will be available as attributes of this module (and of the astromodels.xspec package) when first
+# accessed. This is needed to make the classes pickeable. NOTE: the names of the classes are not in __all__, otherwise
+# "from ... import *" would create all of them. Use get_function_class, or import the classes explicitly, like in
+# "from astromodels.xspec import XS_powerlaw"
 
-    __all__.append(function_name)
+__all__ = ['XspecProcessPool']
 
-    locals()[function_name] = get_function_class(function_name)
+sys.modules[__name__] = _LazyXspecModule(sys.modules[__name__])